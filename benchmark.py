@@ -0,0 +1,309 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pydub import AudioSegment
+
+# Reproducible throughput benchmark for flacHelper.
+#
+# A synthetic library (pink noise plus a tone per track, seeded so every run
+# produces the same audio) is generated once per configuration and reused. Each
+# engine trial runs in a fresh interpreter so CPU time and peak RSS belong to
+# that trial alone. Results are written as JSON and can be compared against an
+# earlier file to spot regressions:
+#
+#   python benchmark.py --count 100 --duration 30 --formats flac,wav --output new.json --compare old.json
+
+FORMAT_CODECS = {
+    "flac": ["-c:a", "flac"],
+    "wav": ["-c:a", "pcm_s16le"],
+    "ogg": ["-c:a", "libvorbis", "-q:a", "5"],
+    "m4a": ["-c:a", "aac", "-b:a", "192k"],
+}
+
+# Option sets passed to scan_and_convert, by engine name.
+ENGINES = {
+    "pydub-serial": {"backend": "pydub", "jobs": 1},
+    "ffmpeg-serial": {"backend": "ffmpeg", "jobs": 1},
+    "ffmpeg-parallel": {"backend": "ffmpeg"},
+    "ffmpeg-streaming": {"backend": "ffmpeg", "schedule": "streaming"},
+    "native-serial": {"backend": "native", "jobs": 1},
+    "native-parallel": {"backend": "native"},
+    # Against the engines above, the cost of measuring loudness while converting.
+    "ffmpeg-serial-replaygain": {"backend": "ffmpeg", "jobs": 1, "replaygain": True},
+    "native-serial-replaygain": {"backend": "native", "jobs": 1, "replaygain": True},
+}
+DEFAULT_ENGINES = ["pydub-serial", "ffmpeg-serial", "ffmpeg-parallel", "native-serial"]
+
+# Per-file overhead is measured on a second library of the same shape whose
+# tracks are this short, so spawn, pipe and setup costs dominate the audio work.
+OVERHEAD_TRACK_SECONDS = 0.5
+
+LIBRARY_MARKER = ".benchmark_library.json"
+REGRESSION_THRESHOLD = 1.10
+
+
+def library_config(count=20, duration=30.0, sample_rate=44100, formats=("flac",), layout="deep", seed=0):
+    return {
+        "count": count,
+        "duration": duration,
+        "sample_rate": sample_rate,
+        "formats": list(formats),
+        "layout": layout,
+        "seed": seed,
+    }
+
+
+def default_library_path(config):
+    digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), "flacconvert_benchmark", digest)
+
+
+def _track_path(library_path, config, index):
+    extension = config["formats"][index % len(config["formats"])]
+    filename = f"track_{index:05d}.{extension}"
+    if config["layout"] == "flat":
+        return os.path.join(library_path, filename)
+    # artist/album/track, ten tracks per album and ten albums per artist.
+    return os.path.join(library_path, f"artist_{index // 100:03d}", f"album_{index // 10 % 10:02d}", filename)
+
+
+def _generate_track(path, extension, duration, sample_rate, rng_seed):
+    rng = random.Random(rng_seed)
+    frequency = rng.randint(110, 880)
+    command = [
+        AudioSegment.converter, "-nostdin", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"anoisesrc=d={duration}:c=pink:r={sample_rate}:a=0.1:seed={rng.randint(0, 2 ** 31)}",
+        "-f", "lavfi", "-i", f"sine=f={frequency}:r={sample_rate}:d={duration}",
+        "-filter_complex", "amix=inputs=2:duration=shortest",
+        "-ac", "2", "-ar", str(sample_rate),
+        *FORMAT_CODECS[extension],
+        path,
+    ]
+    subprocess.run(command, check=True, stdin=subprocess.DEVNULL)
+
+
+def generate_library(library_path, config):
+    # Creates the synthetic library described by config, unless library_path
+    # already holds one generated from the same config.
+    marker = os.path.join(library_path, LIBRARY_MARKER)
+    if os.path.exists(marker):
+        with open(marker, "r", encoding="utf-8") as f:
+            if json.load(f) == config:
+                return library_path
+        shutil.rmtree(library_path)
+
+    unknown = set(config["formats"]) - set(FORMAT_CODECS)
+    if unknown:
+        raise ValueError(f"Unsupported benchmark formats: {sorted(unknown)}")
+
+    os.makedirs(library_path, exist_ok=True)
+    tracks = [_track_path(library_path, config, index) for index in range(config["count"])]
+    for folder in {os.path.dirname(path) for path in tracks}:
+        os.makedirs(folder, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        futures = [
+            executor.submit(_generate_track, path, os.path.splitext(path)[1][1:], config["duration"],
+                            config["sample_rate"], config["seed"] * 1000003 + index)
+            for index, path in enumerate(tracks)
+        ]
+        for future in futures:
+            future.result()
+
+    with open(marker, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    return library_path
+
+
+def _peak_rss_kb(usage):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    return usage.ru_maxrss / 1024 if sys.platform == "darwin" else usage.ru_maxrss
+
+
+def run_trial(library_path, options):
+    # Runs one conversion of the library in this process and returns its metrics.
+    import resource
+    from flacHelper import scan_and_convert
+
+    output_folder = tempfile.mkdtemp(prefix="flacconvert_benchmark_out_")
+    before_self = resource.getrusage(resource.RUSAGE_SELF)
+    before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    try:
+        results = scan_and_convert(library_path, output_folder, **options)
+    finally:
+        wall = time.perf_counter() - started
+        shutil.rmtree(output_folder, ignore_errors=True)
+    after_self = resource.getrusage(resource.RUSAGE_SELF)
+    after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu_seconds = sum(
+        getattr(after, field) - getattr(before, field)
+        for before, after in ((before_self, after_self), (before_children, after_children))
+        for field in ("ru_utime", "ru_stime")
+    )
+    converted = [result for result in results if result["status"] == "converted"]
+    # Files a backend could not handle and passed to its fallback.
+    backend = options.get("backend", "pydub")
+    fallbacks = [result for result in converted if result.get("backend", backend) != backend]
+    audio_seconds = sum(result.get("duration") or 0.0 for result in converted)
+    return {
+        "wall_seconds": wall,
+        "files": len(results),
+        "converted": len(converted),
+        "failed": len(results) - len(converted),
+        "fallback_files": len(fallbacks),
+        "files_per_second": len(converted) / wall if wall else 0.0,
+        "audio_seconds_per_second": audio_seconds / wall if wall else 0.0,
+        "cpu_seconds": cpu_seconds,
+        "cpu_utilization": cpu_seconds / (wall * (os.cpu_count() or 1)) if wall else 0.0,
+        "peak_rss_kb": max(_peak_rss_kb(after_self), _peak_rss_kb(after_children)),
+    }
+
+
+def _run_trial_subprocess(library_path, options):
+    # A fresh interpreter per trial keeps rusage (especially peak RSS) separate.
+    spec = json.dumps({"library": library_path, "options": options})
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-trial", spec],
+                             capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def _ffmpeg_version():
+    try:
+        process = subprocess.run([AudioSegment.converter, "-version"], capture_output=True, text=True)
+        return process.stdout.splitlines()[0] if process.stdout else None
+    except OSError:
+        return None
+
+
+def _median_runs(runs):
+    return {metric: statistics.median(run[metric] for run in runs) for metric in runs[0]}
+
+
+def run_benchmark(config, engines=DEFAULT_ENGINES, repeat=3, library_path=None, overhead=True):
+    # With overhead, each engine also converts a library of OVERHEAD_TRACK_SECONDS
+    # clips and reports wall and CPU milliseconds per file there.
+    library_path = generate_library(library_path or default_library_path(config), config)
+    overhead_config = dict(config, duration=OVERHEAD_TRACK_SECONDS)
+    overhead_path = generate_library(default_library_path(overhead_config), overhead_config) if overhead else None
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "ffmpeg": _ffmpeg_version(),
+        },
+        "library": config,
+        "engines": {},
+    }
+    for name in engines:
+        options = ENGINES[name]
+        runs = [_run_trial_subprocess(library_path, options) for _ in range(repeat)]
+        report["engines"][name] = {
+            "options": options,
+            "runs": runs,
+            "median": _median_runs(runs),
+        }
+        if overhead_path:
+            median = _median_runs([_run_trial_subprocess(overhead_path, options) for _ in range(repeat)])
+            report["engines"][name]["overhead"] = {
+                "track_seconds": OVERHEAD_TRACK_SECONDS,
+                "ms_per_file": median["wall_seconds"] * 1000 / median["files"] if median["files"] else None,
+                "cpu_ms_per_file": median["cpu_seconds"] * 1000 / median["files"] if median["files"] else None,
+            }
+    return report
+
+
+def compare_reports(previous, current):
+    # Returns one line per engine present in both reports; wall-time slowdowns
+    # beyond REGRESSION_THRESHOLD are flagged.
+    lines = []
+    if previous.get("library") != current.get("library"):
+        lines.append("warning: reports were produced from different library configurations")
+    for name, entry in current["engines"].items():
+        if name not in previous.get("engines", {}):
+            continue
+        old_wall = previous["engines"][name]["median"]["wall_seconds"]
+        new_wall = entry["median"]["wall_seconds"]
+        ratio = new_wall / old_wall if old_wall else float("inf")
+        flag = "  REGRESSION" if ratio > REGRESSION_THRESHOLD else ""
+        lines.append(f"{name}: {old_wall:.2f}s -> {new_wall:.2f}s ({ratio:.2f}x){flag}")
+    return lines
+
+
+def format_report(report):
+    header = (f"{'engine':<20}{'wall s':>9}{'files/s':>10}{'audio s/s':>11}{'cpu %':>8}{'peak MB':>9}{'failed':>8}"
+              f"{'ms/file':>9}{'cpu ms/file':>12}")
+    lines = [header]
+    for name, entry in report["engines"].items():
+        median = entry["median"]
+        overhead = entry.get("overhead") or {}
+        per_file = "".join(f"{value:>{width}.1f}" if value is not None else f"{'-':>{width}}"
+                           for value, width in ((overhead.get("ms_per_file"), 9), (overhead.get("cpu_ms_per_file"), 12)))
+        lines.append(
+            f"{name:<20}{median['wall_seconds']:>9.2f}{median['files_per_second']:>10.1f}"
+            f"{median['audio_seconds_per_second']:>11.1f}{median['cpu_utilization'] * 100:>8.0f}"
+            f"{median['peak_rss_kb'] / 1024:>9.1f}{median['failed']:>8.0f}{per_file}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark flacHelper conversion engines on a synthetic library.")
+    parser.add_argument("--count", type=int, default=20, help="number of tracks")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per track")
+    parser.add_argument("--sample-rate", type=int, default=44100)
+    parser.add_argument("--formats", default="flac", help=f"comma-separated, from {','.join(FORMAT_CODECS)}")
+    parser.add_argument("--layout", choices=["deep", "flat"], default="deep")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--library", help="where to generate the library (default: a temp dir keyed by config)")
+    parser.add_argument("--engines", default=",".join(DEFAULT_ENGINES), help=f"comma-separated, from {','.join(ENGINES)}")
+    parser.add_argument("--repeat", type=int, default=3, help="trials per engine; the median is reported")
+    parser.add_argument("--no-overhead", action="store_true",
+                        help=f"skip the per-file overhead pass on {OVERHEAD_TRACK_SECONDS} s clips")
+    parser.add_argument("--output", default="benchmark_results.json", help="machine-readable results file")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--run-trial", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_trial:
+        spec = json.loads(args.run_trial)
+        print(json.dumps(run_trial(spec["library"], spec["options"])))
+        return 0
+
+    engines = [name.strip() for name in args.engines.split(",") if name.strip()]
+    unknown = [name for name in engines if name not in ENGINES]
+    if unknown:
+        parser.error(f"unknown engines: {', '.join(unknown)}")
+    config = library_config(args.count, args.duration, args.sample_rate,
+                            [fmt.strip() for fmt in args.formats.split(",") if fmt.strip()], args.layout, args.seed)
+
+    report = run_benchmark(config, engines, args.repeat, args.library, overhead=not args.no_overhead)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(format_report(report))
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        for line in compare_reports(previous, report):
+            print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+DEFAULT_CACHE_MAX_BYTES = 10 * 1024 ** 3
+
+
+def cache_key(source_digest, settings):
+    # Identical audio encoded with identical settings yields the same key.
+    settings_digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+    return f"{source_digest}-{settings_digest[:16]}"
+
+
+def link_or_copy(source, destination):
+    # Hardlink when possible (same filesystem), otherwise copy. The destination is
+    # replaced atomically so readers never see a partial file.
+    temp_path = f"{destination}.{uuid.uuid4().hex}.tmp"
+    try:
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            shutil.copyfile(source, temp_path)
+        os.replace(temp_path, destination)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class EncodeCache:
+    # Content-addressed store of encoded files, shareable between runs and output
+    # folders. Entries live at <cache_dir>/<first two key chars>/<key>.mp3; their
+    # mtime is bumped on every hit so evict() can drop the least recently used.
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".mp3")
+
+    def lookup(self, key):
+        path = self._entry_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def store(self, key, encoded_path):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_or_copy(encoded_path, path)
+
+    def evict(self):
+        # Deletes least recently used entries until the cache fits in max_bytes.
+        # Temporary files (see link_or_copy) are entries another run is still
+        # writing, so they are neither counted nor removed.
+        entries = []
+        total = 0
+        for foldername, subfolders, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(foldername, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
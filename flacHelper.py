@@ -1,27 +1,1639 @@
+import argparse
+import heapq
+import json
+import math
 import os
+import queue
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from pydub import AudioSegment
 from pathvalidate import sanitize_filepath
+from encode_cache import DEFAULT_CACHE_MAX_BYTES, EncodeCache, cache_key, link_or_copy
+from manifest import MANIFEST_FILENAME, Manifest, file_digest
+import loudness
+import native_codec
+from mp3_frames import encode_range, frame_samples, segment_bounds, segment_frames
+from probe import sniff_file
+from run_report import RunReport
+from throttle import Throttle, apply_priority, check_priority, parse_cpu_list
 
+SUPPORTED_EXTENSIONS = ('.flac', '.wav', '.ogg', '.m4a', '.aac', '.wma')
 
-def convert_audio_to_mp3(input_path, output_path):
+# Planning estimates. ENCODE_SPEED is audio seconds one worker encodes per wall
+# second (LAME on one core); FALLBACK_BYTES_PER_SECOND turns a file size into a
+# duration guess (roughly CD-quality FLAC) when the header cannot be read.
+ENCODE_SPEED = 40.0
+FALLBACK_BYTES_PER_SECOND = 100000
+
+# Output formats a profile can ask for: ffmpeg encoder, ffmpeg muxer, extension.
+OUTPUT_FORMATS = {
+    "mp3": ("libmp3lame", "mp3", ".mp3"),
+    "ogg": ("libvorbis", "ogg", ".ogg"),
+    "opus": ("libopus", "ogg", ".opus"),
+    "m4a": ("aac", "ipod", ".m4a"),
+}
+
+# Directory scanning threads, and how many discovered files may wait in the
+# queue before scanners block.
+DISCOVERY_THREADS = 8
+DISCOVERY_QUEUE_SIZE = 1024
+
+# Threads moving finished encodes from scratch into the target tree, and how
+# many encoded files per worker may wait for them before scheduling pauses.
+COMMIT_THREADS = 4
+COMMIT_BACKLOG_PER_WORKER = 2
+
+# Shortest stretch of audio worth a segment of its own when a long track is
+# split across cores (see split_longer_than).
+SPLIT_SEGMENT_SECONDS = 60.0
+
+# Decoded PCM read ahead of the loudness measurement: read size, and how many
+# reads may wait (16 MiB, about 40 s of 48 kHz stereo float).
+PIPE_CHUNK_BYTES = 64 * 1024
+PIPE_BUFFER_CHUNKS = 256
+
+
+class ConversionError(RuntimeError):
+    # A backend failure, carrying the encoder's exit code when there is one.
+
+    def __init__(self, message, exit_code=None):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+
+@contextmanager
+def _timed(timings, stage):
+    # Adds the block's wall time to timings[stage]; free when timings is None.
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+
+# Backends decode one file once and encode it to every entry of outputs, each a
+# dict with "path", "format" (a key of OUTPUT_FORMATS) and "bitrate" (e.g. "320k",
+# or None for the encoder default). They return the duration in seconds (None if
+# unknown). timings is None, or a dict that per-stage wall times are added to.
+# input_format is the ffmpeg demuxer for the sniffed container, or None to let
+# ffmpeg probe. analysis is None, or a dict the backend fills with the
+# loudness.LoudnessMeter result for the PCM it decoded.
+
+def _convert_with_pydub(input_path, outputs, timings=None, input_format=None, analysis=None):
+    # Decodes the whole track into an in-memory AudioSegment, then exports it
+    # once per output.
+    with _timed(timings, "decode"):
+        audio = AudioSegment.from_file(input_path, format=input_format)
+    with _timed(timings, "encode"):
+        for output in outputs:
+            encoder, muxer, _ = OUTPUT_FORMATS[output["format"]]
+            audio.export(output["path"], format=muxer, codec=encoder, bitrate=output.get("bitrate"))
+    if analysis is not None:
+        meter = loudness.LoudnessMeter(audio.frame_rate, audio.channels)
+        meter.add_pcm(audio.raw_data, {1: "i1", 2: "<i2", 4: "<i4"}[audio.sample_width])
+        _record_analysis(meter, analysis, timings)
+    return len(audio) / 1000.0
+
+
+def _record_analysis(meter, analysis, timings):
+    analysis.update(meter.result())
+    if timings is not None:
+        timings["loudness"] = timings.get("loudness", 0.0) + meter.seconds
+
+
+def _convert_with_ffmpeg(input_path, outputs, timings=None, input_format=None, analysis=None):
+    # Single ffmpeg process decoding and encoding in one streaming pass, so
+    # memory use does not grow with track length. Every output is fed from the
+    # same decoded stream; for analysis one more output sends it to stdout as
+    # float WAV, which is measured block by block while ffmpeg encodes.
+    command = [
+        AudioSegment.converter, "-nostdin", "-v", "error", "-y",
+        *(["-f", input_format] if input_format else []),
+        "-i", input_path, "-nostats",
+    ]
+    if analysis is None:
+        command += ["-progress", "pipe:1"]
+    for output in outputs:
+        encoder, muxer, _ = OUTPUT_FORMATS[output["format"]]
+        command += ["-map", "0:a:0", "-c:a", encoder]
+        if output.get("bitrate"):
+            command += ["-b:a", output["bitrate"]]
+        command += ["-f", muxer, output["path"]]
+    if analysis is not None:
+        command += ["-map", "0:a:0", "-c:a", "pcm_f32le", "-map_metadata", "-1", "-f", "wav", "pipe:1"]
+    with _timed(timings, "transcode"):
+        if analysis is None:
+            process = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+            returncode, error = process.returncode, process.stderr
+        else:
+            returncode, error, meter = _run_ffmpeg_measured(command)
+    if returncode != 0:
+        for output in outputs:
+            if os.path.exists(output["path"]):
+                os.remove(output["path"])
+        error = error.decode(errors="replace").strip()
+        raise ConversionError(error or f"ffmpeg exited with status {returncode}", returncode)
+    if analysis is None:
+        return _parse_progress_duration(process.stdout)
+    _record_analysis(meter, analysis, timings)
+    return meter.frames / meter.sample_rate
+
+
+class _PipeReader:
+    # File-like reader over a pipe that a background thread keeps draining into
+    # a bounded queue, so the writer is not held up while the consumer works on
+    # what it read. After close() the rest of the pipe is read and discarded.
+
+    def __init__(self, pipe):
+        self._chunks = queue.Queue(maxsize=PIPE_BUFFER_CHUNKS)
+        self._pending = bytearray()
+        self._eof = False
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._pump, args=(pipe,), daemon=True)
+        self._thread.start()
+
+    def _pump(self, pipe):
+        while True:
+            data = pipe.read(PIPE_CHUNK_BYTES)
+            while not self._closed.is_set():
+                try:
+                    self._chunks.put(data, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if not data:
+                return
+
+    def read(self, size):
+        while len(self._pending) < size and not self._eof:
+            data = self._chunks.get()
+            if data:
+                self._pending += data
+            else:
+                self._eof = True
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        return data
+
+    def close(self):
+        # Returns once the pipe has reached end of file.
+        self._closed.set()
+        self._thread.join()
+
+
+def _run_ffmpeg_measured(command):
+    # Runs an ffmpeg command that writes WAV to stdout and measures it as it
+    # arrives. Returns (exit status, stderr, LoudnessMeter). stdout is read
+    # ahead on its own thread (see _PipeReader), so decoding and encoding go on
+    # while a block is measured; stderr is drained on the side as well.
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    errors = []
+    error_reader = threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True)
+    error_reader.start()
+    stdout = _PipeReader(process.stdout)
+    meter = None
+    try:
+        meter = loudness.measure_wav_stream(stdout)
+    except ValueError as e:
+        error = e  # Usually ffmpeg failed before writing PCM, and its status says why.
+    finally:
+        stdout.close()
+        process.stdout.close()
+        returncode = process.wait()
+        error_reader.join()
+    if meter is None and returncode == 0:
+        raise ConversionError(f"Could not measure the decoded audio: {error}")
+    return returncode, errors[0] if errors else b"", meter
+
+
+def _parse_progress_duration(progress_output):
+    # The last out_time_us line of ffmpeg's -progress output is the encoded duration.
+    duration = None
+    for line in progress_output.decode(errors="replace").splitlines():
+        key, _, value = line.partition("=")
+        if key == "out_time_us" and value.strip().isdigit():
+            duration = int(value) / 1000000.0
+    return duration
+
+
+def _convert_with_ffmpeg_split(input_path, outputs, duration, sample_rate, timings=None, input_format=None,
+                               max_segments=None):
+    # MP3-only variant of _convert_with_ffmpeg for very long tracks: the track is
+    # cut into frame-aligned segments that separate ffmpeg processes encode at
+    # the same time, and the segments are spliced back into each output (see
+    # mp3_frames). LAME's bit reservoir is off so every frame stands alone; the
+    # joined files carry no Xing/LAME header. The segments are written untagged,
+    # and the source's tags are copied onto each joined file at the end.
+    # max_segments caps the concurrent encodes (default: one per core).
+    total_samples = round(duration * sample_rate)
+    samples_per_frame = frame_samples(sample_rate)
+    segments = max(2, min(max_segments or os.cpu_count() or 1, math.ceil(duration / SPLIT_SEGMENT_SECONDS)))
+    bounds = segment_bounds(total_samples, segments, samples_per_frame)
+    segment_folder = tempfile.mkdtemp(prefix=".segments-", dir=os.path.dirname(os.path.abspath(outputs[0]["path"])))
+
+    def segment_path(index, number):
+        return os.path.join(segment_folder, f"{index}-{number}.mp3")
+
+    def run(command):
+        process = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            error = process.stderr.decode(errors="replace").strip()
+            raise ConversionError(error or f"ffmpeg exited with status {process.returncode}", process.returncode)
+
+    def encode_segment(index):
+        start, end = encode_range(bounds, index, samples_per_frame)
+        # Seek to a whole second before the segment, then trim to the exact sample.
+        seek = max(0, start // sample_rate - 1)
+        trim = (f"atrim=start_sample={start - seek * sample_rate}:end_sample={end - seek * sample_rate},"
+                "asetpts=PTS-STARTPTS")
+        command = [
+            AudioSegment.converter, "-nostdin", "-v", "error", "-y",
+            *(["-f", input_format] if input_format else []),
+            "-ss", str(seek), "-i", input_path,
+        ]
+        for number, output in enumerate(outputs):
+            command += ["-map", "0:a:0", "-af", trim, "-c:a", "libmp3lame"]
+            if output.get("bitrate"):
+                command += ["-b:a", output["bitrate"]]
+            command += ["-reservoir", "0", "-write_xing", "0", "-id3v2_version", "0", "-write_id3v1", "0",
+                        "-f", "mp3", segment_path(index, number)]
+        run(command)
+
+    try:
+        with _timed(timings, "transcode"):
+            with ThreadPoolExecutor(max_workers=len(bounds) - 1) as executor:
+                list(executor.map(encode_segment, range(len(bounds) - 1)))
+        with _timed(timings, "join"):
+            for number, output in enumerate(outputs):
+                joined_path = os.path.join(segment_folder, f"joined-{number}.mp3")
+                with open(joined_path, "wb") as joined:
+                    for index in range(len(bounds) - 1):
+                        with open(segment_path(index, number), "rb") as f:
+                            joined.write(segment_frames(f.read(), bounds, index, samples_per_frame))
+                # Stream copy: the audio frames are kept as joined, the tags come from the source.
+                run([AudioSegment.converter, "-nostdin", "-v", "error", "-y",
+                     *(["-f", input_format] if input_format else []), "-i", input_path, "-i", joined_path,
+                     "-map", "1:a:0", "-map_metadata", "0", "-c", "copy", "-write_xing", "0",
+                     "-f", "mp3", output["path"]])
+    except Exception:
+        for output in outputs:
+            if os.path.exists(output["path"]):
+                os.remove(output["path"])
+        raise
+    finally:
+        shutil.rmtree(segment_folder, ignore_errors=True)
+    return total_samples / sample_rate
+
+
+class Backend:
+    # A conversion backend: convert is a function as described above, and
+    # can_handle(input_path, input_format, outputs) says whether it supports a
+    # given conversion (None: everything). A conversion it cannot handle goes to
+    # the backend named by fallback instead.
+
+    def __init__(self, convert, can_handle=None, fallback=None):
+        self.convert = convert
+        self.can_handle = can_handle
+        self.fallback = fallback
+
+    def handles(self, input_path, input_format, outputs):
+        return self.can_handle is None or self.can_handle(input_path, input_format, outputs)
+
+
+BACKENDS = {
+    "pydub": Backend(_convert_with_pydub),
+    "ffmpeg": Backend(_convert_with_ffmpeg),
+    # In-process, no subprocess per file; WAV/FLAC/Ogg to MP3 only (see native_codec).
+    "native": Backend(native_codec.convert, native_codec.can_handle, fallback="ffmpeg"),
+}
+
+
+def resolve_backend(backend, input_path, input_format, outputs):
+    # Name of the backend that will actually run a conversion: backend itself,
+    # or the first fallback that can handle it.
+    while not BACKENDS[backend].handles(input_path, input_format, outputs):
+        backend = BACKENDS[backend].fallback
+    return backend
+
+
+def convert_audio(input_path, outputs, backend="pydub", timings=None, input_format=None, split_longer_than=None,
+                  split_segments=None):
+    # Decodes input_path once and writes every rendition in outputs (see the
+    # backends above). Returns a per-file result dict so callers (and worker
+    # processes) can report outcomes without scraping stdout; "output" is the
+    # first rendition and "outputs" lists them all. Pass a dict as timings to
+    # have per-stage wall times recorded into it, and the demuxer from
+    # probe.sniff_file as input_format to decode by the real container rather
+    # than the extension. Encoders write to a temporary name that is renamed
+    # into place once every rendition is done, so an interrupted conversion
+    # never leaves a truncated file under the real name. With split_longer_than
+    # (seconds), an ffmpeg MP3-only conversion of a longer track is split across
+    # cores (see _convert_with_ffmpeg_split), at most split_segments at a time
+    # when given. A backend that cannot handle the
+    # file hands it to its fallback; "backend" in the result names the one used.
+    # When an output has "replaygain" set, integrated loudness and peak are
+    # measured on the decoded PCM (see loudness), reported as "loudness" and
+    # written into those MP3 outputs as ReplayGain tags. Such tracks are never
+    # split, since the segments are decoded by separate processes.
+    result = {"input": input_path, "output": outputs[0]["path"], "outputs": [output["path"] for output in outputs],
+              "status": "converted", "error": None, "duration": None, "backend": backend}
+    analysis = {} if any(output.get("replaygain") for output in outputs) else None
+    partials = [dict(output, path=f"{output['path']}.{uuid.uuid4().hex}.part") for output in outputs]
     try:
         # Sanitize the file path
-        sanitized_path = sanitize_filepath(input_path, replacement_text="_")
+        with _timed(timings, "sanitize"):
+            sanitized_path = sanitize_filepath(input_path, replacement_text="_")
+
+        with _timed(timings, "resolve"):
+            backend = result["backend"] = resolve_backend(backend, sanitized_path, input_format, partials)
+        convert = BACKENDS[backend].convert
+        if (split_longer_than and analysis is None and backend == "ffmpeg"
+                and all(output["format"] == "mp3" for output in outputs)):
+            header = sniff_file(sanitized_path)
+            if header["duration"] and header["sample_rate"] and header["duration"] > split_longer_than:
+                def convert(path, outputs, timings, input_format, analysis=None):
+                    return _convert_with_ffmpeg_split(path, outputs, header["duration"], header["sample_rate"],
+                                                      timings, input_format, split_segments)
 
         # Use the sanitized path in the rest of your code
-        audio = AudioSegment.from_file(sanitized_path)
-        audio.export(output_path, format="mp3")
+        result["duration"] = convert(sanitized_path, partials, timings, input_format, analysis)
+        if analysis is not None:
+            result["loudness"] = analysis
+            with _timed(timings, "tag"):
+                for partial in partials:
+                    if partial.get("replaygain") and partial["format"] == "mp3":
+                        loudness.write_id3_txxx(partial["path"], loudness.replaygain_tags(analysis))
+        for output, partial in zip(outputs, partials):
+            os.replace(partial["path"], output["path"])
     except Exception as e:
-        print(f"Error converting file {input_path}: {e}")
-
-def scan_and_convert(root_folder, output_folder):
-    supported_extensions = ['.flac', '.wav', '.ogg', '.m4a', '.aac', '.wma']
-    for foldername, subfolders, filenames in os.walk(root_folder):
-        for filename in filenames:
-            if filename.lower().endswith(tuple(supported_extensions)):
-                input_file_path = os.path.join(foldername, filename)
-                relative_path = os.path.relpath(input_file_path, root_folder)
+        result["status"] = "failed"
+        result["error"] = str(e)
+        result["exit_code"] = getattr(e, "exit_code", None)
+        for partial in partials:
+            if os.path.exists(partial["path"]):
+                os.remove(partial["path"])
+    return result
+
+
+def convert_audio_to_mp3(input_path, output_path, backend="pydub", timings=None, input_format=None,
+                         split_longer_than=None, replaygain=False):
+    # Single MP3 at the encoder's default quality; see convert_audio.
+    return convert_audio(input_path, [{"path": output_path, "format": "mp3", "bitrate": None,
+                                       "replaygain": replaygain}],
+                         backend, timings, input_format, split_longer_than)
+
+
+def iter_audio_files(root_folder, output_folder, threads=DISCOVERY_THREADS, poll_interval=None, errors=None):
+    # Yields (input_path, relative_path, mp3_path), mirroring the source layout under output_folder.
+    #
+    # Directories are listed concurrently by `threads` os.scandir workers, which
+    # pays off on network shares where every listing is a round trip, and files
+    # are streamed through a bounded queue as they are found, so the order is
+    # not deterministic. With poll_interval, None is yielded whenever nothing
+    # was found for that many seconds, letting the consumer get on with other
+    # work. A folder that cannot be listed is skipped; pass a list as errors to
+    # have {"folder" (relative to root_folder), "error"} appended for each.
+    found = queue.Queue(maxsize=DISCOVERY_QUEUE_SIZE)
+    folders = queue.Queue()
+    folders.put(root_folder)
+    stop = threading.Event()
+    lock = threading.Lock()
+    outstanding = [1]
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                found.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan_folder(folder):
+        try:
+            entries = list(os.scandir(folder))
+        except OSError as e:
+            if errors is not None:
+                errors.append({"folder": os.path.relpath(folder, root_folder), "error": str(e)})
+            return
+        batch = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_dir:
+                with lock:
+                    outstanding[0] += 1
+                folders.put(entry.path)
+            elif entry.name.lower().endswith(SUPPORTED_EXTENSIONS):
+                relative_path = os.path.relpath(entry.path, root_folder)
                 mp3_filename = os.path.splitext(relative_path)[0] + '.mp3'
-                mp3_path = os.path.join(output_folder, mp3_filename)
-                os.makedirs(os.path.dirname(mp3_path), exist_ok=True)
-                convert_audio_to_mp3(input_file_path, mp3_path)
+                batch.append((entry.path, relative_path, os.path.join(output_folder, mp3_filename)))
+        for item in batch:
+            if not put(item):
+                return
+
+    def scanner():
+        while not stop.is_set():
+            try:
+                folder = folders.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                scan_folder(folder)
+            finally:
+                with lock:
+                    outstanding[0] -= 1
+                    done = outstanding[0] == 0
+            if done:
+                put(finished)
+                return
+
+    for _ in range(max(1, threads)):
+        threading.Thread(target=scanner, daemon=True).start()
+    try:
+        while True:
+            try:
+                item = found.get(timeout=poll_interval)
+            except queue.Empty:
+                yield None
+                continue
+            if item is finished:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def _iter_sources(root_folder, output_folder, threads, sources=None, poll_interval=None, errors=None):
+    # iter_audio_files, or with `sources` (paths relative to root_folder) only
+    # those of them that still exist and have a supported extension.
+    if sources is None:
+        yield from iter_audio_files(root_folder, output_folder, threads, poll_interval, errors)
+        return
+    for relative_path in sources:
+        input_file_path = os.path.join(root_folder, relative_path)
+        if relative_path.lower().endswith(SUPPORTED_EXTENSIONS) and os.path.isfile(input_file_path):
+            mp3_filename = os.path.splitext(relative_path)[0] + '.mp3'
+            yield input_file_path, relative_path, os.path.join(output_folder, mp3_filename)
+
+
+def _run_job(job):
+    # Worker entry point: everything it needs travels in the picklable job dict.
+    timings = {} if job.get("instrument") else None
+    started = time.perf_counter()
+    result = _convert_job(job, timings)
+    if timings is not None:
+        if job.get("probe_seconds") is not None:
+            timings["probe"] = job["probe_seconds"]
+        timings["total"] = time.perf_counter() - started
+        result["timings"] = timings
+        result["input_size"] = job["size"]
+        if result["status"] == "converted":
+            result["output_size"] = sum(os.path.getsize(source) for source, _, _ in result["staged"]
+                                        if os.path.exists(source))
+    return result
+
+
+def _convert_job(job, timings):
+    # Encodes into each rendition's "staging" path (its final path if it has
+    # none) and never touches the target tree itself: the result's "staged"
+    # list of [source, destination, keep_source] says what the commit stage
+    # has to put where. The cache is best-effort: a cache that cannot be read
+    # or written costs a re-encode, never the file, and the error is reported
+    # as "cache_error".
+    digest = job.get("sha256")
+    if digest is None and (job["cache_dir"] or job["hash_source"]):
+        with _timed(timings, "hash"):
+            digest = file_digest(job["input"])
+
+    # Renditions the cache can satisfy are linked from it; the rest share one decode.
+    staged = []
+    cache = None
+    cache_error = None
+    pending = job["outputs"]
+    if job["cache_dir"]:
+        cache = EncodeCache(job["cache_dir"])
+        pending = []
+        for output in job["outputs"]:
+            with _timed(timings, "cache"):
+                try:
+                    hit = cache.lookup(cache_key(digest, output["settings"]))
+                except OSError as e:
+                    hit, cache_error = None, str(e)
+            if hit is None:
+                pending.append(output)
+            else:
+                staged.append([hit, output["path"], True])
+        if not pending:
+            return {"input": job["input"], "output": job["output"], "outputs": [o["path"] for o in job["outputs"]],
+                    "status": "converted", "error": None, "duration": None, "cached": True, "sha256": digest,
+                    "staged": staged}
+
+    encodes = [dict(output, path=output.get("staging") or output["path"]) for output in pending]
+    result = convert_audio(job["input"], encodes, job["backend"], timings, job.get("format"),
+                           job.get("split_longer_than"), job.get("split_segments"))
+    result["output"] = job["output"]
+    result["outputs"] = [output["path"] for output in job["outputs"]]
+    if result["status"] == "converted":
+        staged.extend([encode["path"], output["path"], False] for encode, output in zip(encodes, pending))
+        if cache is not None:
+            with _timed(timings, "cache"):
+                for encode, output in zip(encodes, pending):
+                    try:
+                        cache.store(cache_key(digest, output["settings"]), encode["path"])
+                    except OSError as e:
+                        cache_error = str(e)
+    else:
+        staged = []
+    result["staged"] = staged
+    if cache_error is not None:
+        result["cache_error"] = cache_error
+    if digest is not None:
+        result["sha256"] = digest
+    return result
+
+
+def default_scratch_dir():
+    # tmpfs when the system has one, so staged encodes never touch a disk.
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _ensure_folder(path, created_folders):
+    # Creates path's parent folder unless this run already did.
+    folder = os.path.dirname(path)
+    if folder not in created_folders:
+        os.makedirs(folder, exist_ok=True)
+        created_folders.add(folder)
+
+
+def _commit_file(source, destination, keep_source, created_folders):
+    # Puts one staged file at destination atomically: a rename when source and
+    # target share a filesystem, else a copy to a temporary name in the target
+    # folder followed by a rename. keep_source leaves source in place (cache
+    # entries), linking instead of moving.
+    _ensure_folder(destination, created_folders)
+    if keep_source:
+        link_or_copy(source, destination)
+        return
+    try:
+        os.replace(source, destination)
+    except OSError:
+        # Typically EXDEV: scratch is on another filesystem.
+        link_or_copy(source, destination)
+        os.remove(source)
+
+
+def _commit_staged(job, result, created_folders):
+    # Commits the result's staged files (see _convert_job) and returns the
+    # result. A cache entry evicted since the worker looked it up (by another
+    # run sharing the cache) is encoded again from the source, straight into
+    # place, and stored back.
+    missing = []
+    for source, destination, keep_source in result.pop("staged", []):
+        try:
+            _commit_file(source, destination, keep_source, created_folders)
+        except FileNotFoundError:
+            if not keep_source:
+                raise
+            missing.append(destination)
+    if not missing:
+        return result
+    outputs = [output for output in job["outputs"] if output["path"] in missing]
+    encoded = convert_audio(job["input"], outputs, job["backend"], None, job.get("format"),
+                            job.get("split_longer_than"), job.get("split_segments"))
+    if encoded["status"] != "converted":
+        return _failed_result(job, encoded["error"])
+    cache = EncodeCache(job["cache_dir"])
+    for output in outputs:
+        try:
+            cache.store(cache_key(result["sha256"], output["settings"]), output["path"])
+        except OSError as e:
+            result["cache_error"] = str(e)
+    result["cached"] = False
+    if result.get("duration") is None:
+        result["duration"] = encoded["duration"]
+    for key in ("loudness", "backend"):
+        if key in encoded:
+            result.setdefault(key, encoded[key])
+    return result
+
+
+def _failed_result(job, error, status="failed"):
+    return {"input": job["input"], "output": job["output"], "status": status, "error": str(error)}
+
+
+def _init_worker(priority=None):
+    # Each worker leads its own process group, so cancelling can signal it
+    # together with any ffmpeg it has spawned. priority (see
+    # throttle.apply_priority) lowers the worker and its encoders.
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+    apply_priority(priority)
+
+
+def _terminate_workers(executor):
+    # ProcessPoolExecutor has no public way to stop running tasks, so signal the
+    # worker processes (and their encoder children) directly. SIGKILL rather than
+    # SIGTERM: ffmpeg treats a single SIGTERM as "finish gracefully" and may keep
+    # encoding; the caller deletes the partial outputs anyway.
+    for process in list(getattr(executor, "_processes", {}).values()):
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.terminate()
+        except (ProcessLookupError, PermissionError):
+            pass
+    executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _execute(tasks, jobs, cancel_event=None, commit=None, commit_threads=COMMIT_THREADS, throttle=None,
+             priority=None):
+    # Yields ("started", job, None) and ("finished", job, result) events. At most
+    # `jobs` conversions are in flight, so "started" means the job really started.
+    # tasks is a list or a lazy iterator; an iterator may yield None to mean
+    # "nothing ready yet". Setting cancel_event stops scheduling, terminates
+    # in-flight encodes and finishes the remaining jobs with a "cancelled" result.
+    # commit(job, result), if given, runs on a separate pool of commit_threads
+    # threads once a job is encoded and returns the (job, result) pairs to report,
+    # so encoders never wait on the target storage. Scheduling pauses while
+    # COMMIT_BACKLOG_PER_WORKER * jobs encodes are waiting for their commit.
+    # throttle (a throttle.Throttle) lowers the number of conversions started
+    # below `jobs` while the host is busy; priority is applied to the workers.
+    # A worker process that dies (OOM kill, crash in a decoder) breaks the whole
+    # pool: it is replaced, and the jobs that were in flight are run again one
+    # at a time, so only the job that kills its worker again fails.
+    is_list = isinstance(tasks, list)
+    if is_list and not tasks:
+        return
+    committer = ThreadPoolExecutor(max_workers=max(1, commit_threads)) if commit is not None else None
+    committing = {}
+    backlog_limit = COMMIT_BACKLOG_PER_WORKER * max(1, jobs)
+
+    def encoded(job, result):
+        # Hands a finished encode to the commit stage, or reports it directly.
+        if committer is None:
+            return [(job, result)]
+        committing[committer.submit(commit, job, result)] = job
+        return []
+
+    def committed(futures):
+        pairs = []
+        for future in futures:
+            job = committing.pop(future)
+            try:
+                pairs.extend(future.result())
+            except Exception as e:
+                pairs.append((job, _failed_result(job, e)))
+        return pairs
+
+    if cancel_event is None and not priority and (jobs <= 1 or (is_list and len(tasks) <= 1)):
+        try:
+            for job in tasks:
+                if job is None:
+                    continue
+                if len(committing) >= backlog_limit:
+                    wait(committing, return_when=FIRST_COMPLETED)
+                for finished_job, result in committed([future for future in committing if future.done()]):
+                    yield "finished", finished_job, result
+                yield "started", job, None
+                try:
+                    result = _run_job(job)
+                except Exception as e:
+                    result = _failed_result(job, e)
+                for finished_job, finished_result in encoded(job, result):
+                    yield "finished", finished_job, finished_result
+            while committing:
+                done, _ = wait(committing, return_when=FIRST_COMPLETED)
+                for finished_job, result in committed(done):
+                    yield "finished", finished_job, result
+        finally:
+            if committer is not None:
+                committer.shutdown()
+        return
+
+    # Cancellable runs always use worker processes, even for jobs=1, because an
+    # in-process encode cannot be interrupted; so do prioritised runs, which must
+    # not lower the caller's own process.
+    workers = max(1, min(jobs, len(tasks)) if is_list else jobs)
+
+    def new_executor():
+        return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(priority,))
+
+    executor = new_executor()
+    source = iter(tasks)
+    exhausted = False
+    in_flight = {}
+    # Jobs that were in flight when a worker died, waiting to be run again alone.
+    suspects = deque()
+    try:
+        while not exhausted or in_flight or committing or suspects:
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            limit = throttle.limit() if throttle is not None else jobs
+            broken = False
+            if suspects:
+                if not in_flight:
+                    job = suspects.popleft()
+                    try:
+                        in_flight[executor.submit(_run_job, job)] = job
+                    except BrokenProcessPool:
+                        suspects.appendleft(job)
+                        broken = True
+            while not suspects and not exhausted and len(in_flight) < limit and len(committing) < backlog_limit:
+                job = next(source, StopIteration)
+                if job is StopIteration:
+                    exhausted = True
+                elif job is None:
+                    break
+                else:
+                    yield "started", job, None
+                    try:
+                        in_flight[executor.submit(_run_job, job)] = job
+                    except BrokenProcessPool:
+                        # The pool broke since the last wait; run this one after the rebuild.
+                        suspects.append(job)
+                        broken = True
+                        break
+            if not in_flight and not committing and not broken:
+                continue
+            done, _ = wait(list(in_flight) + list(committing), timeout=0.2, return_when=FIRST_COMPLETED)
+            lost = []
+            for future in done:
+                if future not in in_flight:
+                    for finished_job, result in committed([future]):
+                        yield "finished", finished_job, result
+                    continue
+                job = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    lost.append(job)
+                    continue
+                except Exception as e:
+                    result = _failed_result(job, e)
+                for finished_job, finished_result in encoded(job, result):
+                    yield "finished", finished_job, finished_result
+            if not lost and not broken:
+                continue
+            # A dead worker fails every future of its pool. Collect what the other
+            # workers managed to finish, then start over with a fresh pool.
+            wait(list(in_flight))
+            for future, job in list(in_flight.items()):
+                del in_flight[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    lost.append(job)
+                    continue
+                except Exception as e:
+                    result = _failed_result(job, e)
+                for finished_job, finished_result in encoded(job, result):
+                    yield "finished", finished_job, finished_result
+            _terminate_workers(executor)
+            executor = new_executor()
+            if len(lost) == 1:
+                # It was running alone, so it is the one that killed its worker.
+                for finished_job, finished_result in encoded(lost[0], _failed_result(
+                        lost[0], "The worker process converting this file died")):
+                    yield "finished", finished_job, finished_result
+            else:
+                suspects.extendleft(reversed(lost))
+    finally:
+        # In-flight encodes only ever wrote to scratch or temporary names, so
+        # killing them leaves nothing half-written in the target tree.
+        if in_flight:
+            _terminate_workers(executor)
+        else:
+            executor.shutdown()
+        if committer is not None:
+            # Started commits are allowed to finish; each one is atomic.
+            committer.shutdown(wait=True)
+        if not exhausted and hasattr(source, "close"):
+            # Stops a streaming discovery instead of scanning the rest of the tree.
+            source.close()
+
+    for finished_job, result in committed(list(committing)):
+        yield "finished", finished_job, result
+    remaining = list(in_flight.values()) + list(suspects)
+    if is_list:
+        remaining.extend(source)
+    for job in remaining:
+        yield "finished", job, _failed_result(job, "Cancelled", status="cancelled")
+
+
+def _split_duplicates(tasks):
+    # Hashes only sources that share a size with another source, so byte-identical
+    # files in one run are encoded once. Returns the tasks to encode and a map
+    # from each encoded output path to the duplicate jobs it will satisfy. Jobs
+    # only pair up when they need the same renditions.
+    sizes = defaultdict(int)
+    for job in tasks:
+        sizes[job["size"]] += 1
+
+    unique_tasks = []
+    duplicates = defaultdict(list)
+    primary_by_digest = {}
+    for job in tasks:
+        if sizes[job["size"]] > 1:
+            try:
+                job["sha256"] = file_digest(job["input"])
+            except OSError:
+                unique_tasks.append(job)
+                continue
+            renditions = tuple(output["profile"] for output in job["outputs"])
+            primary = primary_by_digest.setdefault((job["sha256"], renditions), job)
+            if primary is not job:
+                duplicates[primary["output"]].append(job)
+                continue
+        unique_tasks.append(job)
+    return unique_tasks, duplicates
+
+
+def _satisfy_duplicates(job, result, duplicate_jobs):
+    # Derives results for duplicates of job from its finished conversion.
+    for duplicate in duplicate_jobs:
+        if result["status"] != "converted":
+            yield duplicate, _failed_result(duplicate, result["error"], status=result["status"])
+            continue
+        try:
+            for output, duplicate_output in zip(job["outputs"], duplicate["outputs"]):
+                link_or_copy(output["path"], duplicate_output["path"])
+        except OSError as e:
+            yield duplicate, _failed_result(duplicate, e)
+            continue
+        yield duplicate, {"input": duplicate["input"], "output": duplicate["output"],
+                          "outputs": [output["path"] for output in duplicate["outputs"]], "status": "converted",
+                          "error": None, "duration": result.get("duration"), "cached": True,
+                          "sha256": duplicate["sha256"], "loudness": result.get("loudness")}
+
+
+def _remove_empty_folders(folder, output_folder):
+    while (os.path.normpath(folder) != os.path.normpath(output_folder) and os.path.isdir(folder)
+           and not os.listdir(folder)):
+        os.rmdir(folder)
+        folder = os.path.dirname(folder)
+
+
+def _remove_output(manifest, root_folder, output_folder, relative_source):
+    # Deletes one converted source's output, plus any directories left empty.
+    output_path = os.path.join(output_folder, manifest.entries[relative_source]["output"])
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    manifest.remove(relative_source)
+    _remove_empty_folders(os.path.dirname(output_path), output_folder)
+    return {"input": os.path.join(root_folder, relative_source), "output": output_path, "status": "pruned",
+            "error": None}
+
+
+def _prune_outputs(manifest, root_folder, output_folder, seen_sources, unlisted=()):
+    # Deletes outputs whose source no longer exists, plus any directories left
+    # empty. Sources under an unlisted folder (one the scan could not read, see
+    # iter_audio_files) were not seen but may well exist, so they are kept.
+    if os.curdir in unlisted:
+        return []
+
+    def gone(relative_source):
+        return relative_source not in seen_sources and not any(_under(relative_source, folder)
+                                                                for folder in unlisted)
+    results = []
+    for relative_source in [source for source in manifest.entries if gone(source)]:
+        results.append(_remove_output(manifest, root_folder, output_folder, relative_source))
+    for relative_source in [source for source in manifest.rejected if gone(source)]:
+        manifest.remove(relative_source)
+    return results
+
+
+def _under(relative_source, relative_path):
+    # Whether relative_source is relative_path itself or lies in that folder.
+    return relative_source == relative_path or relative_source.startswith(relative_path.rstrip(os.sep) + os.sep)
+
+
+def mirror_removals(root_folder, output_folder, relative_paths, profiles=None):
+    # Deletes the outputs of removed sources from every profile's output folder
+    # and forgets them in the manifests. relative_paths are relative to
+    # root_folder and may name folders, covering every source below them.
+    # Returns one "pruned" result per deleted output.
+    results = []
+    for manifest in _open_manifests(_normalize_profiles(profiles, output_folder)).values():
+        for relative_path in relative_paths:
+            for relative_source in [source for source in manifest.entries if _under(source, relative_path)]:
+                results.append(_remove_output(manifest, root_folder, manifest.output_folder, relative_source))
+            for relative_source in [source for source in manifest.rejected if _under(source, relative_path)]:
+                manifest.remove(relative_source)
+        manifest.compact()
+    return results
+
+
+def mirror_moves(root_folder, output_folder, moves, profiles=None):
+    # Renames outputs after their sources were renamed, so nothing is re-encoded.
+    # moves is a list of (old, new) paths relative to root_folder, files or
+    # folders. A source renamed to an unsupported extension loses its output.
+    # Returns one "moved" (with "previous", the old output) or "pruned" result
+    # per affected output.
+    results = []
+    for profile in _normalize_profiles(profiles, output_folder):
+        manifest = _open_manifests([profile])[profile["name"]]
+        extension = OUTPUT_FORMATS[profile["format"]][2]
+        for old_path, new_path in moves:
+            for relative_source in [source for source in manifest.entries if _under(source, old_path)]:
+                new_source = new_path + relative_source[len(old_path):]
+                if not new_source.lower().endswith(SUPPORTED_EXTENSIONS):
+                    results.append(_remove_output(manifest, root_folder, manifest.output_folder, relative_source))
+                    continue
+                old_output = os.path.join(manifest.output_folder, manifest.entries[relative_source]["output"])
+                new_output = os.path.join(manifest.output_folder, os.path.splitext(new_source)[0] + extension)
+                if not os.path.exists(old_output):
+                    manifest.remove(relative_source)
+                    continue
+                os.makedirs(os.path.dirname(new_output), exist_ok=True)
+                os.replace(old_output, new_output)
+                manifest.rename(relative_source, new_source, os.path.relpath(new_output, manifest.output_folder))
+                _remove_empty_folders(os.path.dirname(old_output), manifest.output_folder)
+                results.append({"input": os.path.join(root_folder, new_source), "output": new_output,
+                                "previous": old_output, "status": "moved", "error": None})
+            for relative_source in [source for source in manifest.rejected if _under(source, old_path)]:
+                manifest.remove(relative_source)
+        manifest.compact()
+    return results
+
+
+def _record_outputs(manifests, job, result):
+    # Manifest records for every rendition of a converted job.
+    for output in job["outputs"]:
+        manifest = manifests[output["profile"]]
+        manifest.record(job["relative"], os.path.relpath(output["path"], manifest.output_folder),
+                        job["size"], job["mtime_ns"], output["settings"], result.get("sha256"))
+
+
+def record_results(output_folder, finished, profiles=None):
+    # Writes the manifest records for (job, result) pairs converted outside
+    # iter_conversion (see work_queue), so the next incremental run skips them.
+    manifests = _open_manifests(_normalize_profiles(profiles, output_folder))
+    for job, result in finished:
+        if result["status"] == "converted":
+            _record_outputs(manifests, job, result)
+    for manifest in manifests.values():
+        manifest.compact()
+
+
+def convert_planned_job(job, scratch_folder, created_folders=None):
+    # Converts one job from plan_conversion on its own, as a work_queue worker
+    # does: encodes into scratch_folder, then commits the renditions into the
+    # target tree. Returns the result dict; manifests are left to the caller.
+    job = dict(job, outputs=[dict(output, staging=os.path.join(scratch_folder, uuid.uuid4().hex
+                                                                + OUTPUT_FORMATS[output["format"]][2]))
+                             for output in job["outputs"]])
+    result = _run_job(job)
+    try:
+        result = _commit_staged(job, result, set() if created_folders is None else created_folders)
+    except OSError as e:
+        result = _failed_result(job, e)
+    finally:
+        for output in job["outputs"]:
+            if os.path.exists(output["staging"]):
+                os.remove(output["staging"])
+    return result
+
+
+def _estimate_makespan(durations, workers):
+    # Wall time of a longest-first greedy schedule of durations over `workers` slots.
+    loads = [0.0] * max(1, workers)
+    for duration in sorted(durations, reverse=True):
+        heapq.heappush(loads, heapq.heappop(loads) + duration / ENCODE_SPEED)
+    return max(loads)
+
+
+def _normalize_profiles(profiles, output_folder, replaygain=False):
+    # Fills in profile defaults: format "mp3", the encoder's default bitrate,
+    # output_folder as the output root and replaygain as whether to measure
+    # loudness. Raises ValueError for unknown formats, for profiles that would
+    # write the same files, and for ReplayGain without NumPy.
+    normalized = []
+    for profile in profiles or [{}]:
+        output_format = profile.get("format", "mp3")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {output_format!r}, expected one of {sorted(OUTPUT_FORMATS)}")
+        bitrate = profile.get("bitrate")
+        folder = profile.get("output_folder") or output_folder
+        if not folder:
+            raise ValueError("Every profile needs an output_folder when no default output folder is given")
+        normalized.append({
+            "name": profile.get("name") or (f"{output_format}-{bitrate}" if bitrate else output_format),
+            "format": output_format,
+            "bitrate": bitrate,
+            "output_folder": folder,
+            "replaygain": bool(profile.get("replaygain", replaygain)),
+        })
+    if any(profile["replaygain"] for profile in normalized) and not loudness.AVAILABLE:
+        raise ValueError("ReplayGain analysis needs NumPy")
+    names = [profile["name"] for profile in normalized]
+    targets = [(os.path.normpath(profile["output_folder"]), OUTPUT_FORMATS[profile["format"]][2])
+               for profile in normalized]
+    if len(set(names)) != len(names) or len(set(targets)) != len(targets):
+        raise ValueError("Output profiles must have distinct names and must not write the same files")
+    return normalized
+
+
+def _profile_settings(profile, backend):
+    # Encode settings a manifest entry and cache key depend on. A default MP3
+    # profile keeps the settings of a single-output run, so its manifest and
+    # cache entries stay valid.
+    settings = {"backend": backend, "format": profile["format"]}
+    if profile["bitrate"]:
+        settings["bitrate"] = profile["bitrate"]
+    if profile.get("replaygain"):
+        settings["replaygain"] = True
+    return settings
+
+
+def _open_manifests(profiles):
+    # One manifest per profile. Profiles sharing an output folder write different
+    # extensions, so MP3 keeps the plain manifest name and other formats get
+    # their own file beside it.
+    manifests = {}
+    for profile in profiles:
+        filename = MANIFEST_FILENAME
+        if profile["format"] != "mp3":
+            stem, extension = os.path.splitext(MANIFEST_FILENAME)
+            filename = f"{stem}.{profile['format']}{extension}"
+        manifests[profile["name"]] = Manifest(profile["output_folder"], filename)
+    return manifests
+
+
+def _rendition(profile, relative_path, backend):
+    extension = OUTPUT_FORMATS[profile["format"]][2]
+    return {
+        "profile": profile["name"],
+        "path": os.path.join(profile["output_folder"], os.path.splitext(relative_path)[0] + extension),
+        "format": profile["format"],
+        "bitrate": profile["bitrate"],
+        "replaygain": profile.get("replaygain", False),
+        "settings": _profile_settings(profile, backend),
+    }
+
+
+def _make_job(input_file_path, relative_path, outputs, backend, hash_source, cache_dir, verdict):
+    stat = os.stat(input_file_path)
+    duration = verdict["duration"]
+    return {
+        "input": input_file_path,
+        "output": outputs[0]["path"],
+        "outputs": outputs,
+        "relative": relative_path,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "format": verdict["format"],
+        "duration": duration,
+        "estimated_duration": duration if duration is not None else stat.st_size / FALLBACK_BYTES_PER_SECOND,
+        "backend": backend,
+        "hash_source": hash_source,
+        "cache_dir": cache_dir,
+    }
+
+
+def _skipped_result(input_file_path, mp3_path):
+    return {"input": input_file_path, "output": mp3_path, "status": "skipped", "error": None}
+
+
+def _rejected_result(input_file_path, mp3_path, reason):
+    return {"input": input_file_path, "output": mp3_path, "status": "rejected", "error": reason}
+
+
+def _unreadable_result(input_file_path, relative_path, profiles, backend, error):
+    # A listed source that could not be statted or opened: gone since the
+    # listing, a dangling symlink, no permission.
+    return {"input": input_file_path, "output": _rendition(profiles[0], relative_path, backend)["path"],
+            "status": "failed", "error": str(error)}
+
+
+def _sniff(input_file_path, relative_path, manifest):
+    # Header verdict for a source (see probe.sniff_file). With a manifest, a
+    # rejection is remembered against the source's size and mtime, so an
+    # unchanged bad file is rejected again without being reopened.
+    if manifest is not None:
+        reason = manifest.cached_rejection(relative_path, input_file_path)
+        if reason is not None:
+            return {"container": None, "format": None, "valid": False, "reason": reason, "duration": None,
+                    "sample_rate": None}
+    verdict = sniff_file(input_file_path)
+    if not verdict["valid"] and manifest is not None:
+        manifest.record_rejection(relative_path, input_file_path, verdict["reason"])
+    return verdict
+
+
+def _classify(input_file_path, relative_path, profiles, manifests, backend, hash_sources, cache_dir):
+    # Decides what to do with one discovered source: returns ("skipped", result),
+    # ("rejected", result) or ("job", job). In incremental runs the job only
+    # carries the renditions whose manifest says they are out of date.
+    outputs = [_rendition(profile, relative_path, backend) for profile in profiles]
+    primary_output = outputs[0]["path"]
+    if manifests is not None:
+        outputs = [output for output in outputs
+                   if not manifests[output["profile"]].is_up_to_date(relative_path, input_file_path,
+                                                                     output["settings"], hash_sources)]
+        if not outputs:
+            return "skipped", _skipped_result(input_file_path, primary_output)
+    probe_started = time.perf_counter()
+    # Rejections are remembered in the first profile's manifest.
+    verdict = _sniff(input_file_path, relative_path, manifests[profiles[0]["name"]] if manifests is not None else None)
+    if not verdict["valid"]:
+        return "rejected", _rejected_result(input_file_path, primary_output, verdict["reason"])
+    job = _make_job(input_file_path, relative_path, outputs, backend, manifests is not None and hash_sources,
+                    cache_dir, verdict)
+    job["probe_seconds"] = time.perf_counter() - probe_started
+    return "job", job
+
+
+def plan_conversion(root_folder, output_folder, jobs=None, backend="pydub",
+                    incremental=False, hash_sources=False, cache_dir=None,
+                    discovery_threads=DISCOVERY_THREADS, profiles=None, sources=None, replaygain=False):
+    # Enumerates everything a run would do without converting anything. Options
+    # mean the same as for iter_conversion. Returns a plan dict whose "tasks" are
+    # ordered longest first, so the biggest files start early and do not leave
+    # one worker busy long after the others have finished. Every source's header
+    # is sniffed first; files that are not valid audio end up in "rejected"
+    # instead of costing an encoder process. Sources that could not be read at
+    # all are in "failed", and folders that could not be listed in
+    # "scan_errors" (see iter_audio_files).
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {sorted(BACKENDS)}")
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs < 1:
+        raise ValueError(f"jobs must be at least 1, got {jobs}")
+
+    profiles = _normalize_profiles(profiles, output_folder, replaygain)
+    manifests = _open_manifests(profiles) if incremental else None
+
+    tasks = []
+    skipped = []
+    rejected = []
+    failed = []
+    seen_sources = set()
+    scan_errors = []
+    for input_file_path, relative_path, _ in _iter_sources(root_folder, profiles[0]["output_folder"],
+                                                           discovery_threads, sources, errors=scan_errors):
+        seen_sources.add(relative_path)
+        try:
+            kind, item = _classify(input_file_path, relative_path, profiles, manifests, backend, hash_sources,
+                                   cache_dir)
+        except OSError as e:
+            failed.append(_unreadable_result(input_file_path, relative_path, profiles, backend, e))
+            continue
+        if kind == "skipped":
+            skipped.append(item)
+        elif kind == "rejected":
+            rejected.append(item)
+        else:
+            tasks.append(item)
+
+    tasks.sort(key=lambda job: (job["estimated_duration"], job["size"], job["relative"]), reverse=True)
+    durations = [job["estimated_duration"] for job in tasks]
+    return {
+        "root_folder": root_folder,
+        "output_folder": profiles[0]["output_folder"],
+        "workers": jobs,
+        "profiles": profiles,
+        "manifests": manifests,
+        "tasks": tasks,
+        "skipped": skipped,
+        "rejected": rejected,
+        "failed": failed,
+        "seen_sources": seen_sources,
+        "scan_errors": scan_errors,
+        "files": len(tasks),
+        "bytes": sum(job["size"] for job in tasks),
+        "audio_seconds": sum(durations),
+        "files_with_estimated_duration": sum(1 for job in tasks if job["duration"] is None),
+        # Each rendition costs roughly one encode of the whole track.
+        "estimated_seconds": _estimate_makespan([job["estimated_duration"] * len(job["outputs"]) for job in tasks],
+                                                jobs) if tasks else 0.0,
+    }
+
+
+def _format_seconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def format_plan(plan, largest=5):
+    # Human-readable dry-run report for a plan from plan_conversion.
+    lines = [
+        f"Files to convert: {plan['files']} ({len(plan['skipped'])} up to date,"
+        f" {len(plan['rejected'])} rejected)",
+        f"Total size: {plan['bytes'] / (1024 * 1024):.1f} MB",
+        f"Audio duration: {_format_seconds(plan['audio_seconds'])}"
+        f" ({plan['files_with_estimated_duration']} file(s) estimated from size)",
+        f"Workers: {plan['workers']}",
+        f"Estimated wall time: {_format_seconds(plan['estimated_seconds'])}",
+    ]
+    if len(plan["profiles"]) > 1:
+        lines.append("Outputs (one decode per file):")
+        for profile in plan["profiles"]:
+            quality = f" {profile['bitrate']}" if profile["bitrate"] else ""
+            lines.append(f"  {profile['name']}: {profile['format']}{quality} -> {profile['output_folder']}")
+    if plan["tasks"]:
+        lines.append("Largest jobs:")
+        for job in plan["tasks"][:largest]:
+            lines.append(f"  {_format_seconds(job['estimated_duration'])}  {job['relative']}")
+    if plan["rejected"]:
+        lines.append("Rejected:")
+        for result in plan["rejected"]:
+            lines.append(f"  {os.path.relpath(result['input'], plan['root_folder'])}: {result['error']}")
+    if plan["failed"]:
+        lines.append("Unreadable:")
+        for result in plan["failed"]:
+            lines.append(f"  {os.path.relpath(result['input'], plan['root_folder'])}: {result['error']}")
+    return "\n".join(lines)
+
+
+def iter_conversion(root_folder, output_folder, jobs=None, backend="pydub",
+                    incremental=False, prune=False, hash_sources=False,
+                    cache_dir=None, cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+                    cancel_event=None, schedule="longest-first",
+                    discovery_threads=DISCOVERY_THREADS, report_path=None, profiles=None,
+                    scratch_dir=None, commit_threads=COMMIT_THREADS, split_longer_than=None, sources=None,
+                    throttle=None, priority=None, replaygain=False):
+    # Converts root_folder into output_folder, yielding progress events.
+    #
+    # jobs: number of worker processes, defaults to the CPU count. jobs=1 converts
+    # in-process. backend: a key of BACKENDS.
+    # incremental: keep a manifest in output_folder and skip sources whose size,
+    # mtime and encode settings are unchanged since they were last converted.
+    # hash_sources also records a SHA-256 of each source, so a touched but
+    # identical file is still skipped. prune deletes outputs of vanished sources.
+    # cache_dir: content-addressed cache of encoded files keyed by source digest
+    # and settings. Identical sources, in this run or any earlier run sharing the
+    # cache, are hardlinked (or copied) instead of re-encoded; the cache is trimmed
+    # to cache_max_bytes, least recently used first.
+    # cancel_event: a threading.Event; once set, nothing new is scheduled and
+    # in-flight encodes are terminated.
+    # schedule: "longest-first" plans the whole run first (see plan_conversion);
+    # "streaming" starts encoding files as soon as the scanner finds them, which
+    # suits slow network shares where the walk itself takes minutes. Streaming
+    # runs only dedupe within the run through the cache, and their totals grow
+    # as discovery proceeds.
+    # discovery_threads: concurrent directory scanners (see iter_audio_files).
+    # report_path: write a JSON-lines run report there (see run_report.RunReport)
+    # with per-file stage timings, sizes, duration and errors, followed by a
+    # summary; the summary is also yielded as a final "report" event.
+    # profiles: list of output profile dicts, each with "format" (a key of
+    # OUTPUT_FORMATS, default "mp3"), "bitrate" (e.g. "320k", default the encoder's),
+    # "output_folder" (default output_folder) and "name". Each source is decoded
+    # once and encoded to every profile; manifests, the cache and pruning work
+    # per profile. Events and results name the first profile's file as "output"
+    # and all of them as "outputs".
+    # scratch_dir: where workers encode (default: /dev/shm when present, else the
+    # temp dir). commit_threads threads then move each finished file into the
+    # target tree atomically, so encoders never wait on slow target storage and
+    # a crash never leaves a partial file under a real output name.
+    # split_longer_than: seconds; with the ffmpeg backend and only MP3 profiles,
+    # longer tracks are encoded as parallel segments and joined gaplessly, so one
+    # long recording does not keep a single core busy after the rest is done.
+    # Each track gets the run's share of the cores (cpu_count // jobs, at least 2).
+    # sources: paths relative to root_folder to consider instead of scanning the
+    # whole tree (see watch.py); cannot be combined with prune.
+    # throttle: True, or a dict of throttle.Throttle options (min_jobs, max_load,
+    # min_free_memory, max_io_pressure, interval), to run between min_jobs and
+    # `jobs` conversions at once depending on host load, memory and I/O pressure.
+    # priority: dict with "nice" (increment), "ionice" ("idle", "best-effort:N")
+    # and "cpus" (CPU ids) applied to the worker processes and their encoders.
+    # replaygain: measure integrated loudness and peak while converting (see
+    # loudness), report them as each result's "loudness" and tag MP3 outputs
+    # with REPLAYGAIN_TRACK_GAIN/PEAK; a profile's own "replaygain" wins.
+    #
+    # Every event is a dict with a "type" and a "stats" snapshot (files, bytes and
+    # audio seconds done/total, elapsed seconds, whether discovery is still
+    # running). Types: "planned" (plan totals, longest-first only), "discovered"
+    # (a file to convert, with its size), "started", and the per-file outcomes
+    # "skipped", "rejected" (not valid audio, never handed to an encoder),
+    # "finished", "failed", "cancelled" and "pruned", which carry a "result".
+    # "unreadable" names a "folder" the scan could not list and the "error";
+    # pruning leaves everything under it alone.
+    # Throttled runs add "concurrency" (the current limit) to stats and yield a
+    # "throttled" event with the "decision" whenever the limit changes.
+    if schedule not in ("longest-first", "streaming"):
+        raise ValueError(f"Unknown schedule {schedule!r}, expected 'longest-first' or 'streaming'")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {sorted(BACKENDS)}")
+    if prune and sources is not None:
+        raise ValueError("prune needs the whole tree and cannot be combined with sources")
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs < 1:
+        raise ValueError(f"jobs must be at least 1, got {jobs}")
+    check_priority(priority)
+    if throttle:
+        throttle = Throttle(jobs, **(throttle if isinstance(throttle, dict) else {}))
+
+    started_at = time.monotonic()
+    stats = {"files_total": 0, "files_done": 0, "files_failed": 0, "files_rejected": 0,
+             "bytes_total": 0, "bytes_done": 0, "audio_seconds_done": 0.0, "discovering": True}
+    if throttle:
+        stats["concurrency"] = throttle.current
+    # Events produced while the streaming scanner runs inside _execute, flushed
+    # between execution events.
+    backlog = deque()
+    report = RunReport(report_path) if report_path else None
+    scratch = tempfile.mkdtemp(prefix="flacconvert-", dir=scratch_dir or default_scratch_dir())
+
+    def event(event_type, **fields):
+        if report is not None and "result" in fields:
+            report.add(fields["result"])
+        fields["type"] = event_type
+        fields["stats"] = dict(stats, elapsed=time.monotonic() - started_at)
+        return fields
+
+    def rejected(result):
+        stats["files_rejected"] += 1
+        return event("rejected", result=result)
+
+    def discovered(job):
+        job["instrument"] = report is not None
+        job["split_longer_than"] = split_longer_than
+        job["split_segments"] = max(2, (os.cpu_count() or 1) // jobs)
+        for output in job["outputs"]:
+            output["staging"] = os.path.join(scratch, uuid.uuid4().hex + OUTPUT_FORMATS[output["format"]][2])
+        stats["files_total"] += 1
+        stats["bytes_total"] += job["size"]
+        return event("discovered", input=job["input"], output=job["output"], size=job["size"])
+
+    try:
+        duplicates = {}
+        if schedule == "longest-first":
+            plan = plan_conversion(root_folder, output_folder, jobs, backend, incremental, hash_sources, cache_dir,
+                                   discovery_threads, profiles, sources, replaygain)
+            profiles = plan["profiles"]
+            manifests = plan["manifests"]
+            seen_sources = plan["seen_sources"]
+            scan_errors = plan["scan_errors"]
+            tasks = plan["tasks"]
+            stats["discovering"] = False
+            yield event("planned", files=plan["files"], bytes=plan["bytes"], audio_seconds=plan["audio_seconds"],
+                        estimated_seconds=plan["estimated_seconds"])
+            for result in plan["skipped"]:
+                yield event("skipped", result=result)
+            for result in plan["rejected"]:
+                yield rejected(result)
+            for result in plan["failed"]:
+                stats["files_failed"] += 1
+                yield event("failed", result=result)
+            for job in tasks:
+                yield discovered(job)
+            if cache_dir is not None:
+                tasks, duplicates = _split_duplicates(tasks)
+        else:
+            profiles = _normalize_profiles(profiles, output_folder, replaygain)
+            manifests = _open_manifests(profiles) if incremental else None
+            seen_sources = set()
+            scan_errors = []
+
+            def stream_tasks():
+                for item in _iter_sources(root_folder, profiles[0]["output_folder"], discovery_threads, sources,
+                                          poll_interval=0.05, errors=scan_errors):
+                    if item is None:
+                        yield None
+                        continue
+                    input_file_path, relative_path, _ = item
+                    seen_sources.add(relative_path)
+                    try:
+                        kind, outcome = _classify(input_file_path, relative_path, profiles, manifests, backend,
+                                                  hash_sources, cache_dir)
+                    except OSError as e:
+                        stats["files_failed"] += 1
+                        backlog.append(event("failed", result=_unreadable_result(
+                            input_file_path, relative_path, profiles, backend, e)))
+                        continue
+                    if kind == "skipped":
+                        backlog.append(event("skipped", result=outcome))
+                        continue
+                    if kind == "rejected":
+                        backlog.append(rejected(outcome))
+                        continue
+                    backlog.append(discovered(outcome))
+                    yield outcome
+                stats["discovering"] = False
+
+            tasks = stream_tasks()
+
+        # One makedirs per target directory rather than per file, done by the commit stage.
+        created_folders = set()
+
+        def commit(job, result):
+            # Runs on a commit thread: moves the job's staged files into the target
+            # tree, then links any duplicates from there.
+            started = time.perf_counter()
+            duplicate_jobs = duplicates.get(job["output"], [])
+            try:
+                result = _commit_staged(job, result, created_folders)
+                if result["status"] == "converted":
+                    for duplicate in duplicate_jobs:
+                        for output in duplicate["outputs"]:
+                            _ensure_folder(output["path"], created_folders)
+            except OSError as e:
+                result = _failed_result(job, e)
+            if result.get("timings") is not None:
+                result["timings"]["commit"] = time.perf_counter() - started
+            return [(job, result)] + list(_satisfy_duplicates(job, result, duplicate_jobs))
+
+        cancelled = False
+        decisions_reported = 0
+        for state, job, result in _execute(tasks, jobs, cancel_event, commit, commit_threads, throttle or None,
+                                           priority):
+            while backlog:
+                yield backlog.popleft()
+            if throttle:
+                stats["concurrency"] = throttle.current
+                for decision in throttle.decisions[decisions_reported:]:
+                    yield event("throttled", decision=decision)
+                decisions_reported = len(throttle.decisions)
+            if state == "started":
+                yield event("started", input=job["input"], output=job["output"], size=job["size"])
+                continue
+            finished = [(job, result)]
+            if result["status"] == "cancelled":
+                # Never reached the commit stage, which reports duplicates otherwise.
+                finished.extend(_satisfy_duplicates(job, result, duplicates.get(job["output"], [])))
+            for finished_job, finished_result in finished:
+                stats["files_done"] += 1
+                stats["bytes_done"] += finished_job["size"]
+                stats["audio_seconds_done"] += finished_result.get("duration") or 0.0
+                if finished_result["status"] == "converted":
+                    if manifests is not None:
+                        _record_outputs(manifests, finished_job, finished_result)
+                    yield event("finished", result=finished_result)
+                elif finished_result["status"] == "cancelled":
+                    cancelled = True
+                    yield event("cancelled", result=finished_result)
+                else:
+                    stats["files_failed"] += 1
+                    yield event("failed", result=finished_result)
+        while backlog:
+            yield backlog.popleft()
+        for error in scan_errors:
+            yield event("unreadable", **error)
+
+        unlisted = [error["folder"] for error in scan_errors]
+        for manifest in (manifests or {}).values():
+            # A cancelled streaming run has not seen the whole tree, so never prune then.
+            if prune and not cancelled and not stats["discovering"]:
+                for result in _prune_outputs(manifest, root_folder, manifest.output_folder, seen_sources,
+                                             unlisted):
+                    yield event("pruned", result=result)
+            manifest.compact()
+        if cache_dir is not None:
+            try:
+                EncodeCache(cache_dir, cache_max_bytes).evict()
+            except OSError:
+                pass  # The cache is best-effort; the next run evicts again.
+        if report is not None:
+            extra = {"throttle_decisions": throttle.decisions} if throttle else {}
+            summary = report.close(elapsed_seconds=time.monotonic() - started_at, cancelled=cancelled, **extra)
+            yield event("report", summary=summary)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def scan_and_convert(root_folder, output_folder, progress_callback=None, **options):
+    # Blocking wrapper around iter_conversion (see there for options). Each event
+    # is passed to progress_callback if given. Returns one result dict per file.
+    results = []
+    for event in iter_conversion(root_folder, output_folder, **options):
+        if "result" in event:
+            results.append(event["result"])
+        if progress_callback is not None:
+            progress_callback(event)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a folder of audio files to MP3, mirroring its layout.")
+    parser.add_argument("source", help="folder to scan for audio files")
+    parser.add_argument("target", nargs="?", help="output folder (default: '<source>_mp3' next to the source)")
+    parser.add_argument("-j", "--jobs", type=int, help="worker processes (default: CPU count)")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="pydub")
+    parser.add_argument("--incremental", action="store_true", help="skip sources unchanged since the last run")
+    parser.add_argument("--prune", action="store_true", help="with --incremental, delete outputs of removed sources")
+    parser.add_argument("--hash-sources", action="store_true", help="with --incremental, also compare content hashes")
+    parser.add_argument("--cache-dir", help="content-addressed cache shared between runs")
+    parser.add_argument("--schedule", choices=["longest-first", "streaming"], default="longest-first",
+                        help="plan the whole run first, or start encoding while the tree is still being scanned")
+    parser.add_argument("--discovery-threads", type=int, default=DISCOVERY_THREADS,
+                        help="concurrent directory scanners")
+    parser.add_argument("--scratch-dir", help="local folder encodes are written to before being moved into the target "
+                                              "(default: /dev/shm if present, else the temp dir)")
+    parser.add_argument("--commit-threads", type=int, default=COMMIT_THREADS,
+                        help="threads moving finished files into the target")
+    parser.add_argument("--split-longer-than", type=float, metavar="SECONDS",
+                        help="with --backend ffmpeg and MP3 output, encode longer tracks as parallel segments")
+    parser.add_argument("--report", help="write a JSON-lines run report with per-file stage timings")
+    parser.add_argument("--replaygain", action="store_true",
+                        help="measure loudness while converting and write ReplayGain tags into MP3 outputs")
+    parser.add_argument("--profiles", help="JSON file with a list of output profiles (format, bitrate, output_folder, "
+                                           "name); each source is decoded once for all of them")
+    parser.add_argument("--dry-run", action="store_true", help="print the job plan and estimated time, convert nothing")
+    parser.add_argument("--max-load", type=float, help="throttle: run fewer conversions while the 1-minute load "
+                                                        "average is above this (load is not checked otherwise)")
+    parser.add_argument("--min-free-memory", type=float, metavar="FRACTION",
+                        help="throttle: run fewer conversions while less than this fraction of memory is available")
+    parser.add_argument("--max-io-pressure", type=float, metavar="PERCENT",
+                        help="throttle: run fewer conversions while I/O pressure (PSI some avg10) is above this")
+    parser.add_argument("--min-jobs", type=int, default=1, help="throttle: never run fewer conversions than this")
+    parser.add_argument("--nice", type=int, help="niceness increment for workers and encoders")
+    parser.add_argument("--ionice", help="I/O priority for workers and encoders: idle, best-effort[:0-7]")
+    parser.add_argument("--cpus", help="CPUs workers and encoders may run on, e.g. 0-3,6")
+    parser.add_argument("--watch", action="store_true",
+                        help="after converting, keep running and mirror new, changed, renamed and deleted files")
+    parser.add_argument("--poll-interval", type=float, metavar="SECONDS",
+                        help="with --watch, rescan every SECONDS instead of using inotify (e.g. for network shares)")
+    args = parser.parse_args(argv)
+    if args.jobs is not None and args.jobs < 1:
+        parser.error(f"--jobs must be at least 1, got {args.jobs}")
+
+    target = args.target
+    if not target:
+        source_name = os.path.basename(os.path.normpath(args.source))
+        target = os.path.join(os.path.dirname(os.path.normpath(args.source)), f"{source_name}_mp3")
+
+    profiles = None
+    if args.profiles:
+        with open(args.profiles, "r", encoding="utf-8") as f:
+            profiles = json.load(f)
+    throttle = None
+    if args.max_load is not None or args.min_free_memory is not None or args.max_io_pressure is not None:
+        throttle = {"min_jobs": args.min_jobs, "max_load": args.max_load}
+        for option in ("min_free_memory", "max_io_pressure"):
+            if getattr(args, option) is not None:
+                throttle[option] = getattr(args, option)
+    priority = {"nice": args.nice, "ionice": args.ionice, "cpus": parse_cpu_list(args.cpus) if args.cpus else None}
+    if not any(priority.values()):
+        priority = None
+
+    if args.dry_run:
+        plan = plan_conversion(args.source, target, args.jobs, args.backend, args.incremental,
+                               args.hash_sources, args.cache_dir, args.discovery_threads, profiles,
+                               replaygain=args.replaygain)
+        print(format_plan(plan))
+        return 0
+
+    if args.watch:
+        from watch import watch
+        try:
+            for event in watch(args.source, target, poll_interval=args.poll_interval, jobs=args.jobs,
+                               backend=args.backend, hash_sources=args.hash_sources, cache_dir=args.cache_dir,
+                               discovery_threads=args.discovery_threads, profiles=profiles,
+                               scratch_dir=args.scratch_dir, commit_threads=args.commit_threads,
+                               split_longer_than=args.split_longer_than, throttle=throttle, priority=priority,
+                               replaygain=args.replaygain):
+                if "result" in event and event["type"] != "skipped":
+                    result = event["result"]
+                    print(f"{event['type']}: {result['input']}" + (f" ({result['error']})" if result["error"] else ""))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    def report_problems(event):
+        if event["type"] == "unreadable":
+            print(f"Could not list {event['folder']}: {event['error']}")
+        elif event["type"] in ("failed", "rejected"):
+            print(f"{event['type']}: {event['result']['input']} ({event['result']['error']})")
+        if event.get("result", {}).get("cache_error"):
+            print(f"cache: {event['result']['input']} ({event['result']['cache_error']})")
+
+    results = scan_and_convert(args.source, target, report_problems, jobs=args.jobs, backend=args.backend,
+                               incremental=args.incremental, prune=args.prune,
+                               hash_sources=args.hash_sources, cache_dir=args.cache_dir,
+                               schedule=args.schedule, discovery_threads=args.discovery_threads,
+                               report_path=args.report, profiles=profiles, scratch_dir=args.scratch_dir,
+                               commit_threads=args.commit_threads, split_longer_than=args.split_longer_than,
+                               throttle=throttle, priority=priority, replaygain=args.replaygain)
+    output_folders = ", ".join(dict.fromkeys(profile.get("output_folder") or target for profile in profiles or [{}]))
+    failed = [result for result in results if result["status"] == "failed"]
+    rejected = [result for result in results if result["status"] == "rejected"]
+    print(f"{len(results) - len(failed) - len(rejected)} file(s) done, {len(failed)} failed, "
+          f"{len(rejected)} rejected. Output: {output_folders}")
+    return 1 if failed or rejected else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
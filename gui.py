@@ -1,7 +1,20 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 import os
-from flacHelper import scan_and_convert, convert_audio_to_mp3
+import queue
+import threading
+from flacHelper import iter_conversion
+
+POLL_INTERVAL_MS = 100
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
 
 class AudioConverterApp:
     def __init__(self, root):
@@ -11,6 +24,13 @@ class AudioConverterApp:
         self.source_folder = tk.StringVar()
         self.target_folder = tk.StringVar()
 
+        # Conversion runs on a worker thread; it only talks to the UI through this queue.
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.worker_thread = None
+        self.conversion_running = False
+        self.reset_run_state()
+
         # Configure style for a more modern look
         style = ttk.Style()
         style.theme_use('clam') # 'clam', 'alt', 'default', 'classic'
@@ -32,7 +52,11 @@ class AudioConverterApp:
         # --- Start Conversion Button ---
         self.start_button = ttk.Button(root, text="Start Conversion", command=self.start_conversion)
         self.start_button.grid(row=3, column=1, padx=5, pady=10)
-        
+
+        # --- Cancel Button ---
+        self.cancel_button = ttk.Button(root, text="Cancel", command=self.cancel_conversion, state=tk.DISABLED)
+        self.cancel_button.grid(row=3, column=2, padx=5, pady=10)
+
         # --- Progress Bar (Optional but good for UX) ---
         self.progress_var = tk.DoubleVar()
         self.progress_bar = ttk.Progressbar(root, variable=self.progress_var, maximum=100)
@@ -45,6 +69,8 @@ class AudioConverterApp:
         # Configure column weights for responsive resizing
         root.columnconfigure(1, weight=1)
 
+        root.protocol("WM_DELETE_WINDOW", self.on_close)
+
     def browse_source(self):
         folder_selected = filedialog.askdirectory()
         if folder_selected:
@@ -79,28 +105,110 @@ class AudioConverterApp:
 
         try:
             os.makedirs(target, exist_ok=True)
-            self.status_label.config(text=f"Starting conversion... Output: {target}")
-            self.start_button.config(state=tk.DISABLED)
-            self.progress_var.set(0) # Reset progress
-            self.root.update_idletasks() # Ensure UI updates
-
-            # This is a simplified progress update.
-            # For real progress, scan_and_convert would need to yield progress.
-            # Here, we'll just simulate it or update after it's done.
-            
-            scan_and_convert(source, target) # This is a blocking call
-
-            # Simulate progress for now
-            self.progress_var.set(100) 
-            messagebox.showinfo("Success", f"Conversion complete!\nFiles saved to: {target}")
-            self.status_label.config(text="Conversion complete! Select folders to start again.")
-
         except Exception as e:
             messagebox.showerror("Error", f"An error occurred during conversion: {e}")
             self.status_label.config(text=f"Error: {e}")
-        finally:
-            self.start_button.config(state=tk.NORMAL)
-            self.progress_var.set(0) # Reset progress bar
+            return
+
+        self.status_label.config(text=f"Starting conversion... Output: {target}")
+        self.start_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_var.set(0) # Reset progress
+        self.reset_run_state()
+        self.conversion_running = True
+        self.cancel_event = threading.Event()
+        self.events = queue.Queue()
+        self.worker_thread = threading.Thread(target=self._run_conversion, args=(source, target, self.cancel_event, self.events), daemon=True)
+        self.worker_thread.start()
+        self.root.after(POLL_INTERVAL_MS, self._poll_events)
+
+    def reset_run_state(self):
+        self.error = None
+        self.was_cancelled = False
+        self.failures = 0
+
+    def _run_conversion(self, source, target, cancel_event, events):
+        # Worker thread: never touches Tk widgets, only the queue.
+        try:
+            for event in iter_conversion(source, target, cancel_event=cancel_event):
+                events.put(event)
+        except Exception as e:
+            events.put({"type": "error", "error": str(e)})
+        events.put({"type": "done", "target": target})
+
+    def _poll_events(self):
+        try:
+            while True:
+                event = self.events.get_nowait()
+                if event["type"] == "done":
+                    self._finish_conversion(event["target"])
+                    return
+                self._handle_event(event)
+        except queue.Empty:
+            pass
+        self.root.after(POLL_INTERVAL_MS, self._poll_events)
+
+    def _handle_event(self, event):
+        if event["type"] == "error":
+            self.error = event["error"]
+            return
+        if event["type"] == "cancelled":
+            self.was_cancelled = True
+            return
+        if event["type"] in ("failed", "rejected"):
+            self.failures += 1
+
+        stats = event["stats"]
+        if event["type"] == "planned":
+            self.status_label.config(text=f"Found {event['files']} files to convert, "
+                                          f"estimated {format_duration(event['estimated_seconds'])}")
+            return
+        if event["type"] == "discovered":
+            return
+        if not stats["bytes_total"]:
+            return
+        fraction = stats["bytes_done"] / stats["bytes_total"]
+        self.progress_var.set(fraction * 100)
+
+        status = f"{stats['files_done']}/{stats['files_total']} files ({fraction:.0%})"
+        elapsed = stats["elapsed"]
+        if stats["bytes_done"] and elapsed > 0:
+            rate = stats["bytes_done"] / elapsed
+            remaining = (stats["bytes_total"] - stats["bytes_done"]) / rate
+            status += f" - {rate / (1024 * 1024):.1f} MB/s"
+            if stats["audio_seconds_done"]:
+                status += f", {stats['audio_seconds_done'] / elapsed:.0f}x realtime"
+            status += f" - ETA {format_duration(remaining)}"
+        self.status_label.config(text=status)
+
+    def _finish_conversion(self, target):
+        if self.error:
+            messagebox.showerror("Error", f"An error occurred during conversion: {self.error}")
+            self.status_label.config(text=f"Error: {self.error}")
+        elif self.was_cancelled:
+            self.status_label.config(text="Conversion cancelled.")
+        else:
+            self.progress_var.set(100)
+            messagebox.showinfo("Success", f"Conversion complete!\nFiles saved to: {target}")
+            if self.failures:
+                self.status_label.config(text=f"Conversion complete! {self.failures} file(s) failed. Select folders to start again.")
+            else:
+                self.status_label.config(text="Conversion complete! Select folders to start again.")
+        self.start_button.config(state=tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+        self.conversion_running = False
+
+    def cancel_conversion(self):
+        if self.conversion_running:
+            self.cancel_event.set()
+            self.cancel_button.config(state=tk.DISABLED)
+            self.status_label.config(text="Cancelling...")
+
+    def on_close(self):
+        self.cancel_event.set()
+        if self.worker_thread is not None:
+            self.worker_thread.join(timeout=5)
+        self.root.destroy()
 
 
 if __name__ == '__main__':
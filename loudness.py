@@ -0,0 +1,330 @@
+import math
+import os
+import struct
+import time
+
+# Integrated loudness (ITU-R BS.1770-4 / EBU R128) and sample peak, measured on
+# the PCM a backend already decodes for the encoders, so no file is read twice,
+# plus the ReplayGain 2.0 tags derived from them.
+#
+# Everything is block-based and bounded. The K-weighting filter runs as a
+# state-space system over chunks of CHUNK_FRAMES: within a chunk its output is
+# one matrix product with the impulse response, and the four filter states are
+# carried from chunk to chunk by a prefix scan, so a whole block is filtered
+# exactly with a handful of vectorized operations. Gating blocks are
+# accumulated in a fixed loudness histogram instead of being stored. NumPy is
+# optional for the converter as a whole but required here; AVAILABLE says
+# whether it is installed.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+AVAILABLE = numpy is not None
+
+# ReplayGain 2.0 targets -18 LUFS.
+REPLAYGAIN_REFERENCE_LUFS = -18.0
+
+_ABSOLUTE_GATE_LUFS = -70.0
+_RELATIVE_GATE_LU = -10.0
+_HISTOGRAM_STEP_LU = 0.01
+_HISTOGRAM_MAX_LUFS = 10.0
+
+# Frames handed to the filter at once when the caller has more in memory.
+BLOCK_FRAMES = 65536
+
+# Frames the filter treats as one matrix row; 32-64 measured fastest.
+CHUNK_FRAMES = 64
+
+# BS.1770 channel weights for 5.1 (L, R, C, LFE, Ls, Rs); LFE is not counted.
+_SURROUND_WEIGHTS = (1.0, 1.0, 1.0, 0.0, 1.41, 1.41)
+
+
+def _k_weighting(sample_rate):
+    # The two BS.1770 biquads (high shelf, then high pass) as (b, a) pairs for
+    # sample_rate, from the analogue prototypes.
+    k = math.tan(math.pi * 1681.974450955533 / sample_rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = ([(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0],
+             [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    k = math.tan(math.pi * 38.13547087602444 / sample_rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass = ([1.0, -2.0, 1.0], [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    return shelf, high_pass
+
+
+def _chunk_matrices(sample_rate):
+    # The K-weighting cascade as a state-space system (A, B, C, D; both biquads
+    # in transposed direct form II), unrolled over CHUNK_FRAMES. With row
+    # vectors x (a chunk of input) and s (the state before it):
+    #   output = x @ impulse + s @ from_state
+    #   state after = x @ to_state + s @ advance
+    def biquad(b, a):
+        return (numpy.array([[-a[1], 1.0], [-a[2], 0.0]]), numpy.array([b[1] - a[1] * b[0], b[2] - a[2] * b[0]]),
+                numpy.array([1.0, 0.0]), b[0])
+
+    (a1, b1, c1, d1), (a2, b2, c2, d2) = (biquad(b, a) for b, a in _k_weighting(sample_rate))
+    a = numpy.zeros((4, 4))
+    a[:2, :2] = a1
+    a[2:, :2] = numpy.outer(b2, c1)
+    a[2:, 2:] = a2
+    b = numpy.concatenate([b1, b2 * d1])
+    c = numpy.concatenate([d2 * c1, c2])
+    d = d2 * d1
+    powers = [numpy.eye(4)]
+    for _ in range(CHUNK_FRAMES):
+        powers.append(a @ powers[-1])
+    response = [d] + [c @ powers[n] @ b for n in range(CHUNK_FRAMES - 1)]
+    impulse = numpy.zeros((CHUNK_FRAMES, CHUNK_FRAMES))
+    for n in range(CHUNK_FRAMES):
+        impulse[n, n:] = response[:CHUNK_FRAMES - n]
+    from_state = numpy.array([c @ powers[n] for n in range(CHUNK_FRAMES)]).T
+    to_state = numpy.array([powers[CHUNK_FRAMES - 1 - n] @ b for n in range(CHUNK_FRAMES)])
+    return impulse, from_state, to_state, powers[CHUNK_FRAMES].T
+
+
+class LoudnessMeter:
+    # Feed PCM with add() in blocks of shape (frames, channels), integers at
+    # their full scale or floats in [-1, 1], then read result(). `seconds` is
+    # the time spent measuring, for the run report.
+
+    def __init__(self, sample_rate, channels):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self._impulse, self._from_state, self._to_state, self._advance = _chunk_matrices(sample_rate)
+        self._state = numpy.zeros((channels, 4))
+        self._pending = numpy.zeros((0, channels))  # Input short of a whole chunk.
+        weights = _SURROUND_WEIGHTS if channels == 6 else (1.0,) * channels
+        self._weights = numpy.array(weights)
+        self._hop = int(round(sample_rate * 0.1))  # 400 ms gating blocks overlap by 75%.
+        self._partial = numpy.zeros(0)  # Weighted power of samples not yet in a whole hop.
+        self._recent_hops = numpy.zeros(0)  # Mean power of the last three hops.
+        bins = int(round((_HISTOGRAM_MAX_LUFS - _ABSOLUTE_GATE_LUFS) / _HISTOGRAM_STEP_LU)) + 1
+        self._block_counts = numpy.zeros(bins, dtype=numpy.int64)
+        self._block_energy = numpy.zeros(bins)
+        self.peak = 0.0
+        self.frames = 0
+        self.seconds = 0.0
+
+    def add(self, block):
+        started = time.perf_counter()
+        try:
+            self._add(block)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+    def add_pcm(self, data, dtype):
+        # Interleaved PCM bytes of numpy dtype (e.g. "<i2", "<f4", "u1" for
+        # unsigned 8-bit), measured BLOCK_FRAMES at a time.
+        samples = numpy.frombuffer(data, dtype=dtype)
+        step = BLOCK_FRAMES * self.channels
+        for start in range(0, len(samples) - len(samples) % self.channels, step):
+            self.add(samples[start:start + step])
+
+    def _add(self, block):
+        block = numpy.asarray(block)
+        if block.ndim == 1:
+            block = block.reshape(-1, self.channels)
+        if not len(block):
+            return
+        self.frames += len(block)
+        if block.dtype.kind in "iu":
+            full_scale = float(1 << (8 * block.dtype.itemsize - 1))
+            if block.dtype.kind == "u":
+                block = block - full_scale
+            # Peak on the integers, before the block is widened to floats.
+            self.peak = max(self.peak, max(float(block.max()), -float(block.min())) / full_scale)
+            block = block * (1.0 / full_scale)
+        else:
+            self.peak = max(self.peak, max(float(block.max()), -float(block.min())))
+
+        samples = numpy.concatenate([self._pending, block]) if len(self._pending) else block
+        whole = len(samples) // CHUNK_FRAMES * CHUNK_FRAMES
+        self._pending = samples[whole:]
+        if whole:
+            filtered, self._state = self._filter(samples[:whole], self._state)
+            self._partial, self._recent_hops = self._gate(filtered, self._partial, self._recent_hops,
+                                                          self._block_counts, self._block_energy)
+
+    def _filter(self, samples, state):
+        # K-weights whole chunks of samples starting from state; returns the
+        # output and the state after it.
+        chunks = samples.T.reshape(self.channels, -1, CHUNK_FRAMES)
+        # states[:, k] is the state after chunk k: a linear recurrence solved as
+        # a prefix scan with doubling strides.
+        states = chunks @ self._to_state
+        states[:, 0] += state @ self._advance
+        stride, advance = 1, self._advance
+        while stride < states.shape[1]:
+            states[:, stride:] = states[:, stride:] + states[:, :-stride] @ advance
+            advance = advance @ advance
+            stride *= 2
+        before = numpy.concatenate([state[:, None], states[:, :-1]], axis=1)
+        filtered = chunks @ self._impulse + before @ self._from_state
+        return filtered.reshape(self.channels, -1).T, states[:, -1]
+
+    def _gate(self, filtered, partial, recent_hops, counts, energy):
+        # Adds the 400 ms gating blocks completed by filtered to the histogram
+        # (counts, energy); returns the new (partial, recent_hops).
+        power = (filtered * filtered) @ self._weights
+        if len(partial):
+            power = numpy.concatenate([partial, power])
+        whole = len(power) // self._hop * self._hop
+        hops = numpy.concatenate([recent_hops, power[:whole].reshape(-1, self._hop).mean(axis=1)])
+        if len(hops) >= 4:
+            blocks = numpy.lib.stride_tricks.sliding_window_view(hops, 4).mean(axis=1)
+            with numpy.errstate(divide="ignore"):
+                loudness = -0.691 + 10 * numpy.log10(blocks)
+            gated = loudness > _ABSOLUTE_GATE_LUFS
+            index = numpy.clip(numpy.round((loudness[gated] - _ABSOLUTE_GATE_LUFS) / _HISTOGRAM_STEP_LU).astype(int),
+                               0, len(counts) - 1)
+            numpy.add.at(counts, index, 1)
+            numpy.add.at(energy, index, blocks[gated])
+        return power[whole:], hops[-3:]
+
+    def integrated(self):
+        # Integrated loudness in LUFS, or None when nothing passes the gates.
+        # Samples short of a whole chunk are filtered here (zero padding does not
+        # change a causal filter's earlier output) without touching the meter.
+        counts, energy = self._block_counts, self._block_energy
+        if len(self._pending):
+            counts, energy = counts.copy(), energy.copy()
+            padded = numpy.zeros((CHUNK_FRAMES, self.channels))
+            padded[:len(self._pending)] = self._pending
+            filtered, _ = self._filter(padded, self._state)
+            self._gate(filtered[:len(self._pending)], self._partial, self._recent_hops, counts, energy)
+        if not counts.any():
+            return None
+        threshold = -0.691 + 10 * math.log10(energy.sum() / counts.sum()) + _RELATIVE_GATE_LU
+        first = max(0, int(math.ceil((threshold - _ABSOLUTE_GATE_LUFS) / _HISTOGRAM_STEP_LU)))
+        if not counts[first:].any():
+            return None
+        return -0.691 + 10 * math.log10(energy[first:].sum() / counts[first:].sum())
+
+    def result(self):
+        # {"integrated_lufs", "peak", "replaygain_track_gain", "replaygain_track_peak"};
+        # gain and loudness are None for silence.
+        integrated = self.integrated()
+        return {
+            "integrated_lufs": integrated,
+            "peak": self.peak,
+            "replaygain_track_gain": None if integrated is None else REPLAYGAIN_REFERENCE_LUFS - integrated,
+            "replaygain_track_peak": self.peak,
+        }
+
+
+def measure_wav_stream(stream):
+    # Measures a WAV byte stream as it is read, such as ffmpeg writing
+    # "-f wav pipe:1" (whose header sizes are placeholders, so the data chunk
+    # runs to end of stream). Returns the LoudnessMeter.
+    header = stream.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        raise ValueError("PCM stream is not WAV")
+    dtype = None
+    while True:
+        chunk = stream.read(8)
+        if len(chunk) < 8:
+            raise ValueError("PCM stream has no data chunk")
+        chunk_id, size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+        if chunk_id == b"data":
+            break
+        body = stream.read(size + size % 2)
+        if chunk_id == b"fmt ":
+            format_tag, channels, sample_rate = struct.unpack("<HHI", body[:8])
+            bits = struct.unpack("<H", body[14:16])[0]
+            if format_tag == 0xFFFE:  # WAVE_FORMAT_EXTENSIBLE: the real tag leads the subformat GUID.
+                format_tag = struct.unpack("<H", body[24:26])[0]
+            dtype = {(3, 32): "<f4", (3, 64): "<f8", (1, 8): "u1", (1, 16): "<i2", (1, 32): "<i4"}.get(
+                (format_tag, bits))
+    if dtype is None:
+        raise ValueError("PCM stream has an unsupported sample format")
+    meter = LoudnessMeter(sample_rate, channels)
+    frame_bytes = channels * numpy.dtype(dtype).itemsize
+    while True:
+        data = stream.read(BLOCK_FRAMES * frame_bytes)
+        if not data:
+            return meter
+        meter.add_pcm(data[:len(data) - len(data) % frame_bytes], dtype)
+
+
+def replaygain_tags(analysis):
+    # TXXX descriptions and values, formatted as ReplayGain scanners write them.
+    if analysis.get("replaygain_track_gain") is None:
+        return {}
+    return {
+        "REPLAYGAIN_TRACK_GAIN": f"{analysis['replaygain_track_gain']:.2f} dB",
+        "REPLAYGAIN_TRACK_PEAK": f"{analysis['replaygain_track_peak']:.6f}",
+    }
+
+
+def _syncsafe(size):
+    return bytes(((size >> shift) & 0x7F) for shift in (21, 14, 7, 0))
+
+
+def _unsyncsafe(data):
+    size = 0
+    for byte in data:
+        size = (size << 7) | (byte & 0x7F)
+    return size
+
+
+def _txxx_frame(description, value, version):
+    # Latin-1 text (encoding 0), which ID3v2.3 and v2.4 readers both accept.
+    body = b"\x00" + description.encode("latin-1") + b"\x00" + value.encode("latin-1")
+    size = _syncsafe(len(body)) if version == 4 else struct.pack(">I", len(body))
+    return b"TXXX" + size + b"\x00\x00" + body
+
+
+def write_id3_txxx(path, tags):
+    # Adds or replaces TXXX frames in an MP3's leading ID3v2.3/2.4 tag, creating
+    # a v2.4 tag when there is none. The rest of the file is streamed across.
+    # Returns False (file untouched) for tags using unsynchronisation or an
+    # extended header, which ffmpeg never writes.
+    if not tags:
+        return True
+    with open(path, "rb") as f:
+        header = f.read(10)
+        frames = b""
+        version = 4
+        audio_start = 0
+        if len(header) == 10 and header[:3] == b"ID3" and header[3] in (3, 4):
+            version = header[3]
+            if header[5] & 0xC0:
+                return False
+            tag_size = _unsyncsafe(header[6:10])
+            tag = f.read(tag_size)
+            audio_start = 10 + tag_size + (10 if header[5] & 0x10 else 0)
+            offset = 0
+            while offset + 10 <= len(tag) and tag[offset] != 0:
+                frame_id = tag[offset:offset + 4]
+                frame_size = _unsyncsafe(tag[offset + 4:offset + 8]) if version == 4 else \
+                    struct.unpack(">I", tag[offset + 4:offset + 8])[0]
+                frame = tag[offset:offset + 10 + frame_size]
+                offset += 10 + frame_size
+                if frame_id == b"TXXX":
+                    description = frame[11:].split(b"\x00", 1)[0].decode("latin-1", "replace")
+                    if description.upper() in tags:
+                        continue
+                frames += frame
+        frames += b"".join(_txxx_frame(description, value, version) for description, value in tags.items())
+        temp_path = f"{path}.tags"
+        try:
+            with open(temp_path, "wb") as out:
+                out.write(b"ID3" + bytes([version, 0, 0]) + _syncsafe(len(frames)) + frames)
+                f.seek(audio_start)
+                while True:
+                    chunk = f.read(1 << 20)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    return True
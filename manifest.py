@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+
+MANIFEST_FILENAME = ".flacconvert_manifest.jsonl"
+
+
+def file_digest(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    # Persistent record of what has been converted into an output folder.
+    #
+    # Stored as JSON lines, one record per source file keyed by its path relative
+    # to the source root. New records are appended as files finish so a crashed
+    # run keeps what it completed; the last record for a source wins on load, and
+    # compact() rewrites the file with one line per source. Sources the header
+    # sniffer rejected are kept too, in `rejected`, so an unchanged bad file is
+    # not reopened on the next run.
+
+    def __init__(self, output_folder, filename=MANIFEST_FILENAME):
+        self.output_folder = output_folder
+        self.path = os.path.join(output_folder, filename)
+        self.entries = {}
+        self.rejected = {}
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        self.rejected = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn final line from an interrupted run.
+                    continue
+                self.entries.pop(record["source"], None)
+                self.rejected.pop(record["source"], None)
+                if record.get("deleted"):
+                    continue
+                if "rejected" in record:
+                    self.rejected[record["source"]] = record
+                else:
+                    self.entries[record["source"]] = record
+
+    def is_up_to_date(self, relative_source, source_path, settings, use_hash=False):
+        entry = self.entries.get(relative_source)
+        if entry is None or entry.get("settings") != settings:
+            return False
+        if not os.path.exists(os.path.join(self.output_folder, entry["output"])):
+            return False
+        stat = os.stat(source_path)
+        if entry["size"] != stat.st_size:
+            return False
+        if entry["mtime_ns"] == stat.st_mtime_ns:
+            return True
+        # Touched but possibly unchanged (e.g. restored from backup): fall back to
+        # the content hash when one was recorded.
+        if use_hash and entry.get("sha256") and file_digest(source_path) == entry["sha256"]:
+            self.record(relative_source, entry["output"], stat.st_size, stat.st_mtime_ns, settings, entry["sha256"])
+            return True
+        return False
+
+    def record(self, relative_source, relative_output, size, mtime_ns, settings, sha256=None):
+        record = {
+            "source": relative_source,
+            "output": relative_output,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "settings": settings,
+        }
+        if sha256:
+            record["sha256"] = sha256
+        self.rejected.pop(relative_source, None)
+        self.entries[relative_source] = record
+        self._append(record)
+
+    def cached_rejection(self, relative_source, source_path):
+        # The recorded rejection reason if the source is unchanged since, else None.
+        entry = self.rejected.get(relative_source)
+        if entry is None:
+            return None
+        stat = os.stat(source_path)
+        if entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            return None
+        return entry["rejected"]
+
+    def record_rejection(self, relative_source, source_path, reason):
+        stat = os.stat(source_path)
+        record = {
+            "source": relative_source,
+            "rejected": reason,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+        self.entries.pop(relative_source, None)
+        self.rejected[relative_source] = record
+        self._append(record)
+
+    def rename(self, relative_source, new_relative_source, new_relative_output):
+        # Moves a converted source's record to its new path (and output), keeping
+        # size, mtime, settings and hash, so the renamed file is up to date.
+        entry = self.entries.get(relative_source)
+        if entry is None:
+            self.remove(relative_source)
+            return
+        self.remove(relative_source)
+        record = dict(entry, source=new_relative_source, output=new_relative_output)
+        self.rejected.pop(new_relative_source, None)
+        self.entries[new_relative_source] = record
+        self._append(record)
+
+    def remove(self, relative_source):
+        found = self.entries.pop(relative_source, None) is not None
+        found = self.rejected.pop(relative_source, None) is not None or found
+        if found:
+            self._append({"source": relative_source, "deleted": True})
+
+    def _append(self, record):
+        os.makedirs(self.output_folder, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def compact(self):
+        if not self.entries and not self.rejected and not os.path.exists(self.path):
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for record in list(self.entries.values()) + list(self.rejected.values()):
+                f.write(json.dumps(record) + "\n")
+        os.replace(temp_path, self.path)
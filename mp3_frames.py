@@ -0,0 +1,99 @@
+import math
+
+# MPEG audio Layer III frame parsing and frame-accurate splicing, used to join
+# separately encoded segments of one long track into a single gapless MP3.
+#
+# Segments are encoded without a bit reservoir (every frame's data lives in the
+# frame itself) and with a little overlap on both sides, starting on a frame
+# boundary of the whole track. LAME's delay is the same for every encode, so
+# frame k of a segment that starts at sample s covers exactly the audio that
+# frame s / frame_samples + k of a single encode of the whole track would, and
+# the segments can be cut and concatenated at frame granularity.
+
+_BITRATES_KBPS = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG-1
+    2: (22050, 24000, 16000),  # MPEG-2
+    0: (11025, 12000, 8000),   # MPEG-2.5
+}
+
+# Frames of overlap encoded before and after each segment's own range, so the
+# encoder's filterbank and psychoacoustic state have settled where it is cut.
+OVERLAP_FRAMES = 2
+
+
+def frame_samples(sample_rate):
+    # Samples per Layer III frame: 1152 for MPEG-1 rates, 576 below 32 kHz.
+    return 1152 if sample_rate >= 32000 else 576
+
+
+def _parse_header(data, offset):
+    # (frame length in bytes, samples, sample rate) for a Layer III header, else None.
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    version = (data[offset + 1] >> 3) & 0x03
+    layer = (data[offset + 1] >> 1) & 0x03
+    bitrate_index = data[offset + 2] >> 4
+    rate_index = (data[offset + 2] >> 2) & 0x03
+    padding = (data[offset + 2] >> 1) & 0x01
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    bitrate = _BITRATES_KBPS[1 if version == 3 else 2][bitrate_index] * 1000
+    if version == 3:
+        return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+    return 72 * bitrate // sample_rate + padding, 576, sample_rate
+
+
+def iter_frames(data):
+    # Yields (offset, length, samples, sample_rate) for each frame of an MP3
+    # stream, skipping anything between frames (tags, junk).
+    offset = 0
+    while offset + 4 <= len(data):
+        header = _parse_header(data, offset)
+        if header is None or offset + header[0] > len(data):
+            offset += 1
+            continue
+        yield offset, header[0], header[1], header[2]
+        offset += header[0]
+
+
+def segment_bounds(total_samples, segments, samples_per_frame):
+    # Splits [0, total_samples) into `segments` ranges of whole frames; returns
+    # the boundaries, first 0 and last total_samples.
+    frames = math.ceil(total_samples / samples_per_frame)
+    segments = max(1, min(segments, frames))
+    bounds = [round(frames * index / segments) * samples_per_frame for index in range(segments)]
+    return bounds + [total_samples]
+
+
+def encode_range(bounds, index, samples_per_frame):
+    # Input samples to encode for segment `index`, overlap included.
+    overlap = OVERLAP_FRAMES * samples_per_frame
+    start = max(0, bounds[index] - overlap)
+    end = bounds[index + 1] + overlap if index + 2 < len(bounds) else bounds[index + 1]
+    return start, end
+
+
+def segment_frames(data, bounds, index, samples_per_frame):
+    # The part of encoded segment `index` (encoded over its encode_range) that
+    # belongs in the joined stream: the frames of the whole-track timeline in
+    # [bounds[index], bounds[index + 1]), or for the last segment everything
+    # from bounds[index] on, including the encoder's final flush.
+    first_frame = encode_range(bounds, index, samples_per_frame)[0] // samples_per_frame
+    keep_from = bounds[index] // samples_per_frame
+    keep_to = bounds[index + 1] // samples_per_frame if index + 2 < len(bounds) else None
+    kept = bytearray()
+    for position, (offset, length, samples, _) in enumerate(iter_frames(data)):
+        if samples != samples_per_frame:
+            raise ValueError(f"Segment {index} has {samples}-sample frames, expected {samples_per_frame}")
+        frame = first_frame + position
+        if frame < keep_from:
+            continue
+        if keep_to is not None and frame >= keep_to:
+            break
+        kept += data[offset:offset + length]
+    return bytes(kept)
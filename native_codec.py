@@ -0,0 +1,96 @@
+import time
+from contextlib import ExitStack
+from loudness import LoudnessMeter
+
+# In-process conversion: libsndfile (through soundfile) decodes, LAME (through
+# lameenc) encodes, and no process is spawned per file. On libraries of short
+# clips the fork/exec and pipe setup of an ffmpeg run costs more than the audio
+# itself. Both bindings are optional; without them can_handle is always False
+# and flacHelper falls back to ffmpeg.
+
+try:
+    import soundfile
+except (ImportError, OSError):  # OSError: the binding is there but libsndfile is not.
+    soundfile = None
+try:
+    import lameenc
+except ImportError:
+    lameenc = None
+
+AVAILABLE = soundfile is not None and lameenc is not None
+
+# Demuxers (see probe.CONTAINER_FORMATS) whose codecs libsndfile decodes.
+INPUT_FORMATS = ("flac", "wav", "ogg")
+
+# LAME's own default quality (what ffmpeg's libmp3lame uses); lameenc would
+# otherwise pick the slower 2.
+LAME_QUALITY = 3
+
+# Frames decoded and encoded per step, so memory does not grow with track length.
+BLOCK_FRAMES = 65536
+
+
+def can_handle(input_path, input_format, outputs):
+    # True when every output is an MP3 and libsndfile can open the source as
+    # mono or stereo audio. input_format, when known, rules out other
+    # containers without opening the file.
+    if not AVAILABLE or any(output["format"] != "mp3" for output in outputs):
+        return False
+    if input_format is not None and input_format not in INPUT_FORMATS:
+        return False
+    try:
+        info = soundfile.info(input_path)
+    except (RuntimeError, OSError):
+        return False
+    return info.channels in (1, 2) and info.frames > 0
+
+
+def _bitrate_kbps(bitrate):
+    # "320k" -> 320; LAME takes whole kbps.
+    return int(str(bitrate).lower().rstrip("k"))
+
+
+def convert(input_path, outputs, timings=None, input_format=None, analysis=None):
+    # Backend entry point (see flacHelper): decodes input_path block by block
+    # as 16-bit PCM and feeds each block to one LAME encoder per output, and to
+    # the loudness meter when analysis is a dict.
+    decode_seconds = encode_seconds = 0.0
+    with ExitStack() as stack:
+        source = stack.enter_context(soundfile.SoundFile(input_path))
+        meter = LoudnessMeter(source.samplerate, source.channels) if analysis is not None else None
+        encoders = []
+        for output in outputs:
+            encoder = lameenc.Encoder()
+            encoder.set_in_sample_rate(source.samplerate)
+            encoder.set_channels(source.channels)
+            encoder.set_quality(LAME_QUALITY)
+            if output.get("bitrate"):
+                encoder.set_bit_rate(_bitrate_kbps(output["bitrate"]))
+            encoders.append((encoder, stack.enter_context(open(output["path"], "wb"))))
+        frames = 0
+        while True:
+            started = time.perf_counter()
+            block = source.read(BLOCK_FRAMES, dtype="int16")
+            decode_seconds += time.perf_counter() - started
+            if not len(block):
+                break
+            frames += len(block)
+            started = time.perf_counter()
+            pcm = block.tobytes()
+            for encoder, f in encoders:
+                f.write(encoder.encode(pcm))
+            encode_seconds += time.perf_counter() - started
+            if meter is not None:
+                meter.add(block)
+        started = time.perf_counter()
+        for encoder, f in encoders:
+            f.write(encoder.flush())
+        encode_seconds += time.perf_counter() - started
+    if timings is not None:
+        timings["decode"] = timings.get("decode", 0.0) + decode_seconds
+        timings["encode"] = timings.get("encode", 0.0) + encode_seconds
+    if meter is not None:
+        analysis.update(meter.result())
+        if timings is not None:
+            timings["loudness"] = timings.get("loudness", 0.0) + meter.seconds
+    return frames / source.samplerate
@@ -0,0 +1,260 @@
+import os
+import struct
+
+# Pure-Python header readers: they read a few hundred bytes (the Ogg duration
+# also reads the last 64 KiB) and never spawn a process, so they are cheap enough
+# to run on every file during planning.
+
+SNIFF_BYTES = 64
+
+# Container name -> ffmpeg demuxer used to decode it.
+CONTAINER_FORMATS = {
+    "flac": "flac",
+    "wav": "wav",
+    "ogg": "ogg",
+    "mp4": "mp4",
+    "asf": "asf",
+    "aac": "aac",
+    "mp3": "mp3",
+}
+
+_ASF_HEADER_GUID = bytes.fromhex("3026b2758e66cf11a6d900aa0062ce6c")
+
+
+def _flac_streaminfo(f):
+    # (duration, sample rate) from STREAMINFO, which is always the first
+    # metadata block after the fLaC marker; None for what is unknown.
+    header = f.read(4 + 4 + 34)
+    if len(header) < 42 or header[:4] != b"fLaC" or header[4] & 0x7F != 0:
+        return None, None
+    streaminfo = header[8:]
+    packed = int.from_bytes(streaminfo[10:18], "big")
+    sample_rate = packed >> 44
+    total_samples = packed & ((1 << 36) - 1)
+    if not sample_rate:
+        return None, None
+    return (total_samples / sample_rate if total_samples else None), sample_rate
+
+
+def _wav_format(f):
+    # (duration, sample rate) from the fmt and data chunks; None for what is unknown.
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None, None
+    byte_rate = sample_rate = None
+    # fmt and data are normally the first chunks; give up after a handful.
+    for _ in range(16):
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            return None, sample_rate
+        chunk_id, chunk_size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+        if chunk_id == b"fmt ":
+            fmt = f.read(chunk_size + (chunk_size & 1))
+            if len(fmt) < 12:
+                return None, None
+            sample_rate, byte_rate = struct.unpack("<II", fmt[4:12])
+        elif chunk_id == b"data":
+            # 0xFFFFFFFF marks a streamed WAV of unknown length.
+            if not byte_rate or chunk_size == 0xFFFFFFFF:
+                return None, sample_rate
+            return chunk_size / byte_rate, sample_rate
+        else:
+            f.seek(chunk_size + (chunk_size & 1), 1)
+    return None, sample_rate
+
+
+def _id3v2_size(header):
+    # Length of a leading ID3v2 tag (some FLAC/AAC/MP3 files carry one), else 0.
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if header[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def identify_container(head):
+    # Names the container from the first bytes of a file, or None.
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[:4] in (b"RIFF", b"RF64", b"BW64") and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[4:8] == b"ftyp":
+        return "mp4"
+    if head[:16] == _ASF_HEADER_GUID:
+        return "asf"
+    if len(head) >= 2 and head[0] == 0xFF:
+        layer = head[1] & 0x06
+        if head[1] & 0xF6 == 0xF0:
+            return "aac"  # ADTS: 12 sync bits, layer 00.
+        if head[1] & 0xE0 == 0xE0 and layer:
+            return "mp3"
+    return None
+
+
+# Validators take a file positioned at the start of the container and the
+# bytes available from there; they return (reason, duration, sample rate), each
+# None when not applicable or unknown.
+
+def _check_flac(f, available):
+    if available < 42:
+        return "truncated FLAC header", None, None
+    if f.read(5)[4] & 0x7F != 0:
+        return "FLAC stream without STREAMINFO", None, None
+    f.seek(0)
+    return (None, *_flac_streaminfo(f))
+
+
+def _check_wav(f, available):
+    header = f.read(12)
+    riff_size = struct.unpack("<I", header[4:8])[0]
+    # 0xFFFFFFFF is what streaming writers leave when the length is not known up front.
+    if header[:4] == b"RIFF" and riff_size != 0xFFFFFFFF and riff_size + 8 > available:
+        return f"truncated WAV: header declares {riff_size + 8} bytes, file has {available}", None, None
+    f.seek(0)
+    return (None, *_wav_format(f))
+
+
+def _check_mp4(f, available):
+    # Walks the top-level boxes: every box must fit in the file and one must be
+    # moov (the index ffmpeg needs). mvhd, normally moov's first child, gives the
+    # duration.
+    position = 0
+    duration = None
+    found_moov = False
+    for _ in range(64):
+        if position >= available:
+            break
+        f.seek(position)
+        header = f.read(16)
+        if len(header) < 8:
+            return "truncated MP4 box header", None, None
+        box_size, box_type = struct.unpack(">I4s", header[:8])
+        header_size = 8
+        if box_size == 1:
+            if len(header) < 16:
+                return "truncated MP4 box header", None, None
+            box_size = struct.unpack(">Q", header[8:16])[0]
+            header_size = 16
+        elif box_size == 0:
+            box_size = available - position
+        if box_size < header_size or position + box_size > available:
+            return f"truncated MP4: {box_type.decode('latin-1')} box runs past end of file", None, None
+        if box_type == b"moov":
+            found_moov = True
+            f.seek(position + header_size)
+            duration = _mvhd_duration(f.read(40))
+        position += box_size
+    if not found_moov:
+        return "MP4 without moov atom", None, None
+    return None, duration, None
+
+
+def _mvhd_duration(data):
+    if len(data) < 32 or data[4:8] != b"mvhd":
+        return None
+    if data[8] == 1:
+        if len(data) < 40:
+            return None
+        timescale, length = struct.unpack(">IQ", data[28:40])
+    else:
+        timescale, length = struct.unpack(">II", data[20:28])
+    return length / timescale if timescale else None
+
+
+def _check_ogg(f, available):
+    head = f.read(64)
+    if len(head) < 28 or len(head) < 27 + head[26]:
+        return "truncated Ogg page header", None, None
+    if head[4] != 0:
+        return "unsupported Ogg version", None, None
+    # First packet identifies the codec and its granule rate; the last page's
+    # granule position is the total sample count.
+    packet = head[27 + head[26]:]
+    if packet[:7] == b"\x01vorbis" and len(packet) >= 16:
+        rate = struct.unpack("<I", packet[12:16])[0]
+    elif packet[:8] == b"OpusHead":
+        rate = 48000
+    else:
+        return None, None, None
+    if not rate:
+        return None, None, None
+    tail_size = min(available, 65536)
+    f.seek(available - tail_size)
+    tail = f.read(tail_size)
+    last_page = tail.rfind(b"OggS")
+    if last_page < 0 or last_page + 14 > len(tail):
+        return None, None, rate
+    granule = struct.unpack("<q", tail[last_page + 6:last_page + 14])[0]
+    return None, (granule / rate if granule > 0 else None), rate
+
+
+def _check_asf(f, available):
+    header = f.read(24)
+    if len(header) < 24:
+        return "truncated ASF header", None, None
+    header_size = struct.unpack("<Q", header[16:24])[0]
+    if header_size > available:
+        return "truncated ASF header object", None, None
+    return None, None, None
+
+
+_VALIDATORS = {
+    "flac": _check_flac,
+    "wav": _check_wav,
+    "mp4": _check_mp4,
+    "ogg": _check_ogg,
+    "asf": _check_asf,
+}
+
+
+class _OffsetFile:
+    # File view whose position 0 is `offset` bytes into the real file.
+
+    def __init__(self, f, offset):
+        self._f = f
+        self._offset = offset
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+    def seek(self, position, whence=0):
+        if whence == 0:
+            position += self._offset
+        return self._f.seek(position, whence) - self._offset
+
+
+def sniff_file(path):
+    # Identifies and sanity-checks an audio file from its headers alone, without
+    # spawning any process. Returns {"container", "format", "valid", "reason",
+    # "duration", "sample_rate"}: format is the ffmpeg demuxer to decode it with, and reason
+    # says why an invalid file was rejected.
+    verdict = {"container": None, "format": None, "valid": False, "reason": None, "duration": None,
+               "sample_rate": None}
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            offset = _id3v2_size(f.read(10))
+            f.seek(offset)
+            container = identify_container(f.read(SNIFF_BYTES))
+            if container is None:
+                verdict["reason"] = "not a recognised audio container" if size else "empty file"
+                return verdict
+            verdict["container"] = container
+            verdict["format"] = CONTAINER_FORMATS[container]
+            validator = _VALIDATORS.get(container)
+            if validator is not None:
+                # Validators see the container as if it started at offset 0.
+                container_file = _OffsetFile(f, offset)
+                container_file.seek(0)
+                verdict["reason"], verdict["duration"], verdict["sample_rate"] = validator(container_file,
+                                                                                           size - offset)
+    except OSError as e:
+        verdict["reason"] = str(e)
+        return verdict
+    verdict["valid"] = verdict["reason"] is None
+    return verdict
+
@@ -0,0 +1,90 @@
+import json
+import math
+
+SLOWEST_FILES = 10
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of an already sorted list.
+    if not values:
+        return None
+    rank = max(1, math.ceil(fraction * len(values)))
+    return values[rank - 1]
+
+
+def _distribution(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "total": sum(values),
+        "p50": percentile(values, 0.50),
+        "p90": percentile(values, 0.90),
+        "p99": percentile(values, 0.99),
+        "max": values[-1] if values else None,
+    }
+
+
+class RunReport:
+    # JSON-lines run report: one {"type": "file"} line per finished file, written
+    # as results arrive, then a {"type": "summary"} line with per-stage
+    # percentiles, the slowest files and every failure.
+
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        self._file = open(path, "w", encoding="utf-8")
+
+    def add(self, result):
+        timings = result.get("timings") or {}
+        record = {
+            "type": "file",
+            "input": result["input"],
+            "output": result["output"],
+            "status": result["status"],
+            "backend": result.get("backend"),
+            "error": result.get("error"),
+            "exit_code": result.get("exit_code"),
+            "cached": bool(result.get("cached")),
+            "cache_error": result.get("cache_error"),
+            "input_size": result.get("input_size"),
+            "output_size": result.get("output_size"),
+            "duration": result.get("duration"),
+            "loudness": result.get("loudness"),
+            "wall_seconds": timings.get("total"),
+            "stages": {stage: seconds for stage, seconds in timings.items() if stage != "total"},
+        }
+        self.records.append(record)
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def summary(self):
+        stages = {}
+        for record in self.records:
+            for stage, seconds in record["stages"].items():
+                stages.setdefault(stage, []).append(seconds)
+        timed = [record for record in self.records if record["wall_seconds"] is not None]
+        slowest = sorted(timed, key=lambda record: record["wall_seconds"], reverse=True)[:SLOWEST_FILES]
+        statuses = {}
+        for record in self.records:
+            statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+        return {
+            "type": "summary",
+            "files": len(self.records),
+            "statuses": statuses,
+            "input_bytes": sum(record["input_size"] or 0 for record in self.records),
+            "output_bytes": sum(record["output_size"] or 0 for record in self.records),
+            "audio_seconds": sum(record["duration"] or 0.0 for record in self.records),
+            "wall_seconds": _distribution([record["wall_seconds"] for record in timed]),
+            "stages": {stage: _distribution(values) for stage, values in sorted(stages.items())},
+            "slowest": [{"input": record["input"], "wall_seconds": record["wall_seconds"]} for record in slowest],
+            "failures": [{"input": record["input"], "error": record["error"], "exit_code": record["exit_code"]}
+                         for record in self.records if record["status"] in ("failed", "rejected")],
+        }
+
+    def close(self, **extra):
+        # Writes the summary line (plus any run-level fields) and returns it.
+        summary = self.summary()
+        summary.update(extra)
+        self._file.write(json.dumps(summary) + "\n")
+        self._file.close()
+        return summary
@@ -1,13 +1,18 @@
 import unittest
+from unittest import mock
+import json
 import os
 import shutil
 import sys
 import subprocess
+import threading
+import time
 
 # Add the directory containing flacHelper.py and gui.py to the Python path
 sys.path.append(os.getcwd())
 
-from flacHelper import scan_and_convert, convert_audio_to_mp3
+from flacHelper import iter_audio_files, iter_conversion, plan_conversion, format_plan, scan_and_convert, convert_audio_to_mp3
+from flacHelper import _run_job
 
 # --- TKINTER SETUP ---
 # Assume xvfb-run is used, so Tkinter *should* be available for initialization.
@@ -26,6 +31,18 @@ except ImportError as e:
     print(f"Failed to import tkinter or gui modules: {e}. GUI tests will be impacted.")
     TKINTER_AVAILABLE = False # Fallback if import fails despite xvfb-run
 
+def _worker_priority():
+    # Runs in a pool worker for test_26.
+    return os.nice(0), os.sched_getaffinity(0)
+
+
+def _crashing_run_job(job, run_job=_run_job):
+    # Runs in a pool worker for test_28: the worker dies on one file.
+    if os.path.basename(job["input"]).startswith("crash"):
+        os._exit(1)
+    return run_job(job)
+
+
 class TestAudioConverter(unittest.TestCase):
 
     TEST_BASE_DIR = "test_app_files_valid_audio" 
@@ -136,6 +153,15 @@ class TestAudioConverter(unittest.TestCase):
         except Exception as e:
             return False, f"Exception during MP3 validation of {mp3_filepath}: {e}"
 
+    def _wait_for_conversion(self, timeout=120):
+        # start_conversion returns immediately; pump the Tk event loop until the
+        # background conversion reports completion.
+        deadline = time.monotonic() + timeout
+        while self.app.conversion_running and time.monotonic() < deadline:
+            self.root.update()
+            time.sleep(0.02)
+        self.assertFalse(self.app.conversion_running, "Conversion did not finish in time")
+
     def _mock_askdirectory(self):
         if self.mock_paths_to_return:
             return self.mock_paths_to_return.pop(0)
@@ -172,6 +198,7 @@ class TestAudioConverter(unittest.TestCase):
         self.app.source_folder.set(self.SOURCE_DIR)
         self.app.target_folder.set("") 
         self.app.start_conversion() 
+        self._wait_for_conversion()
         self.assertTrue(os.path.exists(self.DEFAULT_TARGET_DIR))
         self.assertEqual(self.app.target_folder.get(), self.DEFAULT_TARGET_DIR)
         expected_mp3 = os.path.join(self.DEFAULT_TARGET_DIR, "dummy.mp3")
@@ -191,6 +218,7 @@ class TestAudioConverter(unittest.TestCase):
         self.app.source_folder.set(self.SOURCE_DIR)
         self.app.target_folder.set(new_target)
         self.app.start_conversion()
+        self._wait_for_conversion()
         self.assertTrue(os.path.exists(new_target))
         expected_mp3 = os.path.join(new_target, "dummy.mp3")
         self.assertTrue(os.path.exists(expected_mp3))
@@ -268,6 +296,7 @@ class TestAudioConverter(unittest.TestCase):
         self.app.source_folder.set(self.SOURCE_DIR)
         self.app.target_folder.set(self.TARGET_DIR_EXPLICIT)
         self.app.start_conversion() 
+        self._wait_for_conversion()
         self.assertIn("Conversion complete!", self.app.status_label.cget("text"))
         self.assertEqual(str(self.app.start_button.cget("state")), tk_module.NORMAL) 
         self.assertEqual(self.app.progress_var.get(), 100.0)
@@ -279,6 +308,768 @@ class TestAudioConverter(unittest.TestCase):
         self.assertEqual(str(self.app.start_button.cget("state")), tk_module.NORMAL)
         print("test_08_gui_feedback_elements: PASSED")
 
+    def test_09_parallel_conversion_results(self):
+        print("\nRunning test_09_parallel_conversion_results (flacHelper direct)...")
+        old_stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        results = scan_and_convert(self.SOURCE_DIR, self.TARGET_DIR_EXPLICIT, jobs=2)
+        sys.stdout = old_stdout
+
+        by_name = {os.path.relpath(r["input"], self.SOURCE_DIR): r for r in results}
+        self.assertEqual(len(results), 6, f"Unexpected results: {sorted(by_name)}")
+        self.assertNotIn("non_audio_file.txt", by_name)
+        self.assertEqual(by_name["corrupted_audio.flac"]["status"], "rejected")
+        self.assertTrue(by_name["corrupted_audio.flac"]["error"])
+
+        nested = by_name[os.path.join("subfolder", "nested_dummy.flac")]
+        self.assertEqual(nested["status"], "converted", nested["error"])
+        self.assertEqual(nested["output"], os.path.join(self.TARGET_DIR_EXPLICIT, "subfolder", "nested_dummy.mp3"))
+        is_valid, msg = self._check_mp3_validity(nested["output"])
+        self.assertTrue(is_valid, f"Nested dummy.mp3 (parallel) invalid: {msg}")
+        print("test_09_parallel_conversion_results: PASSED")
+
+    def test_10_ffmpeg_streaming_backend(self):
+        print("\nRunning test_10_ffmpeg_streaming_backend (flacHelper direct)...")
+        old_stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        results = scan_and_convert(self.SOURCE_DIR, self.TARGET_DIR_EXPLICIT, jobs=1, backend="ffmpeg")
+        sys.stdout = old_stdout
+
+        for result in results:
+            if os.path.basename(result["input"]) == "corrupted_audio.flac":
+                self.assertEqual(result["status"], "rejected")
+                self.assertFalse(os.path.exists(result["output"]), "Partial output left behind for corrupted file")
+            else:
+                self.assertEqual(result["status"], "converted", result["error"])
+                is_valid, msg = self._check_mp3_validity(result["output"])
+                self.assertTrue(is_valid, f"{result['output']} (ffmpeg backend) invalid: {msg}")
+
+        with self.assertRaises(ValueError):
+            scan_and_convert(self.SOURCE_DIR, self.TARGET_DIR_EXPLICIT, backend="no-such-backend")
+        print("test_10_ffmpeg_streaming_backend: PASSED")
+
+    def test_11_incremental_manifest_skips_and_prunes(self):
+        print("\nRunning test_11_incremental_manifest_skips_and_prunes (flacHelper direct)...")
+        source = os.path.join(self.TEST_BASE_DIR, "incremental_source")
+        if os.path.exists(source): shutil.rmtree(source)
+        os.makedirs(os.path.join(source, "album"))
+        shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.flac"), os.path.join(source, "one.flac"))
+        shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.wav"), os.path.join(source, "album", "two.wav"))
+
+        def statuses():
+            results = scan_and_convert(source, self.TARGET_DIR_EXPLICIT, jobs=1, backend="ffmpeg",
+                                       incremental=True, prune=True, hash_sources=True)
+            return {os.path.relpath(r["input"], source): r["status"] for r in results}
+
+        self.assertEqual(statuses(), {"one.flac": "converted", os.path.join("album", "two.wav"): "converted"})
+        self.assertEqual(statuses(), {"one.flac": "skipped", os.path.join("album", "two.wav"): "skipped"})
+
+        # Touched but identical content is still skipped thanks to the recorded hash.
+        os.utime(os.path.join(source, "one.flac"), (1, 1))
+        self.assertEqual(statuses()["one.flac"], "skipped")
+
+        # Changed settings force a re-encode.
+        results = scan_and_convert(source, self.TARGET_DIR_EXPLICIT, jobs=1, backend="pydub", incremental=True)
+        self.assertTrue(all(r["status"] != "skipped" for r in results))
+
+        # A folder that cannot be listed is reported, and its outputs are not pruned.
+        scandir = os.scandir
+
+        def failing_scandir(path):
+            if isinstance(path, str) and os.path.basename(path) == "album":
+                raise PermissionError(13, "Permission denied", path)
+            return scandir(path)
+        for schedule in ("longest-first", "streaming"):
+            events = []
+            with mock.patch("flacHelper.os.scandir", side_effect=failing_scandir):
+                results = scan_and_convert(source, self.TARGET_DIR_EXPLICIT, events.append, jobs=1,
+                                           backend="ffmpeg", incremental=True, prune=True, hash_sources=True,
+                                           schedule=schedule)
+            self.assertEqual([r["status"] for r in results], ["skipped"])
+            unreadable = [e for e in events if e["type"] == "unreadable"]
+            self.assertEqual([e["folder"] for e in unreadable], ["album"])
+            self.assertIn("Permission denied", unreadable[0]["error"])
+            self.assertTrue(os.path.exists(os.path.join(self.TARGET_DIR_EXPLICIT, "album", "two.mp3")))
+
+        shutil.rmtree(os.path.join(source, "album"))
+        self.assertEqual(statuses()[os.path.join("album", "two.wav")], "pruned")
+        self.assertFalse(os.path.exists(os.path.join(self.TARGET_DIR_EXPLICIT, "album")))
+        self.assertTrue(os.path.exists(os.path.join(self.TARGET_DIR_EXPLICIT, "one.mp3")))
+        shutil.rmtree(source)
+        print("test_11_incremental_manifest_skips_and_prunes: PASSED")
+
+    def test_12_dedup_cache_encodes_identical_audio_once(self):
+        print("\nRunning test_12_dedup_cache_encodes_identical_audio_once (flacHelper direct)...")
+        source = os.path.join(self.TEST_BASE_DIR, "dedup_source")
+        cache_dir = os.path.join(self.TEST_BASE_DIR, "dedup_cache")
+        second_target = os.path.join(self.TEST_BASE_DIR, "dedup_second_target")
+        for folder in (source, cache_dir, second_target):
+            if os.path.exists(folder): shutil.rmtree(folder)
+        for album in ("artist_a", "compilation"):
+            os.makedirs(os.path.join(source, album))
+            shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.flac"), os.path.join(source, album, "track.flac"))
+
+        results = scan_and_convert(source, self.TARGET_DIR_EXPLICIT, jobs=2, backend="ffmpeg", cache_dir=cache_dir)
+        self.assertEqual([r["status"] for r in results], ["converted", "converted"])
+        self.assertEqual(sum(1 for r in results if r.get("cached")), 1, "Duplicate was encoded twice")
+        for result in results:
+            is_valid, msg = self._check_mp3_validity(result["output"])
+            self.assertTrue(is_valid, f"{result['output']} (dedup) invalid: {msg}")
+
+        # A different target folder sharing the cache needs no encoding at all.
+        results = scan_and_convert(source, second_target, jobs=1, backend="ffmpeg", cache_dir=cache_dir)
+        self.assertTrue(all(r.get("cached") for r in results))
+
+        # An entry evicted between the worker's lookup and the commit is encoded again.
+        import flacHelper
+        commit_file = flacHelper._commit_file
+
+        def evict_first(source, destination, keep_source, created_folders):
+            if keep_source:
+                os.remove(source)
+            commit_file(source, destination, keep_source, created_folders)
+        with mock.patch("flacHelper._commit_file", side_effect=evict_first):
+            results = scan_and_convert(source, second_target, jobs=1, backend="ffmpeg", cache_dir=cache_dir)
+        self.assertEqual([r["status"] for r in results], ["converted", "converted"], results)
+        self.assertEqual(sum(1 for r in results if r.get("cached")), 1, "Only the duplicate is linked")
+        for result in results:
+            is_valid, msg = self._check_mp3_validity(result["output"])
+            self.assertTrue(is_valid, f"{result['output']} (re-encoded) invalid: {msg}")
+        self.assertEqual(len([f for _, _, files in os.walk(cache_dir) for f in files]), 1)
+
+        # A cache that cannot be written costs the cache entry, not the file.
+        full_source = os.path.join(self.TEST_BASE_DIR, "dedup_full_source")
+        if os.path.exists(full_source): shutil.rmtree(full_source)
+        os.makedirs(full_source)
+        shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.wav"), os.path.join(full_source, "new.wav"))
+        with mock.patch("encode_cache.EncodeCache.store", side_effect=OSError(28, "No space left on device")):
+            results = scan_and_convert(full_source, second_target, jobs=1, backend="ffmpeg", cache_dir=cache_dir)
+        self.assertEqual(results[0]["status"], "converted", results[0]["error"])
+        self.assertIn("No space left", results[0]["cache_error"])
+        is_valid, msg = self._check_mp3_validity(results[0]["output"])
+        self.assertTrue(is_valid, f"{results[0]['output']} (uncached) invalid: {msg}")
+        shutil.rmtree(full_source)
+
+        # A copy that fails partway leaves no temporary file behind.
+        from encode_cache import link_or_copy
+
+        def partial_copy(source_path, destination_path):
+            with open(destination_path, "wb") as f:
+                f.write(b"partial")
+            raise OSError(28, "No space left on device")
+        with mock.patch("encode_cache.os.link", side_effect=OSError(18, "Invalid cross-device link")), \
+                mock.patch("encode_cache.shutil.copyfile", side_effect=partial_copy):
+            with self.assertRaises(OSError):
+                link_or_copy(os.path.join(self.ASSETS_DIR, "dummy.wav"), os.path.join(cache_dir, "entry.mp3"))
+        self.assertEqual([f for f in os.listdir(cache_dir) if f.startswith("entry")], [])
+
+        # A zero-byte budget evicts everything but entries still being written.
+        with open(os.path.join(cache_dir, "entry.mp3.0123.tmp"), "wb") as f:
+            f.write(b"in progress")
+        scan_and_convert(source, second_target, jobs=1, backend="ffmpeg", cache_dir=cache_dir, cache_max_bytes=0)
+        cached_files = [f for _, _, files in os.walk(cache_dir) for f in files]
+        self.assertEqual(cached_files, ["entry.mp3.0123.tmp"])
+        for folder in (source, cache_dir, second_target):
+            shutil.rmtree(folder)
+        print("test_12_dedup_cache_encodes_identical_audio_once: PASSED")
+
+    @unittest.skipUnless(TKINTER_AVAILABLE and gui_module is not None, "Skipping GUI test: tkinter/gui not fully available")
+    def test_13_gui_non_blocking_with_cancel(self):
+        self.assertIsNotNone(self.app, "GUI App not initialized")
+        print("\nRunning test_13_gui_non_blocking_with_cancel...")
+        self.assertEqual(str(self.app.cancel_button.cget("state")), tk_module.DISABLED)
+        self.app.source_folder.set(self.SOURCE_DIR)
+        self.app.target_folder.set(self.TARGET_DIR_EXPLICIT)
+        self.app.start_conversion()
+        self.assertTrue(self.app.conversion_running)
+        self.assertEqual(str(self.app.start_button.cget("state")), tk_module.DISABLED)
+        self.assertEqual(str(self.app.cancel_button.cget("state")), tk_module.NORMAL)
+        self.app.cancel_conversion()
+        self._wait_for_conversion()
+        self.assertEqual(str(self.app.start_button.cget("state")), tk_module.NORMAL)
+        self.assertEqual(str(self.app.cancel_button.cget("state")), tk_module.DISABLED)
+        print("test_13_gui_non_blocking_with_cancel: PASSED")
+
+    def test_14_cancel_stops_scheduling(self):
+        print("\nRunning test_14_cancel_stops_scheduling (flacHelper direct)...")
+        cancel_event = threading.Event()
+        cancel_event.set()
+        events = list(iter_conversion(self.SOURCE_DIR, self.TARGET_DIR_EXPLICIT, jobs=2, backend="ffmpeg",
+                                      cancel_event=cancel_event))
+        discovered = [e for e in events if e["type"] == "discovered"]
+        cancelled = [e for e in events if e["type"] == "cancelled"]
+        self.assertEqual(len(discovered), 5)
+        self.assertEqual(len(cancelled), 5)
+        self.assertFalse(any(e["type"] == "started" for e in events))
+        self.assertEqual(events[-1]["stats"]["files_total"], 5)
+        print("test_14_cancel_stops_scheduling: PASSED")
+
+    def test_15_plan_orders_longest_first_without_side_effects(self):
+        print("\nRunning test_15_plan_orders_longest_first_without_side_effects (flacHelper direct)...")
+        target = os.path.join(self.TEST_BASE_DIR, "plan_target")
+        plan = plan_conversion(self.SOURCE_DIR, target, jobs=2)
+        self.assertFalse(os.path.exists(target), "Planning must not create the output folder")
+        self.assertEqual(plan["files"], 5)
+        self.assertEqual([os.path.basename(r["input"]) for r in plan["rejected"]], ["corrupted_audio.flac"])
+        self.assertEqual(plan["bytes"], sum(job["size"] for job in plan["tasks"]))
+        estimates = [job["estimated_duration"] for job in plan["tasks"]]
+        self.assertEqual(estimates, sorted(estimates, reverse=True))
+
+        # Header-readable formats get exact durations; the rest are estimated from size.
+        by_name = {os.path.basename(job["input"]): job for job in plan["tasks"]}
+        self.assertAlmostEqual(by_name["dummy.flac"]["duration"], 1.0, places=2)
+        self.assertAlmostEqual(by_name["dummy.wav"]["duration"], 1.0, places=2)
+        self.assertGreater(plan["estimated_seconds"], 0)
+        self.assertIn("Files to convert: 5", format_plan(plan))
+
+        # A dangling symlink fails on its own instead of aborting the run.
+        source = os.path.join(self.TEST_BASE_DIR, "plan_dangling_src")
+        if os.path.exists(source): shutil.rmtree(source)
+        os.makedirs(source)
+        shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.flac"), os.path.join(source, "good.flac"))
+        os.symlink(os.path.join(source, "missing.flac"), os.path.join(source, "dangling.flac"))
+        for schedule in ("longest-first", "streaming"):
+            results = scan_and_convert(source, target, jobs=1, backend="ffmpeg", incremental=True,
+                                       schedule=schedule)
+            by_name = {os.path.basename(r["input"]): r for r in results}
+            self.assertEqual(by_name["good.flac"]["status"], "converted" if schedule == "longest-first"
+                             else "skipped", by_name["good.flac"]["error"])
+            self.assertEqual(by_name["dangling.flac"]["status"], "failed", schedule)
+            self.assertIn("No such file", by_name["dangling.flac"]["error"])
+        shutil.rmtree(source)
+        shutil.rmtree(target)
+        print("test_15_plan_orders_longest_first_without_side_effects: PASSED")
+
+    def test_16_streaming_discovery_overlaps_conversion(self):
+        print("\nRunning test_16_streaming_discovery_overlaps_conversion (flacHelper direct)...")
+        walked = set()
+        for foldername, subfolders, filenames in os.walk(self.SOURCE_DIR):
+            walked.update(os.path.join(foldername, f) for f in filenames if not f.endswith(".txt"))
+        scanned = {item[0] for item in iter_audio_files(self.SOURCE_DIR, self.TARGET_DIR_EXPLICIT, threads=4)}
+        self.assertEqual(scanned, walked)
+
+        events = list(iter_conversion(self.SOURCE_DIR, self.TARGET_DIR_EXPLICIT, jobs=2, backend="ffmpeg",
+                                      schedule="streaming"))
+        outcomes = [e for e in events if e["type"] in ("finished", "failed", "rejected")]
+        self.assertEqual(len(outcomes), 6)
+        self.assertEqual(events[-1]["stats"]["files_rejected"], 1)
+        self.assertFalse(any(e["type"] == "planned" for e in events))
+        self.assertFalse(events[-1]["stats"]["discovering"])
+        expected_mp3_nested = os.path.join(self.TARGET_DIR_EXPLICIT, "subfolder", "nested_dummy.mp3")
+        is_valid, msg = self._check_mp3_validity(expected_mp3_nested)
+        self.assertTrue(is_valid, f"Nested dummy.mp3 (streaming) invalid: {msg}")
+        print("test_16_streaming_discovery_overlaps_conversion: PASSED")
+
+    def test_17_benchmark_library_and_trial_metrics(self):
+        print("\nRunning test_17_benchmark_library_and_trial_metrics...")
+        import benchmark
+        library = os.path.join(self.TEST_BASE_DIR, "benchmark_library")
+        config = benchmark.library_config(count=3, duration=1.0, formats=["flac", "wav"], layout="deep")
+        benchmark.generate_library(library, config)
+        tracks = sorted(f for _, _, files in os.walk(library) for f in files if not f.startswith("."))
+        self.assertEqual(tracks, ["track_00000.flac", "track_00001.wav", "track_00002.flac"])
+
+        metrics = benchmark.run_trial(library, {"backend": "ffmpeg", "jobs": 1})
+        self.assertEqual(metrics["converted"], 3)
+        for key in ("wall_seconds", "files_per_second", "audio_seconds_per_second", "cpu_utilization", "peak_rss_kb"):
+            self.assertGreater(metrics[key], 0, key)
+        shutil.rmtree(library)
+        print("test_17_benchmark_library_and_trial_metrics: PASSED")
+
+    def test_18_instrumented_run_report(self):
+        print("\nRunning test_18_instrumented_run_report (flacHelper direct)...")
+        report_path = os.path.join(self.TEST_BASE_DIR, "run_report.jsonl")
+        old_stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        events = list(iter_conversion(self.SOURCE_DIR, self.TARGET_DIR_EXPLICIT, jobs=2, backend="ffmpeg",
+                                      report_path=report_path))
+        sys.stdout = old_stdout
+
+        with open(report_path) as f:
+            lines = [json.loads(line) for line in f]
+        files = [line for line in lines if line["type"] == "file"]
+        summary = lines[-1]
+        self.assertEqual(summary["type"], "summary")
+        self.assertEqual(events[-1]["type"], "report")
+        self.assertEqual(events[-1]["summary"]["files"], 6)
+        self.assertEqual(len(files), 6)
+
+        converted = next(line for line in files if line["input"].endswith("dummy.wav"))
+        self.assertEqual(converted["status"], "converted")
+        self.assertGreater(converted["output_size"], 0)
+        self.assertIn("transcode", converted["stages"])
+        self.assertIn("probe", converted["stages"])
+        self.assertAlmostEqual(converted["duration"], 1.0, delta=0.1)
+
+        self.assertEqual([failure["input"] for failure in summary["failures"]],
+                         [os.path.join(self.SOURCE_DIR, "corrupted_audio.flac")])
+        self.assertEqual(summary["statuses"]["rejected"], 1)
+        self.assertEqual(summary["stages"]["transcode"]["count"], 5)
+        self.assertLessEqual(summary["stages"]["transcode"]["p50"], summary["stages"]["transcode"]["max"])
+        print("test_18_instrumented_run_report: PASSED")
+
+    def test_19_sniffer_rejects_and_routes_by_container(self):
+        print("\nRunning test_19_sniffer_rejects_and_routes_by_container (flacHelper direct)...")
+        from probe import sniff_file
+        source = os.path.join(self.TEST_BASE_DIR, "sniff_src")
+        target = os.path.join(self.TEST_BASE_DIR, "sniff_target")
+        os.makedirs(source, exist_ok=True)
+        # A WAV saved as .m4a, a truncated M4A, and an empty FLAC.
+        shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.wav"), os.path.join(source, "mislabeled.m4a"))
+        with open(os.path.join(self.ASSETS_DIR, "dummy.m4a"), "rb") as f:
+            m4a = f.read()
+        with open(os.path.join(source, "truncated.m4a"), "wb") as f:
+            f.write(m4a[:len(m4a) // 2])
+        open(os.path.join(source, "empty.flac"), "w").close()
+        # A streamed WAV: RIFF and data sizes left at 0xFFFFFFFF by the writer.
+        with open(os.path.join(self.ASSETS_DIR, "dummy.wav"), "rb") as f:
+            wav = bytearray(f.read())
+        wav[4:8] = b"\xff\xff\xff\xff"
+        data = wav.index(b"data", 12)
+        wav[data + 4:data + 8] = b"\xff\xff\xff\xff"
+        with open(os.path.join(source, "streamed.wav"), "wb") as f:
+            f.write(wav)
+
+        for name in ("dummy.flac", "dummy.wav", "dummy.m4a", "dummy.ogg"):
+            verdict = sniff_file(os.path.join(self.ASSETS_DIR, name))
+            self.assertTrue(verdict["valid"], f"{name}: {verdict['reason']}")
+        self.assertEqual(sniff_file(os.path.join(source, "mislabeled.m4a"))["format"], "wav")
+        self.assertFalse(sniff_file(os.path.join(source, "truncated.m4a"))["valid"])
+        verdict = sniff_file(os.path.join(source, "streamed.wav"))
+        self.assertTrue(verdict["valid"], verdict["reason"])
+        self.assertIsNone(verdict["duration"])
+
+        results = scan_and_convert(source, target, jobs=1, backend="ffmpeg", incremental=True)
+        by_name = {os.path.basename(r["input"]): r for r in results}
+        self.assertEqual(by_name["mislabeled.m4a"]["status"], "converted", by_name["mislabeled.m4a"]["error"])
+        self.assertEqual(by_name["streamed.wav"]["status"], "converted", by_name["streamed.wav"]["error"])
+        self.assertEqual(by_name["truncated.m4a"]["status"], "rejected")
+        self.assertEqual(by_name["empty.flac"]["status"], "rejected")
+        self.assertFalse(os.path.exists(os.path.join(target, "truncated.mp3")))
+
+        # Unchanged rejects are answered from the manifest on the next run.
+        with mock.patch("flacHelper.sniff_file", side_effect=AssertionError("re-sniffed")):
+            results = scan_and_convert(source, target, jobs=1, backend="ffmpeg", incremental=True)
+        self.assertEqual(sorted(r["status"] for r in results), ["rejected", "rejected", "skipped", "skipped"])
+        print("test_19_sniffer_rejects_and_routes_by_container: PASSED")
+
+    def test_20_profiles_decode_once_for_every_rendition(self):
+        print("\nRunning test_20_profiles_decode_once_for_every_rendition (flacHelper direct)...")
+        import flacHelper
+        source = os.path.join(self.TEST_BASE_DIR, "profiles_src")
+        archive = os.path.join(self.TEST_BASE_DIR, "profiles_archive")
+        mobile = os.path.join(self.TEST_BASE_DIR, "profiles_mobile")
+        os.makedirs(os.path.join(source, "album"), exist_ok=True)
+        shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.flac"), os.path.join(source, "album", "one.flac"))
+        shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.wav"), os.path.join(source, "two.wav"))
+        profiles = [
+            {"name": "archive", "format": "mp3", "bitrate": "320k", "output_folder": archive},
+            {"name": "mobile", "format": "mp3", "bitrate": "64k", "output_folder": mobile},
+        ]
+
+        real_run = subprocess.run
+        with mock.patch("flacHelper.subprocess.run", side_effect=real_run) as run:
+            results = scan_and_convert(source, None, jobs=1, backend="ffmpeg", incremental=True, profiles=profiles)
+        self.assertEqual(run.call_count, 2, "Expected one ffmpeg process per source")
+        for result in results:
+            self.assertEqual(result["status"], "converted", result["error"])
+            self.assertEqual(len(result["outputs"]), 2)
+        high = os.path.join(archive, "album", "one.mp3")
+        low = os.path.join(mobile, "album", "one.mp3")
+        for path in (high, low):
+            is_valid, msg = self._check_mp3_validity(path)
+            self.assertTrue(is_valid, f"{path}: {msg}")
+        self.assertGreater(os.path.getsize(high), os.path.getsize(low))
+
+        # A profile added later only encodes the new rendition.
+        profiles.append({"format": "ogg", "output_folder": mobile})
+        results = scan_and_convert(source, None, jobs=1, backend="ffmpeg", incremental=True, profiles=profiles)
+        self.assertEqual(sorted(os.path.basename(r["outputs"][0]) for r in results), ["one.ogg", "two.ogg"])
+        self.assertEqual([r["status"] for r in scan_and_convert(source, None, jobs=1, backend="ffmpeg",
+                                                                incremental=True, profiles=profiles)],
+                         ["skipped", "skipped"])
+
+        with self.assertRaises(ValueError):
+            flacHelper.plan_conversion(source, archive, profiles=[{"bitrate": "320k"}, {"bitrate": "128k"}])
+        print("test_20_profiles_decode_once_for_every_rendition: PASSED")
+
+    def test_21_encode_to_scratch_then_commit(self):
+        print("\nRunning test_21_encode_to_scratch_then_commit (flacHelper direct)...")
+        import flacHelper
+        source = os.path.join(self.TEST_BASE_DIR, "staging_src")
+        target = os.path.join(self.TEST_BASE_DIR, "staging_target")
+        scratch = os.path.join(self.TEST_BASE_DIR, "staging_scratch")
+        for folder in (source, target, scratch):
+            if os.path.exists(folder): shutil.rmtree(folder)
+        os.makedirs(os.path.join(source, "album"))
+        os.makedirs(scratch)
+        shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.flac"), os.path.join(source, "album", "one.flac"))
+        shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.wav"), os.path.join(source, "album", "two.wav"))
+
+        # Slow target storage: the second encode must not wait for the first commit.
+        real_commit = flacHelper._commit_file
+        committed_from = []
+
+        def slow_commit(staged, destination, keep_source, created_folders):
+            committed_from.append(staged)
+            self.assertFalse(os.path.exists(destination), "Encoder wrote into the target tree")
+            time.sleep(0.3)
+            real_commit(staged, destination, keep_source, created_folders)
+
+        with mock.patch("flacHelper._commit_file", side_effect=slow_commit):
+            events = list(iter_conversion(source, target, jobs=1, backend="ffmpeg", scratch_dir=scratch))
+        types = [e["type"] for e in events if e["type"] in ("started", "finished")]
+        self.assertEqual(types, ["started", "started", "finished", "finished"])
+        self.assertTrue(all(path.startswith(scratch) for path in committed_from))
+        for name in ("one.mp3", "two.mp3"):
+            is_valid, msg = self._check_mp3_validity(os.path.join(target, "album", name))
+            self.assertTrue(is_valid, f"{name} (staged) invalid: {msg}")
+        self.assertEqual(sorted(os.listdir(os.path.join(target, "album"))), ["one.mp3", "two.mp3"])
+        self.assertEqual(os.listdir(scratch), [], "Scratch space was not cleaned up")
+        print("test_21_encode_to_scratch_then_commit: PASSED")
+
+    def test_22_long_track_split_into_parallel_segments(self):
+        print("\nRunning test_22_long_track_split_into_parallel_segments (flacHelper direct)...")
+        import flacHelper
+        folder = os.path.join(self.TEST_BASE_DIR, "split_long")
+        if os.path.exists(folder): shutil.rmtree(folder)
+        os.makedirs(folder)
+        source = os.path.join(folder, "long.flac")
+        subprocess.run(["ffmpeg", "-nostdin", "-v", "error", "-y",
+                        "-f", "lavfi", "-i", "sine=f=440:r=44100:d=20", "-ac", "2",
+                        "-metadata", "title=Long Mix", "-metadata", "artist=Someone", source], check=True)
+
+        # A 5 s segment floor turns 20 s into four segments (given the cores).
+        with mock.patch("flacHelper.SPLIT_SEGMENT_SECONDS", 5.0), \
+                mock.patch("flacHelper.os.cpu_count", return_value=4), \
+                mock.patch("flacHelper.subprocess.run", wraps=subprocess.run) as run:
+            timings = {}
+            result = convert_audio_to_mp3(source, os.path.join(folder, "split.mp3"), backend="ffmpeg",
+                                          timings=timings, input_format="flac", split_longer_than=10)
+        self.assertEqual(result["status"], "converted", result["error"])
+        # Four segment encodes plus one pass copying the source's tags.
+        self.assertEqual(run.call_count, 5)
+        self.assertIn("join", timings)
+        self.assertAlmostEqual(result["duration"], 20.0, places=3)
+        is_valid, msg = self._check_mp3_validity(os.path.join(folder, "split.mp3"))
+        self.assertTrue(is_valid, f"Joined MP3 invalid: {msg}")
+        with open(os.path.join(folder, "split.mp3"), "rb") as f:
+            head = f.read(4096)
+        self.assertTrue(head.startswith(b"ID3"))
+        self.assertIn(b"Long Mix", head)
+        self.assertIn(b"Someone", head)
+
+        # Same decoded length as one reservoir-free encode of the whole track.
+        subprocess.run(["ffmpeg", "-nostdin", "-v", "error", "-y", "-i", source, "-c:a", "libmp3lame",
+                        "-reservoir", "0", "-write_xing", "0", os.path.join(folder, "whole.mp3")], check=True)
+
+        def decoded_bytes(path):
+            return len(subprocess.run(["ffmpeg", "-v", "error", "-i", path, "-f", "s16le", "-"],
+                                      capture_output=True, check=True).stdout)
+        self.assertEqual(decoded_bytes(os.path.join(folder, "split.mp3")),
+                         decoded_bytes(os.path.join(folder, "whole.mp3")))
+        self.assertEqual(sorted(os.listdir(folder)), ["long.flac", "split.mp3", "whole.mp3"])
+
+        # A run with several jobs passes each track its share of the cores.
+        with mock.patch("flacHelper.SPLIT_SEGMENT_SECONDS", 5.0), \
+                mock.patch("flacHelper.os.cpu_count", return_value=4), \
+                mock.patch("flacHelper.subprocess.run", wraps=subprocess.run) as run:
+            result = flacHelper.convert_audio(source, [{"path": os.path.join(folder, "shared.mp3"), "format": "mp3",
+                                                        "bitrate": None}],
+                                              "ffmpeg", None, "flac", split_longer_than=10, split_segments=2)
+        self.assertEqual(result["status"], "converted", result["error"])
+        self.assertEqual(run.call_count, 3)
+        os.remove(os.path.join(folder, "shared.mp3"))
+
+        # jobs sizes each track's share of the cores, so it must be at least 1.
+        with self.assertRaises(ValueError):
+            scan_and_convert(folder, os.path.join(folder, "out"), jobs=0, backend="ffmpeg", split_longer_than=10)
+        with mock.patch("sys.stderr"), self.assertRaises(SystemExit):
+            flacHelper.main([folder, os.path.join(folder, "out"), "-j", "0"])
+        self.assertFalse(os.path.exists(os.path.join(folder, "out")))
+
+        # Short tracks keep the single-process path.
+        result = convert_audio_to_mp3(source, os.path.join(folder, "short.mp3"), backend="ffmpeg",
+                                      split_longer_than=60)
+        self.assertEqual(result["status"], "converted", result["error"])
+        print("test_22_long_track_split_into_parallel_segments: PASSED")
+
+    def test_23_native_backend_in_process_with_fallback(self):
+        print("\nRunning test_23_native_backend_in_process_with_fallback (flacHelper direct)...")
+        import native_codec
+        if not native_codec.AVAILABLE:
+            self.skipTest("soundfile and lameenc are not installed")
+        source = os.path.join(self.TEST_BASE_DIR, "native_src")
+        target = os.path.join(self.TEST_BASE_DIR, "native_target")
+        for folder in (source, target):
+            if os.path.exists(folder): shutil.rmtree(folder)
+        os.makedirs(source)
+        for name in ("dummy.flac", "dummy.wav", "dummy.m4a"):
+            shutil.copy(os.path.join(self.ASSETS_DIR, name), os.path.join(source, name))
+
+        with mock.patch("flacHelper.subprocess.run", wraps=subprocess.run) as run:
+            results = scan_and_convert(source, target, jobs=1, backend="native")
+        backends = {os.path.basename(r["input"]): r["backend"] for r in results}
+        self.assertEqual(backends, {"dummy.flac": "native", "dummy.wav": "native", "dummy.m4a": "ffmpeg"})
+        self.assertEqual(run.call_count, 1, "Only the M4A should have spawned ffmpeg")
+        for r in results:
+            self.assertEqual(r["status"], "converted", r["error"])
+            self.assertAlmostEqual(r["duration"], 1.0, places=1)
+            is_valid, msg = self._check_mp3_validity(r["output"])
+            self.assertTrue(is_valid, f"{r['output']} invalid: {msg}")
+        print("test_23_native_backend_in_process_with_fallback: PASSED")
+
+    def test_24_watch_mirrors_arrivals_renames_and_deletions(self):
+        print("\nRunning test_24_watch_mirrors_arrivals_renames_and_deletions (watch direct)...")
+        import watch
+        source = os.path.join(self.TEST_BASE_DIR, "watch_src")
+        target = os.path.join(self.TEST_BASE_DIR, "watch_target")
+        for folder in (source, target):
+            if os.path.exists(folder): shutil.rmtree(folder)
+        os.makedirs(os.path.join(source, "inbox"))
+        shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.flac"), os.path.join(source, "inbox", "one.flac"))
+
+        stop = threading.Event()
+        events = []
+
+        def run():
+            for event in watch.watch(source, target, stop_event=stop, debounce=0.2, backend="ffmpeg", jobs=1):
+                events.append(event)
+        watcher = threading.Thread(target=run)
+        watcher.start()
+
+        def wait_for(relative_path, present=True):
+            deadline = time.time() + 15
+            while time.time() < deadline:
+                if os.path.exists(os.path.join(target, relative_path)) == present:
+                    return
+                time.sleep(0.05)
+            self.fail(f"{relative_path} {'never appeared' if present else 'was never removed'}")
+
+        try:
+            wait_for(os.path.join("inbox", "one.mp3"))  # Initial catch-up run.
+            shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.wav"), os.path.join(source, "inbox", "two.wav"))
+            wait_for(os.path.join("inbox", "two.mp3"))
+            os.rename(os.path.join(source, "inbox"), os.path.join(source, "filed"))
+            wait_for(os.path.join("filed", "two.mp3"))
+            wait_for("inbox", present=False)
+            os.remove(os.path.join(source, "filed", "one.flac"))
+            wait_for(os.path.join("filed", "one.mp3"), present=False)
+        finally:
+            stop.set()
+            watcher.join(timeout=30)
+        self.assertFalse(watcher.is_alive(), "watch did not stop")
+        finished = [e for e in events if e["type"] == "finished"]
+        self.assertEqual(len(finished), 2, "A rename must not re-encode")
+        self.assertEqual(len([e for e in events if e["type"] == "moved"]), 2)
+        is_valid, msg = self._check_mp3_validity(os.path.join(target, "filed", "two.mp3"))
+        self.assertTrue(is_valid, f"Moved MP3 invalid: {msg}")
+        print("test_24_watch_mirrors_arrivals_renames_and_deletions: PASSED")
+
+    def test_25_work_queue_workers_drain_and_retry_expired_leases(self):
+        print("\nRunning test_25_work_queue_workers_drain_and_retry_expired_leases (work_queue direct)...")
+        import sqlite3
+        import work_queue
+        source = os.path.join(self.TEST_BASE_DIR, "queue_src")
+        target = os.path.join(self.TEST_BASE_DIR, "queue_target")
+        for folder in (source, target):
+            if os.path.exists(folder): shutil.rmtree(folder)
+        os.makedirs(source)
+        for index in range(6):
+            shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.flac"), os.path.join(source, f"track{index}.flac"))
+        queue_path = os.path.join(self.TEST_BASE_DIR, "queue.sqlite")
+        if os.path.exists(queue_path): os.remove(queue_path)
+
+        plan = work_queue.enqueue(queue_path, source, target, backend="ffmpeg", lease_seconds=0.5)
+        self.assertEqual(plan["files"], 6)
+        # A worker that leases a job and dies: the lease must expire and the job be retried.
+        queue = work_queue.WorkQueue(queue_path)
+        crashed_id, _ = queue.lease("crashed-worker", lease_seconds=0.5)
+        queue.close()
+
+        workers = [subprocess.Popen([sys.executable, "work_queue.py", "work", "--queue", queue_path],
+                                    stdout=subprocess.DEVNULL) for _ in range(3)]
+        counts = work_queue.wait_and_record(queue_path, poll_interval=0.1)
+        for worker in workers:
+            self.assertEqual(worker.wait(timeout=60), 0)
+        self.assertEqual(counts, {"pending": 0, "leased": 0, "done": 6, "failed": 0})
+        with sqlite3.connect(queue_path) as connection:
+            attempts = connection.execute("SELECT attempts FROM jobs WHERE id = ?", (crashed_id,)).fetchone()[0]
+        self.assertEqual(attempts, 2)
+        for index in range(6):
+            is_valid, msg = self._check_mp3_validity(os.path.join(target, f"track{index}.mp3"))
+            self.assertTrue(is_valid, f"track{index}.mp3 invalid: {msg}")
+
+        # The coordinator recorded the manifest, so a second run finds nothing to do.
+        self.assertEqual(work_queue.enqueue(queue_path, source, target, backend="ffmpeg")["files"], 0)
+
+        # Each worker splits long tracks over its share of the host's cores.
+        work_queue.enqueue(queue_path, source, target, backend="ffmpeg", incremental=False, split_longer_than=600)
+        with mock.patch("work_queue.os.cpu_count", return_value=8), \
+                mock.patch("work_queue.convert_planned_job", wraps=work_queue.convert_planned_job) as convert:
+            self.assertEqual(work_queue.run_worker(queue_path, host_workers=2), 6)
+        self.assertEqual({call.args[0]["split_segments"] for call in convert.call_args_list}, {4})
+
+        # With no worker left, jobs whose leases keep expiring fail after max_attempts,
+        # and the rest fail once nothing has happened for idle_timeout.
+        work_queue.enqueue(queue_path, source, target, backend="ffmpeg", incremental=False, lease_seconds=0.1,
+                           max_attempts=2)
+        queue = work_queue.WorkQueue(queue_path)
+        for _ in range(2):
+            # The two longest jobs are leased twice by workers that die.
+            for _ in range(2):
+                queue.lease("dead-worker", lease_seconds=0.1, max_attempts=2)
+            time.sleep(0.2)
+        started = time.monotonic()
+        counts = work_queue.wait_and_record(queue_path, poll_interval=0.05, idle_timeout=0.5)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(counts, {"pending": 0, "leased": 0, "done": 0, "failed": 6})
+        errors = [result["error"] for _, result in queue.finished()]
+        queue.close()
+        self.assertEqual(errors.count("lease expired on every attempt"), 2)
+        self.assertEqual(sum(error.startswith("no worker") for error in errors), 4)
+
+        # The coordinator trims the shared cache once the queue is drained.
+        cache_dir = os.path.join(self.TEST_BASE_DIR, "queue_cache")
+        work_queue.enqueue(queue_path, source, target, backend="ffmpeg", incremental=False, cache_dir=cache_dir,
+                           cache_max_bytes=0)
+        work_queue.run_worker(queue_path)
+        self.assertTrue([f for _, _, files in os.walk(cache_dir) for f in files])
+        self.assertEqual(work_queue.wait_and_record(queue_path, poll_interval=0.1)["done"], 6)
+        self.assertEqual([f for _, _, files in os.walk(cache_dir) for f in files], [])
+        print("test_25_work_queue_workers_drain_and_retry_expired_leases: PASSED")
+
+    def test_26_throttle_adapts_concurrency_and_lowers_priority(self):
+        print("\nRunning test_26_throttle_adapts_concurrency_and_lowers_priority (flacHelper direct)...")
+        import flacHelper
+        from concurrent.futures import ProcessPoolExecutor
+        source = os.path.join(self.TEST_BASE_DIR, "throttle_src")
+        if os.path.exists(source): shutil.rmtree(source)
+        os.makedirs(source)
+        for index in range(6):
+            shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.flac"), os.path.join(source, f"track{index}.flac"))
+        report_path = os.path.join(self.TEST_BASE_DIR, "throttle_report.jsonl")
+
+        # A host that stays overloaded: concurrency must step down to min_jobs and stay there.
+        busy_host = lambda: {"load": 100.0, "cpus": 4, "free_memory": 0.5, "io_pressure": 0.0}
+        events = list(iter_conversion(source, self.TARGET_DIR_EXPLICIT, jobs=3, backend="ffmpeg",
+                                      report_path=report_path,
+                                      throttle={"sampler": busy_host, "interval": 0, "max_load": 4.0}))
+        decisions = [e["decision"] for e in events if e["type"] == "throttled"]
+        self.assertEqual([(d["from"], d["to"]) for d in decisions], [(3, 2), (2, 1)])
+        self.assertIn("load 100.00 > 4.00", decisions[0]["reason"])
+        self.assertEqual(events[-1]["stats"]["concurrency"], 1)
+        self.assertEqual(len([e for e in events if e["type"] == "finished"]), 6)
+        self.assertEqual(len(events[-1]["summary"]["throttle_decisions"]), 2)
+
+        # Without an explicit max_load the load average (which the run itself raises) is not a limit.
+        from throttle import Throttle
+        unbounded = Throttle(3, sampler=busy_host, interval=0)
+        self.assertEqual([unbounded.limit() for _ in range(3)], [3, 3, 3])
+        self.assertEqual(unbounded.decisions, [])
+
+        # Workers start with the requested niceness and CPU affinity (inherited by encoders).
+        cpu = min(os.sched_getaffinity(0))
+        with ProcessPoolExecutor(max_workers=1, initializer=flacHelper._init_worker,
+                                 initargs=({"nice": 5, "ionice": "idle", "cpus": [cpu]},)) as pool:
+            nice, affinity = pool.submit(_worker_priority).result()
+        self.assertEqual(nice, os.nice(0) + 5)
+        self.assertEqual(affinity, {cpu})
+        with self.assertRaises(ValueError):
+            list(iter_conversion(source, self.TARGET_DIR_EXPLICIT, priority={"ionice": "urgent"}))
+        print("test_26_throttle_adapts_concurrency_and_lowers_priority: PASSED")
+
+    def test_27_replaygain_measured_during_conversion(self):
+        print("\nRunning test_27_replaygain_measured_during_conversion (flacHelper direct)...")
+        import loudness
+        import native_codec
+        if not loudness.AVAILABLE:
+            self.skipTest("numpy is not installed")
+        source = os.path.join(self.TEST_BASE_DIR, "replaygain_src")
+        if os.path.exists(source): shutil.rmtree(source)
+        os.makedirs(source)
+        # 997 Hz at -20 dBFS (the sine source peaks at 1/8) in both channels
+        # measures -20 LUFS by definition.
+        subprocess.run(["ffmpeg", "-nostdin", "-v", "error", "-y", "-f", "lavfi",
+                        "-i", "sine=frequency=997:sample_rate=48000:duration=5",
+                        "-af", "volume=0.8,pan=stereo|c0=c0|c1=c0", "-metadata", "REPLAYGAIN_TRACK_GAIN=+9.00 dB",
+                        os.path.join(source, "tone.flac")], check=True)
+        shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.m4a"), os.path.join(source, "other.m4a"))
+
+        backends = ["ffmpeg"] + (["native"] if native_codec.AVAILABLE else [])
+        for backend in backends:
+            target = os.path.join(self.TEST_BASE_DIR, f"replaygain_{backend}")
+            if os.path.exists(target): shutil.rmtree(target)
+            report_path = os.path.join(self.TEST_BASE_DIR, f"replaygain_{backend}.jsonl")
+            results = scan_and_convert(source, target, jobs=1, backend=backend, replaygain=True,
+                                       report_path=report_path)
+            tone = next(r for r in results if r["input"].endswith("tone.flac"))
+            self.assertEqual(tone["status"], "converted", tone["error"])
+            self.assertAlmostEqual(tone["loudness"]["integrated_lufs"], -20.0, delta=0.05)
+            self.assertAlmostEqual(tone["loudness"]["replaygain_track_gain"], 2.0, delta=0.05)
+            self.assertAlmostEqual(tone["loudness"]["peak"], 0.1, delta=0.002)
+            self.assertAlmostEqual(tone["duration"], 5.0, places=2)
+            with open(tone["output"], "rb") as f:
+                head = f.read(4096)
+            # The source's stale gain is replaced, not duplicated.
+            self.assertEqual(head.count(b"REPLAYGAIN_TRACK_GAIN"), 1)
+            self.assertIn(b"REPLAYGAIN_TRACK_GAIN\x002.00 dB", head)
+            for r in results:
+                is_valid, msg = self._check_mp3_validity(r["output"])
+                self.assertTrue(is_valid, f"{r['output']} invalid: {msg}")
+            with open(report_path, "r", encoding="utf-8") as f:
+                records = [json.loads(line) for line in f if '"type": "file"' in line]
+            self.assertTrue(all(record["loudness"] is not None for record in records))
+            self.assertTrue(all("loudness" in record["stages"] for record in records))
+
+        # 8-bit PCM (unsigned on disk, signed in pydub) measures the same on every backend.
+        eight_bit = os.path.join(source, "tone8.wav")
+        subprocess.run(["ffmpeg", "-nostdin", "-v", "error", "-y", "-f", "lavfi",
+                        "-i", "sine=frequency=997:sample_rate=48000:duration=3",
+                        "-af", "volume=0.8,pan=stereo|c0=c0|c1=c0", "-c:a", "pcm_u8", eight_bit], check=True)
+        for backend in ["pydub"] + backends:
+            result = convert_audio_to_mp3(eight_bit, os.path.join(self.TEST_BASE_DIR, f"tone8_{backend}.mp3"),
+                                          backend=backend, input_format="wav", replaygain=True)
+            self.assertEqual(result["status"], "converted", result["error"])
+            self.assertEqual(result["backend"], backend)
+            self.assertAlmostEqual(result["loudness"]["integrated_lufs"], -20.0, delta=0.1, msg=backend)
+
+        # Block boundaries do not change the measurement.
+        import numpy
+        samples = (numpy.random.default_rng(0).standard_normal((100000, 2)) * 3000).astype("int16")
+        whole = loudness.LoudnessMeter(44100, 2)
+        whole.add(samples)
+        pieces = loudness.LoudnessMeter(44100, 2)
+        for start in range(0, len(samples), 7919):
+            pieces.add(samples[start:start + 7919])
+        self.assertAlmostEqual(whole.integrated(), pieces.integrated(), places=6)
+        self.assertIsNone(loudness.LoudnessMeter(44100, 2).result()["replaygain_track_gain"])
+        print("test_27_replaygain_measured_during_conversion: PASSED")
+
+    def test_28_dead_worker_fails_only_its_own_file(self):
+        print("\nRunning test_28_dead_worker_fails_only_its_own_file (flacHelper direct)...")
+        import flacHelper
+        source = os.path.join(self.TEST_BASE_DIR, "dead_worker_src")
+        if os.path.exists(source): shutil.rmtree(source)
+        os.makedirs(source)
+        for name in ["a.flac", "crash.flac", "b.flac", "c.flac", "d.flac"]:
+            shutil.copy(os.path.join(self.ASSETS_DIR, "dummy.flac"), os.path.join(source, name))
+        target = os.path.join(self.TEST_BASE_DIR, "dead_worker_target")
+        if os.path.exists(target): shutil.rmtree(target)
+        with mock.patch.object(flacHelper, "_run_job", _crashing_run_job):
+            results = scan_and_convert(source, target, jobs=2, backend="ffmpeg")
+        statuses = {os.path.basename(r["input"]): r["status"] for r in results}
+        self.assertEqual(statuses, {"a.flac": "converted", "crash.flac": "failed", "b.flac": "converted",
+                                    "c.flac": "converted", "d.flac": "converted"})
+        crashed = next(r for r in results if r["input"].endswith("crash.flac"))
+        self.assertIn("worker process", crashed["error"])
+        self.assertFalse(os.path.exists(crashed["output"]))
+        for r in results:
+            if r["status"] == "converted":
+                is_valid, msg = self._check_mp3_validity(r["output"])
+                self.assertTrue(is_valid, f"{r['output']} invalid: {msg}")
+        print("test_28_dead_worker_fails_only_its_own_file: PASSED")
+
 if __name__ == '__main__':
     print("----------------------------------------------------------------------")
     print("Audio Converter Test Suite - Using Valid Dummy Audio Files")
@@ -0,0 +1,192 @@
+import ctypes
+import os
+import platform
+import time
+
+# Adaptive concurrency and process priority for conversions sharing a host with
+# other services.
+#
+# A Throttle samples the load average, available memory and I/O pressure at
+# most every `interval` seconds and moves the number of conversions allowed to
+# run at once one step at a time between min_jobs and max_jobs: down when any
+# signal is over its limit, up when all of them are comfortably below. The load
+# average is a one-minute moving average, so single steps keep the scheduler
+# from oscillating. Every change is kept in `decisions`.
+#
+# The load average counts the run's own encoders, so it is only checked against
+# an explicit max_load: a default derived from the CPU count would be reached by
+# the conversions alone and make the limit swing up and down.
+
+# Defaults for the limits; memory is a fraction of MemTotal and I/O pressure the
+# percentage of the last 10 s in which some task waited on I/O.
+MIN_FREE_MEMORY = 0.10
+MAX_IO_PRESSURE = 10.0
+THROTTLE_INTERVAL = 5.0
+
+# Fraction of a limit a signal must be under before concurrency is raised again.
+HEADROOM = 0.75
+
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+# ioprio_set has no libc wrapper; its syscall number depends on the architecture.
+_SYS_IOPRIO_SET = {"x86_64": 251, "amd64": 251, "i386": 289, "i686": 289, "aarch64": 30, "arm64": 30,
+                   "armv7l": 314, "ppc64le": 273, "ppc64": 273, "s390x": 282, "riscv64": 30}
+
+
+def _read_meminfo():
+    values = {}
+    with open("/proc/meminfo", "r", encoding="ascii") as f:
+        for line in f:
+            key, _, rest = line.partition(":")
+            values[key] = int(rest.split()[0]) * 1024
+    return values
+
+
+def _read_io_pressure():
+    # "some avg10" from the kernel's pressure stall information (Linux 4.20+).
+    with open("/proc/pressure/io", "r", encoding="ascii") as f:
+        for line in f:
+            fields = line.split()
+            if fields and fields[0] == "some":
+                return float(dict(field.split("=") for field in fields[1:])["avg10"])
+    return None
+
+
+def sample_host():
+    # {"load": 1-minute load average, "cpus", "free_memory": MemAvailable as a
+    # fraction of MemTotal, "io_pressure"}; None for what this platform lacks.
+    sample = {"load": None, "cpus": os.cpu_count() or 1, "free_memory": None, "io_pressure": None}
+    try:
+        sample["load"] = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        pass
+    try:
+        meminfo = _read_meminfo()
+        sample["free_memory"] = meminfo["MemAvailable"] / meminfo["MemTotal"]
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        pass
+    try:
+        sample["io_pressure"] = _read_io_pressure()
+    except (OSError, KeyError, ValueError):
+        pass
+    return sample
+
+
+class Throttle:
+    # Current concurrency limit for a run; see the top of this module. The load
+    # average is ignored unless max_load is given. Starts at max_jobs, or at
+    # start_jobs when given.
+
+    def __init__(self, max_jobs, min_jobs=1, max_load=None, min_free_memory=MIN_FREE_MEMORY,
+                 max_io_pressure=MAX_IO_PRESSURE, interval=THROTTLE_INTERVAL, start_jobs=None, sampler=sample_host):
+        if not 1 <= min_jobs <= max_jobs:
+            raise ValueError(f"Throttle needs 1 <= min_jobs <= max_jobs, got {min_jobs} and {max_jobs}")
+        self.min_jobs = min_jobs
+        self.max_jobs = max_jobs
+        self.max_load = max_load
+        self.min_free_memory = min_free_memory
+        self.max_io_pressure = max_io_pressure
+        self.interval = interval
+        self.sampler = sampler
+        self.current = max(min_jobs, min(max_jobs, start_jobs or max_jobs))
+        self.decisions = []
+        self._started = time.monotonic()
+        self._next_sample = self._started
+
+    def _pressure(self, sample):
+        # (reasons the host is over a limit, whether it has headroom everywhere).
+        over = []
+        headroom = True
+        checks = [
+            ("load", sample["load"], self.max_load, False),
+            ("free memory", sample["free_memory"], self.min_free_memory, True),
+            ("io pressure", sample["io_pressure"], self.max_io_pressure, False),
+        ]
+        for name, value, limit, is_floor in checks:
+            if value is None or limit is None:
+                continue
+            if is_floor:
+                if value < limit:
+                    over.append(f"{name} {value:.0%} < {limit:.0%}")
+                headroom = headroom and value >= limit / HEADROOM
+            else:
+                if value > limit:
+                    over.append(f"{name} {value:.2f} > {limit:.2f}")
+                headroom = headroom and value <= limit * HEADROOM
+        return over, headroom
+
+    def limit(self):
+        # Conversions allowed to run now; resamples the host when due.
+        now = time.monotonic()
+        if now < self._next_sample:
+            return self.current
+        self._next_sample = now + self.interval
+        sample = self.sampler()
+        over, headroom = self._pressure(sample)
+        previous = self.current
+        if over and self.current > self.min_jobs:
+            self.current -= 1
+            reason = ", ".join(over)
+        elif not over and headroom and self.current < self.max_jobs:
+            self.current += 1
+            reason = "headroom"
+        else:
+            return self.current
+        self.decisions.append({"elapsed": now - self._started, "from": previous, "to": self.current,
+                               "reason": reason, "sample": sample})
+        return self.current
+
+
+def parse_cpu_list(text):
+    # "0-3,6" -> [0, 1, 2, 3, 6], as taskset and cgroups write CPU lists.
+    cpus = []
+    for part in text.split(","):
+        first, _, last = part.strip().partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _parse_ionice(spec):
+    # "idle", "best-effort" or "best-effort:7" -> (class, level).
+    name, _, level = spec.partition(":")
+    if name not in IOPRIO_CLASSES:
+        raise ValueError(f"Unknown I/O priority class {name!r}, expected one of {sorted(IOPRIO_CLASSES)}")
+    level = int(level) if level else 4
+    if not 0 <= level <= 7:
+        raise ValueError(f"I/O priority level must be 0-7, got {level}")
+    return IOPRIO_CLASSES[name], level
+
+
+def check_priority(priority):
+    # Validates a priority dict ("nice", "ionice", "cpus") in the parent process,
+    # so a bad setting fails the run up front instead of every worker.
+    if not priority:
+        return
+    if priority.get("ionice"):
+        _parse_ionice(priority["ionice"])
+        if platform.machine().lower() not in _SYS_IOPRIO_SET:
+            raise ValueError(f"I/O priorities are not supported on {platform.machine()}")
+    if priority.get("cpus"):
+        if not hasattr(os, "sched_setaffinity"):
+            raise ValueError("CPU affinity is not supported on this platform")
+        unknown = set(priority["cpus"]) - os.sched_getaffinity(0)
+        if unknown:
+            raise ValueError(f"CPUs {sorted(unknown)} are not available to this process")
+
+
+def apply_priority(priority):
+    # Applies nice, ionice and CPU affinity to the calling process; encoders it
+    # spawns inherit all three.
+    if not priority:
+        return
+    if priority.get("nice"):
+        os.nice(priority["nice"])
+    if priority.get("ionice"):
+        io_class, level = _parse_ionice(priority["ionice"])
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.syscall(_SYS_IOPRIO_SET[platform.machine().lower()], _IOPRIO_WHO_PROCESS, 0,
+                        (io_class << _IOPRIO_CLASS_SHIFT) | level) < 0:
+            raise OSError(ctypes.get_errno(), "ioprio_set failed")
+    if priority.get("cpus"):
+        os.sched_setaffinity(0, priority["cpus"])
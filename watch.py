@@ -0,0 +1,325 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+
+from flacHelper import SUPPORTED_EXTENSIONS, iter_conversion, mirror_moves, mirror_removals
+
+# Watch mode: convert a folder once, then keep the output tree in step as files
+# arrive, change, move or disappear, converting only the files concerned.
+#
+# Watchers report changes as tuples of paths relative to the root:
+# ("changed", path), ("deleted", path), ("moved", old, new), or ("rescan",)
+# when changes may have been lost. Deleted and moved paths can be folders.
+
+# Seconds a file must go without changes before it is converted, so copies and
+# rips still being written are left alone.
+DEBOUNCE_SECONDS = 2.0
+
+# Rescan period of the polling watcher.
+POLL_INTERVAL = 5.0
+
+# Longest wait for changes before checking for a stop request.
+IDLE_WAKEUP = 1.0
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE
+               | _IN_DELETE | _IN_ONLYDIR)
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _is_audio(relative_path):
+    return relative_path.lower().endswith(SUPPORTED_EXTENSIONS)
+
+
+def _files_under(root_folder, relative_folder):
+    # Supported files below a folder, relative to root_folder.
+    found = []
+    for folder, _, filenames in os.walk(os.path.join(root_folder, relative_folder)):
+        found.extend(os.path.relpath(os.path.join(folder, filename), root_folder)
+                     for filename in filenames if _is_audio(filename))
+    return found
+
+
+class InotifyWatcher:
+    # Linux inotify through ctypes, one watch per directory: an idle tree costs
+    # no CPU, and changes are seen as they happen. Raises OSError where inotify
+    # is unavailable or the watch limit (fs.inotify.max_user_watches) is hit.
+
+    def __init__(self, root_folder):
+        self.root_folder = root_folder
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        # IN_NONBLOCK and IN_CLOEXEC share their values with O_NONBLOCK and O_CLOEXEC.
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._folders = {}  # watch descriptor -> folder relative to the root ("" for the root)
+        try:
+            self._watch_tree("")
+        except OSError:
+            self.close()
+            raise
+
+    def _watch_tree(self, relative_folder):
+        # Watches relative_folder and every folder below it.
+        for folder, _, _ in os.walk(os.path.join(self.root_folder, relative_folder)):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), _WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue  # Gone again already.
+                raise OSError(error, f"inotify_add_watch failed for {folder}")
+            relative = os.path.relpath(folder, self.root_folder)
+            self._folders[wd] = "" if relative == os.curdir else relative
+
+    def _unwatch_tree(self, relative_folder):
+        prefix = relative_folder + os.sep
+        for wd, folder in list(self._folders.items()):
+            if folder == relative_folder or folder.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._folders[wd]
+
+    def _rename_tree(self, old_folder, new_folder):
+        # Watches follow a moved directory; only the paths they stand for change.
+        prefix = old_folder + os.sep
+        for wd, folder in self._folders.items():
+            if folder == old_folder or folder.startswith(prefix):
+                self._folders[wd] = new_folder + folder[len(old_folder):]
+
+    def _read_events(self):
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return data
+            if not chunk:
+                return data
+            data += chunk
+
+    def read(self, timeout):
+        # Waits up to timeout seconds for changes and returns them.
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        data = self._read_events()
+        changes = []
+        moved_from = {}  # cookie -> (relative path, is_dir)
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += _EVENT_HEADER.size + length
+            if mask & _IN_Q_OVERFLOW:
+                changes.append(("rescan",))
+                continue
+            if mask & _IN_IGNORED:
+                self._folders.pop(wd, None)
+                continue
+            if wd not in self._folders or mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+                continue
+            path = os.path.join(self._folders[wd], os.fsdecode(name))
+            is_dir = bool(mask & _IN_ISDIR)
+            if mask & _IN_MOVED_FROM:
+                moved_from[cookie] = (path, is_dir)
+            elif mask & _IN_MOVED_TO:
+                old = moved_from.pop(cookie, None)
+                if is_dir:
+                    if old is not None:
+                        self._rename_tree(old[0], path)
+                        changes.append(("moved", old[0], path))
+                    else:
+                        self._watch_tree(path)
+                    changes.extend(("changed", child) for child in _files_under(self.root_folder, path))
+                else:
+                    if old is not None:
+                        changes.append(("moved", old[0], path))
+                    if _is_audio(path):
+                        changes.append(("changed", path))
+            elif mask & _IN_DELETE:
+                changes.append(("deleted", path))
+            elif is_dir:
+                if mask & _IN_CREATE:
+                    # Files may have landed before the new folder was watched.
+                    self._watch_tree(path)
+                    changes.extend(("changed", child) for child in _files_under(self.root_folder, path))
+            elif _is_audio(path):
+                changes.append(("changed", path))
+        # A move whose destination is outside the tree is a deletion.
+        for path, is_dir in moved_from.values():
+            if is_dir:
+                self._unwatch_tree(path)
+            changes.append(("deleted", path))
+        return changes
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    # Fallback for systems without inotify, and for network mounts, where
+    # inotify does not see changes made by other machines: rescans the tree
+    # every interval and compares (inode, size, mtime) snapshots. A file that
+    # vanished while one with the same inode, size and mtime appeared was moved.
+
+    def __init__(self, root_folder, interval=POLL_INTERVAL):
+        self.root_folder = root_folder
+        self.interval = interval
+        self._snapshot = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def _scan(self):
+        snapshot = {}
+        folders = [self.root_folder]
+        while folders:
+            try:
+                entries = list(os.scandir(folders.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif _is_audio(entry.name):
+                        stat = entry.stat()
+                        snapshot[os.path.relpath(entry.path, self.root_folder)] = (
+                            stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    continue
+        return snapshot
+
+    def read(self, timeout):
+        wait = self._next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(max(0.0, timeout))
+            return []
+        time.sleep(max(0.0, wait))
+        self._next_scan = time.monotonic() + self.interval
+        previous, self._snapshot = self._snapshot, self._scan()
+        vanished = {identity: path for path, identity in previous.items() if path not in self._snapshot}
+        changes = []
+        for path, identity in self._snapshot.items():
+            if previous.get(path) == identity:
+                continue
+            old_path = vanished.pop(identity, None) if path not in previous else None
+            if old_path is not None:
+                changes.append(("moved", old_path, path))
+            changes.append(("changed", path))
+        changes.extend(("deleted", path) for path in vanished.values())
+        return changes
+
+    def close(self):
+        pass
+
+
+def open_watcher(root_folder, poll_interval=None):
+    # inotify where available, else polling; a poll_interval forces polling.
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(root_folder)
+        except (OSError, AttributeError):  # AttributeError: no inotify in this libc.
+            pass
+    return PollingWatcher(root_folder, poll_interval or POLL_INTERVAL)
+
+
+def _excluded_folders(root_folder, output_folder, profiles):
+    # Output folders inside the source tree, relative to it, so the watcher
+    # never converts its own output.
+    excluded = []
+    for folder in [output_folder] + [profile.get("output_folder") for profile in profiles or []]:
+        if folder:
+            relative = os.path.relpath(os.path.abspath(folder), os.path.abspath(root_folder))
+            if relative != os.pardir and not relative.startswith(os.pardir + os.sep):
+                excluded.append(relative)
+    return excluded
+
+
+def watch(root_folder, output_folder, stop_event=None, debounce=DEBOUNCE_SECONDS, poll_interval=None, **options):
+    # Converts root_folder incrementally (see iter_conversion; options are passed
+    # on), then keeps output_folder in step until stop_event is set, yielding
+    # iter_conversion's events as it goes. A new or changed file is converted
+    # once it has been left alone for `debounce` seconds. Deleted sources lose
+    # their outputs ("pruned" events) and renamed sources have their outputs
+    # renamed rather than re-encoded ("moved" events); those two events carry
+    # only a "result". poll_interval forces the polling watcher, e.g. for
+    # network shares.
+    stop_event = stop_event or threading.Event()
+    profiles = options.get("profiles")
+    jobs = options.pop("jobs", None) or os.cpu_count() or 1
+    for option in ("incremental", "prune", "cancel_event", "sources"):
+        options.pop(option, None)
+    excluded = _excluded_folders(root_folder, output_folder, profiles)
+
+    def wanted(path):
+        return not any(path == folder or path.startswith(folder + os.sep) for folder in excluded)
+
+    def full_run():
+        return iter_conversion(root_folder, output_folder, jobs=jobs, incremental=True, prune=True,
+                               cancel_event=stop_event, **options)
+
+    # Watching starts before the first run, so files landing during it are not missed.
+    watcher = open_watcher(root_folder, poll_interval)
+    try:
+        yield from full_run()
+        pending = {}  # relative path -> when it last changed
+        while not stop_event.is_set():
+            now = time.monotonic()
+            timeout = min([changed + debounce - now for changed in pending.values()] + [IDLE_WAKEUP])
+            changes = watcher.read(max(0.0, timeout))
+            rescan = False
+            removed = []
+            moves = []
+            now = time.monotonic()
+            for change in changes:
+                if change[0] == "rescan":
+                    rescan = True
+                elif change[0] == "changed":
+                    if wanted(change[1]):
+                        pending[change[1]] = now
+                elif change[0] == "deleted":
+                    if wanted(change[1]):
+                        removed.append(change[1])
+                        for path in [path for path in pending if path == change[1]
+                                     or path.startswith(change[1] + os.sep)]:
+                            del pending[path]
+                elif wanted(change[1]) and wanted(change[2]):
+                    moves.append((change[1], change[2]))
+                    for path in [path for path in pending if path == change[1]
+                                 or path.startswith(change[1] + os.sep)]:
+                        pending[change[2] + path[len(change[1]):]] = pending.pop(path)
+            if moves:
+                for result in mirror_moves(root_folder, output_folder, moves, profiles):
+                    yield {"type": result["status"], "result": result}
+            if removed:
+                for result in mirror_removals(root_folder, output_folder, removed, profiles):
+                    yield {"type": "pruned", "result": result}
+            if rescan:
+                pending.clear()
+                yield from full_run()
+                continue
+            ready = sorted(path for path, changed in pending.items() if now - changed >= debounce)
+            if ready:
+                for path in ready:
+                    del pending[path]
+                yield from iter_conversion(root_folder, output_folder, jobs=min(jobs, len(ready)), incremental=True,
+                                           cancel_event=stop_event, sources=ready, **options)
+    finally:
+        watcher.close()
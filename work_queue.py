@@ -0,0 +1,368 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from encode_cache import DEFAULT_CACHE_MAX_BYTES, EncodeCache
+from flacHelper import (BACKENDS, convert_planned_job, default_scratch_dir, format_plan, plan_conversion,
+                        record_results)
+
+# Coordinator/worker mode: a coordinator plans a conversion into a queue held
+# in a SQLite file, and any number of worker processes, on this host or on
+# others that mount the queue, source and target at the same paths, lease jobs
+# from it, convert them and acknowledge them. A lease that is not renewed (its
+# worker crashed or lost the share) expires and the job goes to another worker.
+# Workers never touch the manifests; the coordinator records every finished job
+# once the queue is drained, so the next incremental run skips them.
+#
+#   python work_queue.py coordinate MyMusic MyMusic_mp3 --queue /shared/q.sqlite --workers 4
+#   python work_queue.py work --queue /shared/q.sqlite --processes 8      (on each other host)
+
+# Seconds a lease lasts; workers renew it every third of that while converting.
+LEASE_SECONDS = 300.0
+# Times a job is handed out (failures and expired leases) before it fails for good.
+MAX_ATTEMPTS = 3
+# How often idle workers and the coordinator look at the queue again.
+POLL_SECONDS = 1.0
+# Seconds the coordinator waits while no worker holds a live lease and no job
+# finishes before it gives up on the remaining jobs.
+IDLE_SECONDS = 600.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    relative TEXT NOT NULL UNIQUE,
+    job TEXT NOT NULL,
+    priority REAL NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, priority);
+CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+
+class WorkQueue:
+    # One run's jobs in a SQLite file. Job states: "pending", "leased" (to
+    # lease_owner until lease_expires, a time.time() value), "done" and
+    # "failed". The rollback journal is used rather than WAL, which needs
+    # shared memory and so does not work on network filesystems.
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can never
+        # both see a job as free and lease it.
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._connection
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    def reset(self, run, jobs):
+        # Replaces the queue's contents with a new run: settings dict and jobs
+        # from plan_conversion, which are handed out longest first.
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM jobs")
+            connection.execute("DELETE FROM run")
+            connection.executemany("INSERT INTO run (key, value) VALUES (?, ?)",
+                                   [(key, json.dumps(value)) for key, value in run.items()])
+            connection.executemany("INSERT INTO jobs (relative, job, priority) VALUES (?, ?, ?)",
+                                   [(job["relative"], json.dumps(job), job["estimated_duration"]) for job in jobs])
+
+    def run(self):
+        return {key: json.loads(value) for key, value in self._connection.execute("SELECT key, value FROM run")}
+
+    def lease(self, owner, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        # Hands the next job to owner as (job id, job), or returns None when
+        # nothing is free. Expired leases count as free until the job has had
+        # max_attempts tries, after which it fails.
+        now = time.time()
+        with self._transaction() as connection:
+            _fail_expired(connection, now, max_attempts)
+            row = connection.execute(
+                "SELECT id, job FROM jobs WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                "ORDER BY priority DESC, id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET state = 'leased', attempts = attempts + 1, lease_owner = ?, lease_expires = ? "
+                "WHERE id = ?", (owner, now + lease_seconds, row[0]))
+        return row[0], json.loads(row[1])
+
+    def renew(self, job_id, owner, lease_seconds=LEASE_SECONDS):
+        # Extends owner's lease; False if it has lost the job to another worker.
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ? AND state = 'leased'",
+                (time.time() + lease_seconds, job_id, owner))
+        return cursor.rowcount == 1
+
+    def ack(self, job_id, owner, result, max_attempts=MAX_ATTEMPTS):
+        # Records owner's result for a job. A failed conversion goes back to the
+        # queue until it has had max_attempts tries. Ignored (returns False) when
+        # the lease has meanwhile passed to another worker.
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET state = CASE WHEN ? THEN 'done' WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                "result = ?, lease_owner = NULL, lease_expires = NULL "
+                "WHERE id = ? AND lease_owner = ? AND state = 'leased'",
+                (result["status"] == "converted", max_attempts, json.dumps(result), job_id, owner))
+        return cursor.rowcount == 1
+
+    def expire(self, max_attempts=MAX_ATTEMPTS):
+        # Fails the jobs whose lease expired on their last allowed attempt, as
+        # lease() does, for when no worker is left to call it.
+        with self._transaction() as connection:
+            _fail_expired(connection, time.time(), max_attempts)
+
+    def live_leases(self):
+        return self._connection.execute("SELECT COUNT(*) FROM jobs WHERE state = 'leased' AND lease_expires >= ?",
+                                        (time.time(),)).fetchone()[0]
+
+    def abandon(self, error):
+        # Fails every job that has not finished, with error as the reason.
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET state = 'failed', result = ?, lease_owner = NULL, lease_expires = NULL "
+                "WHERE state IN ('pending', 'leased')", (json.dumps({"status": "failed", "error": error}),))
+
+    def counts(self):
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        for state, count in self._connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+            counts[state] = count
+        return counts
+
+    def outstanding(self):
+        counts = self.counts()
+        return counts["pending"] + counts["leased"]
+
+    def finished(self):
+        # (job, result) for every job that is done or has failed for good.
+        return [(json.loads(job), json.loads(result)) for job, result in self._connection.execute(
+            "SELECT job, result FROM jobs WHERE state IN ('done', 'failed') ORDER BY id")]
+
+
+def _fail_expired(connection, now, max_attempts):
+    connection.execute(
+        "UPDATE jobs SET state = 'failed', result = ? WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+        (json.dumps({"status": "failed", "error": "lease expired on every attempt"}), now, max_attempts))
+
+
+def _worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def run_worker(queue_path, stop_event=None, scratch_dir=None, exit_when_idle=True, host_workers=1):
+    # Leases, converts and acknowledges jobs until the queue has nothing left
+    # (or, with exit_when_idle=False, until stop_event is set). Returns the
+    # number of jobs this worker converted or failed. host_workers is how many
+    # workers share this host: a long track split across cores (see
+    # split_longer_than) gets this worker's share of them.
+    stop_event = stop_event or threading.Event()
+    owner = _worker_name()
+    queue = WorkQueue(queue_path)
+    settings = queue.run()
+    lease_seconds = settings.get("lease_seconds", LEASE_SECONDS)
+    max_attempts = settings.get("max_attempts", MAX_ATTEMPTS)
+    scratch = tempfile.mkdtemp(prefix="flacconvert-worker-", dir=scratch_dir or default_scratch_dir())
+    created_folders = set()
+    split_segments = max(2, (os.cpu_count() or 1) // max(1, host_workers))
+    handled = 0
+    try:
+        while not stop_event.is_set():
+            leased = queue.lease(owner, lease_seconds, max_attempts)
+            if leased is None:
+                if exit_when_idle and queue.outstanding() == 0:
+                    break
+                # Others still hold leases that may expire; keep checking.
+                stop_event.wait(POLL_SECONDS)
+                continue
+            job_id, job = leased
+            job["split_segments"] = split_segments
+            converted = threading.Event()
+
+            def heartbeat():
+                renewals = WorkQueue(queue_path)
+                try:
+                    while not converted.wait(lease_seconds / 3):
+                        if not renewals.renew(job_id, owner, lease_seconds):
+                            return
+                finally:
+                    renewals.close()
+
+            renewer = threading.Thread(target=heartbeat, daemon=True)
+            renewer.start()
+            try:
+                result = convert_planned_job(job, scratch, created_folders)
+            finally:
+                converted.set()
+                renewer.join()
+            queue.ack(job_id, owner, result, max_attempts)
+            handled += 1
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+        queue.close()
+    return handled
+
+
+def enqueue(queue_path, root_folder, output_folder, backend="pydub", incremental=True, hash_sources=False,
+            cache_dir=None, profiles=None, split_longer_than=None, lease_seconds=LEASE_SECONDS,
+            max_attempts=MAX_ATTEMPTS, replaygain=False, cache_max_bytes=DEFAULT_CACHE_MAX_BYTES):
+    # Plans root_folder -> output_folder (see plan_conversion) and replaces the
+    # queue's contents with the jobs. Returns the plan. With cache_dir, the
+    # cache is trimmed to cache_max_bytes once the queue is drained.
+    plan = plan_conversion(root_folder, output_folder, 1, backend, incremental, hash_sources, cache_dir,
+                           profiles=profiles, replaygain=replaygain)
+    for job in plan["tasks"]:
+        job["split_longer_than"] = split_longer_than
+    queue = WorkQueue(queue_path)
+    try:
+        queue.reset({
+            "root_folder": root_folder,
+            "output_folder": output_folder,
+            "profiles": plan["profiles"],
+            "incremental": incremental,
+            "lease_seconds": lease_seconds,
+            "max_attempts": max_attempts,
+            "cache_dir": cache_dir,
+            "cache_max_bytes": cache_max_bytes,
+        }, plan["tasks"])
+    finally:
+        queue.close()
+    return plan
+
+
+def wait_and_record(queue_path, poll_interval=POLL_SECONDS, progress_callback=None, idle_timeout=IDLE_SECONDS):
+    # Waits for the workers to drain the queue, then writes the manifest records
+    # of an incremental run and trims the encode cache. Returns the job counts
+    # by state; progress_callback, if given, receives them on every poll. Jobs
+    # whose lease expired on every attempt fail even with no worker left, and
+    # once no worker has held a live lease or finished a job for idle_timeout
+    # seconds (None: wait forever) the remaining jobs fail too.
+    queue = WorkQueue(queue_path)
+    try:
+        settings = queue.run()
+        max_attempts = settings.get("max_attempts", MAX_ATTEMPTS)
+        finished = None
+        active_at = time.monotonic()
+        while True:
+            queue.expire(max_attempts)
+            counts = queue.counts()
+            if progress_callback is not None:
+                progress_callback(counts)
+            if counts["pending"] + counts["leased"] == 0:
+                break
+            if queue.live_leases() or counts["done"] + counts["failed"] != finished:
+                finished = counts["done"] + counts["failed"]
+                active_at = time.monotonic()
+            elif idle_timeout is not None and time.monotonic() - active_at > idle_timeout:
+                queue.abandon(f"no worker took the job for {idle_timeout:g} s")
+                counts = queue.counts()
+                break
+            time.sleep(poll_interval)
+        if settings.get("incremental"):
+            record_results(settings["output_folder"], queue.finished(), settings["profiles"])
+        if settings.get("cache_dir"):
+            try:
+                EncodeCache(settings["cache_dir"], settings.get("cache_max_bytes", DEFAULT_CACHE_MAX_BYTES)).evict()
+            except OSError:
+                pass  # The cache is best-effort; the next run evicts again.
+        return counts
+    finally:
+        queue.close()
+
+
+def _spawn_worker(queue_path, scratch_dir=None, host_workers=1):
+    command = [sys.executable, os.path.abspath(__file__), "work", "--queue", queue_path,
+               "--host-workers", str(host_workers)]
+    if scratch_dir:
+        command += ["--scratch-dir", scratch_dir]
+    return subprocess.Popen(command, stdin=subprocess.DEVNULL)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Share one conversion between worker processes and hosts.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    coordinator = commands.add_parser("coordinate", help="plan a conversion into the queue and wait for it")
+    coordinator.add_argument("source", help="folder to scan for audio files")
+    coordinator.add_argument("target", help="output folder")
+    coordinator.add_argument("--queue", required=True, help="SQLite queue file, on storage every worker can reach")
+    coordinator.add_argument("--workers", type=int, default=0, help="worker processes to start on this host")
+    coordinator.add_argument("--backend", choices=sorted(BACKENDS), default="pydub")
+    coordinator.add_argument("--full", action="store_true", help="convert everything, ignoring the manifests")
+    coordinator.add_argument("--hash-sources", action="store_true", help="also compare content hashes")
+    coordinator.add_argument("--cache-dir", help="content-addressed cache shared between workers")
+    coordinator.add_argument("--profiles", help="JSON file with a list of output profiles")
+    coordinator.add_argument("--split-longer-than", type=float, metavar="SECONDS")
+    coordinator.add_argument("--replaygain", action="store_true", help="measure loudness and tag MP3 outputs")
+    coordinator.add_argument("--lease-seconds", type=float, default=LEASE_SECONDS)
+    coordinator.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS)
+    coordinator.add_argument("--idle-timeout", type=float, default=IDLE_SECONDS, metavar="SECONDS",
+                             help="give up on the remaining jobs once no worker has been active for this long "
+                                  "(0: wait forever)")
+    coordinator.add_argument("--scratch-dir", help="scratch folder for the local workers")
+    worker = commands.add_parser("work", help="convert jobs from the queue until it is empty")
+    worker.add_argument("--queue", required=True)
+    worker.add_argument("--processes", type=int, default=1, help="worker processes on this host")
+    worker.add_argument("--host-workers", type=int, help="workers sharing this host's cores, for splitting long "
+                                                         "tracks (default: --processes)")
+    worker.add_argument("--scratch-dir", help="local folder encodes are written to before being committed")
+    args = parser.parse_args(argv)
+
+    if args.command == "work":
+        host_workers = args.host_workers or max(1, args.processes)
+        if args.processes <= 1:
+            print(f"{run_worker(args.queue, scratch_dir=args.scratch_dir, host_workers=host_workers)} job(s) handled")
+            return 0
+        processes = [multiprocessing.Process(target=run_worker, args=(args.queue,),
+                                             kwargs={"scratch_dir": args.scratch_dir, "host_workers": host_workers})
+                     for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        return 0
+
+    profiles = None
+    if args.profiles:
+        with open(args.profiles, "r", encoding="utf-8") as f:
+            profiles = json.load(f)
+    plan = enqueue(args.queue, args.source, args.target, args.backend, not args.full, args.hash_sources,
+                   args.cache_dir, profiles, args.split_longer_than, args.lease_seconds, args.max_attempts,
+                   args.replaygain)
+    print(format_plan(plan))
+    workers = [_spawn_worker(args.queue, args.scratch_dir, args.workers) for _ in range(args.workers)]
+    try:
+        counts = wait_and_record(args.queue, idle_timeout=args.idle_timeout or None)
+    finally:
+        for process in workers:
+            process.wait()
+    print(f"{counts['done']} file(s) done, {counts['failed']} failed. Output: {args.target}")
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())